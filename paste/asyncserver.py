@@ -0,0 +1,590 @@
+# (c) 2005 Ian Bicking and contributors; written for Paste (http://pythonpaste.org)
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+An ``asyncio`` engine for paste.httpserver
+
+Connections are handled on an ``asyncio`` event loop: accepting,
+waiting for and parsing request heads, keep-alive, and buffering
+input from and output to slow clients all happen there, so an idle or
+slow connection costs no thread.  Only once a request head has
+arrived is the request given to a ``ThreadPool`` worker, which runs
+the WSGI application through the usual ``WSGIHandler`` (so WSGI
+applications and middleware work unchanged).  The worker reads the
+request body from, and writes the response to, buffers that the event
+loop fills from and sends to the socket.
+
+Use it with ``paste.httpserver.serve(app, engine='asyncio')``.  This
+needs Python 3.4+; the module is written without ``async`` syntax
+only so the rest of Paste still compiles on Python 2.
+"""
+
+from __future__ import print_function
+import asyncio
+import collections
+import errno
+import socket
+import sys
+import threading
+import time
+import traceback
+from io import BytesIO
+
+from six.moves import _thread
+from paste.httpserver import (
+    ChunkedInputFile, ConnectionManager, LimitedLengthFile, ThreadPoolMixIn,
+    WSGIHandler, _bind_socket, _default_backlog, _name_server,
+    _remove_unix_socket, _restart_if_requested, _ssl_environ,
+    _timeouts_lock)
+
+__all__ = ['AsyncioWSGIServer']
+
+
+class _InputStream(object):
+    """
+    Bytes received from a connection, fed by the event loop; request
+    heads are taken from it by the loop, and request bodies read (with
+    blocking reads) by worker threads.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.buffer = bytearray()
+        self.eof = False
+        self.cond = threading.Condition()
+        # Reads waiting longer than this raise socket.timeout:
+        self.timeout = None
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data):
+        with self.cond:
+            self.buffer += data
+            self.cond.notify_all()
+
+    def feed_eof(self):
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def take_head(self, max_size):
+        """
+        Removes and returns a complete request head (or the first
+        ``max_size`` bytes, if no head ends before), or returns None
+        """
+        with self.cond:
+            buffer = self.buffer
+            end = buffer.find(b'\r\n\r\n')
+            if end != -1:
+                end += 4
+            else:
+                end = buffer.find(b'\n\n')
+                if end != -1:
+                    end += 2
+                elif len(buffer) >= max_size:
+                    end = max_size
+                else:
+                    return None
+            head = bytes(buffer[:end])
+            del buffer[:end]
+            return head
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def _wait(self, deadline):
+        if deadline is None:
+            self.cond.wait()
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0 or not self.cond.wait(remaining):
+            raise socket.timeout('timed out')
+
+    def _deadline(self):
+        if self.timeout is None:
+            return None
+        return time.time() + self.timeout
+
+    def _take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        deadline = self._deadline()
+        with self.cond:
+            if size is None or size < 0:
+                while not self.eof:
+                    self._wait(deadline)
+                size = len(self.buffer)
+            else:
+                # Like a buffered file, only return less at the end (or
+                # when more than the connection buffers is asked for)
+                wanted = min(size, self.protocol.server.input_buffer_size)
+                while len(self.buffer) < wanted and not self.eof:
+                    self._wait(deadline)
+            data = self._take(size)
+        self.protocol.input_consumed()
+        return data
+
+    def readline(self, size=-1):
+        deadline = self._deadline()
+        limit = self.protocol.server.input_buffer_size
+        with self.cond:
+            start = 0
+            while True:
+                end = self.buffer.find(b'\n', start) + 1
+                if end:
+                    break
+                # Like read(), return part of a line longer than the
+                # connection buffers, since no more is read until some
+                # of it is taken
+                if (self.eof or 0 <= size <= len(self.buffer)
+                    or len(self.buffer) >= limit):
+                    end = len(self.buffer)
+                    break
+                start = len(self.buffer)
+                self._wait(deadline)
+            if size is not None and size >= 0:
+                end = min(end, size)
+            data = self._take(end)
+        self.protocol.input_consumed()
+        return data
+
+    def readlines(self, hint=None):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+
+class _OutputStream(object):
+    """
+    The ``wfile`` of a handler: hands what is written to the event
+    loop to send.  A worker thread writing to a client that is not
+    reading waits while the transport's buffer is full, or while the
+    server's ``write_buffer_size`` bytes are already waiting for the
+    loop to get to them.  Bytes and memoryviews (e.g., from the
+    content cache of ``paste.fileapp``) are passed on without being
+    copied.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def write(self, data):
+        protocol = self.protocol
+        if not isinstance(data, (bytes, memoryview)):
+            data = bytes(data)
+        if _thread.get_ident() == protocol.server.loop_thread_id:
+            protocol.write(data)
+            return
+        size = getattr(data, 'nbytes', len(data))
+        limit = protocol.server.write_buffer_size
+        with protocol.write_ready:
+            while not protocol.closed and (
+                    not protocol.writable or protocol.write_queued >= limit):
+                protocol.write_ready.wait(1)
+            if protocol.closed:
+                raise socket.error(errno.EPIPE, 'Connection closed by client')
+            protocol.write_queued += size
+        protocol.loop.call_soon_threadsafe(protocol.write, data, size)
+
+    def flush(self):
+        pass
+
+
+class _HTTPProtocol(asyncio.Protocol):
+    """
+    One connection of an ``AsyncioWSGIServer``
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = server.loop
+        self.transport = None
+        self.client_address = None
+        self.input = _InputStream(self)
+        # The handler of the request being run by a worker, if any:
+        self.handler = None
+        self.environ = None
+        self.requests = 0
+        self.closed = False
+        self.draining = False
+        self.reading_paused = False
+        # Notified when a worker may write again; guards writable
+        # (false while the transport's buffer is full) and
+        # write_queued (bytes written by a worker that the loop hasn't
+        # given to the transport yet):
+        self.write_ready = threading.Condition()
+        self.writable = True
+        self.write_queued = 0
+        self.timer = None
+        # What the timer is waiting for ('header_timeout' or
+        # 'keepalive_timeout'):
+        self.timer_reason = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info('peername')
+        transport.set_write_buffer_limits(high=self.server.write_buffer_size)
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self.environ = _ssl_environ(ssl_object)
+        self.server.connections.add(self)
+        self.set_idle_timer()
+
+    def data_received(self, data):
+        self.input.feed(data)
+        if (not self.reading_paused
+            and len(self.input) > self.server.input_buffer_size):
+            self.reading_paused = True
+            self.transport.pause_reading()
+        if self.handler is None:
+            if (self.timer_reason == 'keepalive_timeout'
+                and self.server.wsgi_header_timeout):
+                # The next request has started
+                self.set_idle_timer()
+            self.next_request()
+
+    def eof_received(self):
+        self.input.feed_eof()
+        # Keep the connection open to send the response, if a request
+        # is being run
+        return self.handler is not None
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.input.feed_eof()
+        with self.write_ready:
+            self.write_ready.notify_all()
+        self.cancel_timer()
+        self.server.connections.discard(self)
+
+    def pause_writing(self):
+        with self.write_ready:
+            self.writable = False
+
+    def resume_writing(self):
+        with self.write_ready:
+            self.writable = True
+            self.write_ready.notify_all()
+
+    def write(self, data, queued=0):
+        """
+        Writes ``data`` to the transport; ``queued`` is what a worker
+        added to ``write_queued`` for it
+        """
+        if not self.closed:
+            self.transport.write(data)
+        if queued:
+            with self.write_ready:
+                self.write_queued -= queued
+                self.write_ready.notify_all()
+
+    def close(self):
+        self.cancel_timer()
+        if not self.closed:
+            self.transport.close()
+
+    def input_consumed(self):
+        """
+        Called (by any thread) after request body has been read
+        """
+        if (self.reading_paused
+            and len(self.input) < self.server.input_buffer_size // 2):
+            self.loop.call_soon_threadsafe(self.resume_reading)
+
+    def resume_reading(self):
+        if self.reading_paused and not self.closed:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def set_idle_timer(self):
+        """
+        Starts the timer closing the connection if a request head
+        doesn't arrive in time
+        """
+        self.cancel_timer()
+        server = self.server
+        timeout = None
+        if server.wsgi_header_timeout and (len(self.input) or not self.requests):
+            # Waiting for (the rest of) a request head
+            timeout = server.wsgi_header_timeout
+            self.timer_reason = 'header_timeout'
+        if not timeout:
+            timeout = server.keepalive_timeout or server.wsgi_socket_timeout
+            self.timer_reason = 'keepalive_timeout'
+        if timeout:
+            self.timer = self.loop.call_later(timeout, self.idle_timeout,
+                                              self.timer_reason)
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.timer_reason = None
+
+    def idle_timeout(self, reason=None):
+        self.timer = None
+        self.timer_reason = None
+        if self.handler is None and not self.closed:
+            if reason is not None:
+                with _timeouts_lock:
+                    self.server.wsgi_timeouts[reason] += 1
+            self.close()
+
+    def drain(self):
+        """
+        Called when the server drains: idle connections are closed
+        (connections that haven't sent a first request get a few
+        seconds to do so), the others once their request is done.
+        """
+        self.draining = True
+        if self.handler is not None:
+            return
+        if self.requests and not len(self.input):
+            self.close()
+        else:
+            self.cancel_timer()
+            self.timer = self.loop.call_later(
+                ConnectionManager.drain_timeout, self.idle_timeout)
+
+    def next_request(self):
+        """
+        Parses the next request head, if it has arrived, and queues the
+        request to be run by a worker
+        """
+        if self.closed:
+            return
+        server = self.server
+        head = self.input.take_head(ConnectionManager.max_head_size)
+        if head is None:
+            if self.input.eof:
+                self.close()
+            return
+        self.cancel_timer()
+        handler = server.RequestHandlerClass.__new__(server.RequestHandlerClass)
+        handler.server = server
+        handler.client_address = self.client_address
+        handler.request = handler.connection = None
+        handler.close_connection = 1
+        handler.rfile = BytesIO(head)
+        handler.wfile = _OutputStream(self)
+        handler.raw_requestline = handler.rfile.readline(
+            handler.max_request_line + 1)
+        if not handler.parse_request():
+            # An error response has been sent
+            self.close()
+            return
+        handler.rfile = self.input
+        handler.wsgi_accepted_at = time.time()
+        if server.overloaded():
+            server.requests_shed += 1
+            self.write(server.shed_response())
+            self.close()
+            return
+        self.handler = handler
+        server.thread_pool.add_task(self.run_request)
+
+    def run_request(self):
+        """
+        Runs the request in a worker thread
+        """
+        handler = self.handler
+        server = self.server
+        try:
+            if server.expired(handler.wsgi_accepted_at):
+                with _timeouts_lock:
+                    server.requests_expired += 1
+                handler.close_connection = 1
+                handler.wfile.write(server.shed_response())
+            else:
+                handler.wsgi_execute(self.environ)
+        except:
+            handler.close_connection = 1
+            print('Error handling request from %s:' % (self.client_address,),
+                  file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            self.loop.call_soon_threadsafe(self.request_done)
+
+    def request_done(self):
+        handler, self.handler = self.handler, None
+        self.requests += 1
+        if self.closed:
+            return
+        wsgi_input = getattr(handler, 'wsgi_environ', {}).get('wsgi.input')
+        if ((isinstance(wsgi_input, LimitedLengthFile)
+             and wsgi_input._consumed < wsgi_input.length)
+            or (isinstance(wsgi_input, ChunkedInputFile)
+                and not wsgi_input._eof)):
+            # The rest of the body would be taken for the next request
+            handler.close_connection = 1
+        if handler.close_connection or self.draining:
+            self.close()
+            return
+        self.resume_reading()
+        self.next_request()
+        if self.handler is None and not self.closed:
+            self.set_idle_timer()
+
+
+class AsyncioWSGIServer(ThreadPoolMixIn):
+    """
+    A WSGI server handling connections on an ``asyncio`` event loop,
+    and running requests in a ``ThreadPool`` (see the module
+    docstring).  It takes the same arguments as
+    ``WSGIThreadPoolServer``, except that ``ssl_context`` is an
+    ``ssl.SSLContext``, and ``park_connections`` is ignored (idle
+    connections are always watched by the event loop).
+    Idle connections are closed after ``keepalive_timeout`` (or else
+    ``wsgi_socket_timeout``) seconds, connections that take more than
+    ``header_timeout`` seconds to send a request head too, and
+    ``drain`` works as for ``ThreadPoolMixIn``.
+
+    Each connection buffers up to ``input_buffer_size`` bytes of input
+    before it stops reading from the client, and up to
+    ``write_buffer_size`` bytes of output before a worker writing to
+    it has to wait.
+    """
+
+    wsgi_multiprocess = False
+    wsgi_metrics = None
+    wsgi_unix_socket = None
+    wsgi_socket_timeout = None
+    wsgi_min_upload_rate = None
+    input_buffer_size = 256 * 1024
+    write_buffer_size = 1024 * 1024
+
+    def __init__(self, wsgi_application, server_address,
+                 RequestHandlerClass=None, ssl_context=None,
+                 nworkers=10, daemon_threads=False,
+                 threadpool_options=None, request_queue_size=None,
+                 park_connections=True, keepalive_timeout=None,
+                 listen_socket=None, max_queue_size=None,
+                 max_queue_wait=None, header_timeout=None,
+                 max_request_age=None):
+        self.wsgi_application = wsgi_application
+        self.RequestHandlerClass = RequestHandlerClass or WSGIHandler
+        self.ssl_context = ssl_context
+        self.wsgi_timeouts = collections.Counter()
+        if listen_socket is None:
+            listen_socket = _bind_socket(server_address, request_queue_size)
+        self.socket = listen_socket
+        self.server_address = listen_socket.getsockname()
+        _name_server(self)
+        if threadpool_options is None:
+            threadpool_options = {}
+        ThreadPoolMixIn.__init__(self, nworkers, daemon_threads,
+                                 park_connections=False,
+                                 keepalive_timeout=keepalive_timeout,
+                                 max_queue_size=max_queue_size,
+                                 max_queue_wait=max_queue_wait,
+                                 header_timeout=header_timeout,
+                                 max_request_age=max_request_age,
+                                 **threadpool_options)
+        self.connections = set()
+        self.loop_thread_id = None
+        self.loop = asyncio.new_event_loop()
+        self._stopped = self.loop.create_future()
+        self._draining = False
+        self.aio_server = self.loop.run_until_complete(
+            self.loop.create_server(
+                lambda: _HTTPProtocol(self), sock=listen_socket,
+                ssl=ssl_context,
+                backlog=request_queue_size or _default_backlog()))
+
+    def serve_forever(self):
+        """
+        Runs the event loop until the server is drained (or
+        interrupted)
+        """
+        self.running = True
+        self.loop_thread_id = _thread.get_ident()
+        self._tick()
+        try:
+            self.loop.run_until_complete(self._stopped)
+        finally:
+            self.loop_thread_id = None
+            for protocol in list(self.connections):
+                protocol.close()
+            self.thread_pool.shutdown(
+                self.drained_cleanly is False and 1 or 0)
+
+    def _tick(self):
+        if self._stopped.done():
+            return
+        server_exit = self.thread_pool.server_exit
+        if server_exit is not None:
+            self._stopped.set_exception(server_exit)
+            return
+        _restart_if_requested(self)
+        if not self.running:
+            # Set from outside the loop (e.g., by a signal handler)
+            self.finish_requests()
+        self.loop.call_later(1, self._tick)
+
+    def drain(self, timeout=None):
+        """
+        Stops ``serve_forever`` gracefully; this can be called from any
+        thread (or a signal handler).
+        """
+        if timeout is not None:
+            self.stop_timeout = timeout
+        self.running = False
+        self.loop.call_soon_threadsafe(self.finish_requests)
+
+    def finish_requests(self):
+        """
+        Stops listening, closes idle connections, and waits (without
+        blocking the event loop) up to ``stop_timeout`` seconds for
+        the requests that have been accepted to finish
+        """
+        if self._draining:
+            return
+        self._draining = True
+        self.running = False
+        self.aio_server.close()
+        _remove_unix_socket(self)
+        for protocol in list(self.connections):
+            protocol.drain()
+        self._check_drained(time.time() + self.stop_timeout)
+
+    def _check_drained(self, deadline):
+        pool = self.thread_pool
+        if (not self.connections and pool.queue.empty()
+            and not pool.busy_count):
+            self.drained_cleanly = True
+        elif time.time() > deadline:
+            self.report_unfinished()
+            self.drained_cleanly = False
+        else:
+            self.loop.call_later(0.05, self._check_drained, deadline)
+            return
+        if not self._stopped.done():
+            self._stopped.set_result(None)
+
+    def server_close(self):
+        """
+        Stops the server right away, closing all connections
+        """
+        if self.loop_thread_id is not None:
+            # serve_forever is running in another thread
+            self.loop.call_soon_threadsafe(self._stop)
+            return
+        self._stop()
+        self.thread_pool.shutdown()
+        self.loop.run_until_complete(self.aio_server.wait_closed())
+        self.loop.close()
+
+    def _stop(self):
+        self.running = False
+        self.aio_server.close()
+        _remove_unix_socket(self)
+        for protocol in list(self.connections):
+            protocol.close()
+        if not self._stopped.done():
+            self._stopped.set_result(None)
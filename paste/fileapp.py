@@ -10,13 +10,24 @@ if-modified-since request header.
 """
 
 import os, time, mimetypes, zipfile, tarfile
+import binascii
+import collections
+import mmap
+import threading
+from stat import S_ISREG
 from paste.httpexceptions import *
 from paste.httpheaders import *
 
 CACHE_SIZE = 4096
 BLOCK_SIZE = 4096 * 16
+# The size of the pieces of a mapped file that are sent at a time
+MMAP_BLOCK_SIZE = 1024 * 1024
+# The content-codings of precompressed files, in order of preference,
+# and the suffixes of their filenames
+PRECOMPRESSED = (('br', '.br'), ('zstd', '.zst'), ('gzip', '.gz'))
 
-__all__ = ['DataApp', 'FileApp', 'DirectoryApp', 'ArchiveStore']
+__all__ = ['DataApp', 'FileApp', 'DirectoryApp', 'ArchiveStore',
+           'FileCache', 'ContentCache']
 
 class DataApp(object):
     """
@@ -55,6 +66,8 @@ class DataApp(object):
     """
 
     allowed_methods = ('GET', 'HEAD')
+    # Requests for more ranges than this get the whole content instead
+    max_ranges = 100
 
     def __init__(self, content, headers=None, allowed_methods=None,
                  **kwargs):
@@ -144,22 +157,38 @@ class DataApp(object):
                 return exce.wsgi_application(environ, start_response)
 
         (lower, upper) = (0, self.content_length - 1)
-        range = RANGE.parse(environ)
-        if range and 'bytes' == range[0] and 1 == len(range[1]):
-            (lower, upper) = range[1][0]
-            upper = upper or (self.content_length - 1)
-            if upper >= self.content_length or lower > upper:
+        ranges = None
+        if RANGE(environ):
+            ranges = _byte_ranges(RANGE(environ), self.content_length,
+                                  self.max_ranges)
+            if ranges == []:
                 return HTTPRequestRangeNotSatisfiable((
                   "Range request was made beyond the end of the content,\r\n"
                   "which is %s long.\r\n  Range: %s\r\n") % (
-                     self.content_length, RANGE(environ))
+                     self.content_length, RANGE(environ)),
+                  headers=[('Content-Range',
+                            'bytes */%d' % self.content_length)]
                 ).wsgi_application(environ, start_response)
+        if ranges and len(ranges) > 1:
+            byteranges = _ByteRanges(ranges, CONTENT_TYPE(headers),
+                                     self.content_length)
+            CONTENT_RANGE.delete(headers)
+            CONTENT_TYPE.update(headers, byteranges.content_type)
+            CONTENT_LENGTH.update(headers, byteranges.content_length)
+            start_response('206 Partial Content', headers)
+            if self.content is not None:
+                content = self.content
+                return list(byteranges.body(
+                    lambda lower, size: [content[lower:lower + size]]))
+            return byteranges
+        if ranges:
+            (lower, upper) = ranges[0]
 
         content_length = upper - lower + 1
         CONTENT_RANGE.update(headers, first_byte=lower, last_byte=upper,
                             total_length = self.content_length)
         CONTENT_LENGTH.update(headers, content_length)
-        if range or content_length != self.content_length:
+        if ranges:
             start_response('206 Partial Content', headers)
         else:
             start_response('200 OK', headers)
@@ -167,15 +196,179 @@ class DataApp(object):
             return [self.content[lower:upper+1]]
         return (lower, content_length)
 
+def _byte_ranges(value, length, max_ranges=None):
+    """
+    Returns the ranges of the content (of ``length`` bytes) that the
+    Range header ``value`` asks for, as (first, last) byte positions,
+    in order and with overlapping or adjacent ranges merged; or an
+    empty list if none of them can be satisfied.  Returns None if the
+    header is to be ignored: if it is malformed (including a range
+    that ends before it starts), isn't for bytes, or has more than
+    ``max_ranges`` ranges.
+
+    Only a range that starts past the content can't be satisfied; one
+    that ends past it, or a suffix range (``-500``, the last 500
+    bytes) longer than it, is cut to the length of the content (RFC
+    7233, section 2.1).
+    """
+    if '=' not in value:
+        return None
+    (units, spec) = value.split('=', 1)
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    count = 0
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        count += 1
+        if item.count('-') != 1:
+            return None
+        (first, last) = [part.strip() for part in item.split('-')]
+        if not first:
+            if not last.isdigit():
+                return None
+            suffix = int(last)
+            if suffix and length:
+                ranges.append((max(length - suffix, 0), length - 1))
+            continue
+        if not first.isdigit() or (last and not last.isdigit()):
+            return None
+        first = int(first)
+        last = int(last) if last else None
+        if last is not None and last < first:
+            return None
+        if first >= length:
+            # A start past the end of the content
+            continue
+        if last is None or last >= length:
+            last = length - 1
+        ranges.append((first, last))
+    if max_ranges and count > max_ranges:
+        return None
+    ranges.sort()
+    merged = []
+    for (first, last) in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    return merged
+
+class _ByteRanges(object):
+    """
+    The body of a multipart/byteranges response: the (first, last)
+    ``ranges`` of the content, each with a part header giving its
+    Content-Range (and ``content_type``)
+    """
+
+    def __init__(self, ranges, content_type, total_length):
+        boundary = binascii.hexlify(os.urandom(12)).decode('ascii')
+        self.content_type = 'multipart/byteranges; boundary=%s' % boundary
+        self.parts = []
+        for (first, last) in ranges:
+            head = '\r\n--%s\r\n' % boundary
+            if content_type:
+                head += 'Content-Type: %s\r\n' % content_type
+            head += 'Content-Range: bytes %d-%d/%d\r\n\r\n' % (
+                first, last, total_length)
+            self.parts.append(
+                (head.encode('latin-1'), first, last - first + 1))
+        self.tail = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+        self.content_length = len(self.tail) + sum(
+            len(head) + size for (head, first, size) in self.parts)
+
+    def body(self, read, close=None):
+        """
+        Returns the body, with the content of each part taken from
+        ``read(first, size)`` (an iterable) as it is sent; ``close`` is
+        called when the response is closed.
+        """
+        return _ByteRangesIter(self._chunks(read), close)
+
+    def _chunks(self, read):
+        for (head, first, size) in self.parts:
+            yield head
+            for chunk in read(first, size):
+                yield chunk
+        yield self.tail
+
+class _ByteRangesIter(object):
+
+    def __init__(self, chunks, close=None):
+        self.chunks = chunks
+        self._close = close
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.chunks)
+    __next__ = next
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
 class FileApp(DataApp):
     """
     Returns an application that will send the file at the given
     filename.  Adds a mime type based on ``mimetypes.guess_type()``.
-    See DataApp for the arguments beyond ``filename``.
+    See DataApp for the arguments beyond ``filename``,
+    ``file_cache``, an optional FileCache to look up and open the file
+    with, and ``content_cache``, an optional ContentCache to keep the
+    file's content in (files under ``CACHE_SIZE`` bytes are always
+    kept in memory).
+
+    With ``use_mmap``, files that are not cached otherwise are sent from
+    a read-only ``mmap`` of the file, which is shared by all the
+    requests for the file (see ``FileCache.map``), instead of being
+    read for each request.  Where the server sends files with
+    ``sendfile`` (as paste.httpserver does on plain sockets, which it
+    declares with ``paste.httpserver.sendfile`` in the environment),
+    its ``wsgi.file_wrapper`` is given the file instead.  A mapped file
+    must be replaced (e.g., by renaming a new file over it) rather
+    than rewritten in place: the file's size is checked before each
+    block is sent, but a file that shrinks while a block is being sent
+    crashes the process (SIGBUS).
+
+    With ``buffers``, ranges of cached content and pieces of mapped
+    files are sent as memoryviews of them instead of copies, to servers
+    that declare ``paste.httpserver.accepts_buffers`` in the environ.
+    PEP 3333 only allows bytes in a response body, so only use this
+    when no middleware between the server and the FileApp looks at the
+    body.
+
+    With ``precompressed``, a compressed copy of the file made ahead of
+    time (``app.js.br``, ``app.js.zst`` or ``app.js.gz`` next to
+    ``app.js``) is sent instead of the file to clients that accept its
+    content-coding, preferring the one with the highest "q" value in
+    their ``Accept-Encoding`` (and then the order of
+    ``PRECOMPRESSED``).  ``precompressed`` can also be a list of the
+    content-codings to look for.  Copies older than the file are
+    ignored.  Which copies exist is looked up through ``file_cache``
+    (or a process-wide FileCache), so it costs no ``stat`` on most
+    requests.
     """
 
-    def __init__(self, filename, headers=None, **kwargs):
+    def __init__(self, filename, headers=None, file_cache=None,
+                 content_cache=None, use_mmap=False, precompressed=False,
+                 buffers=False, **kwargs):
         self.filename = filename
+        self.file_cache = file_cache
+        self.content_cache = content_cache
+        self.use_mmap = use_mmap
+        self.buffers = buffers
+        if precompressed is True:
+            precompressed = [encoding for (encoding, suffix) in PRECOMPRESSED]
+        self.precompressed = precompressed or []
+        for encoding in self.precompressed:
+            assert encoding in dict(PRECOMPRESSED), (
+                "Unknown content-coding for precompressed files: %r"
+                % encoding)
+        # The FileApps sending the precompressed copies, by encoding
+        self._encoded_apps = {}
         content_type, content_encoding = self.guess_type()
         if content_type and 'content_type' not in kwargs:
             kwargs['content_type'] = content_type
@@ -187,12 +380,17 @@ class FileApp(DataApp):
         return mimetypes.guess_type(self.filename)
 
     def update(self, force=False):
-        stat = os.stat(self.filename)
+        if self.file_cache is None:
+            stat = os.stat(self.filename)
+        else:
+            if force:
+                self.file_cache.invalidate(self.filename)
+            stat = self.file_cache.stat(self.filename)
         if not force and stat.st_mtime == self.last_modified:
             return
         self.last_modified = stat.st_mtime
         if stat.st_size < CACHE_SIZE:
-            fh = open(self.filename,"rb")
+            fh = self.open()
             self.set_content(fh.read(), stat.st_mtime)
             fh.close()
         else:
@@ -208,14 +406,31 @@ class FileApp(DataApp):
             self.update(force=True) # RFC 2616 13.2.6
         else:
             self.update()
+        if self.precompressed and not CONTENT_ENCODING(self.headers):
+            encoded = self.encoded_apps()
+            if encoded:
+                encoding = _choose_encoding(
+                    ACCEPT_ENCODING.parse(environ),
+                    [encoding for (encoding, app) in encoded])
+                for (app_encoding, app) in encoded:
+                    if app_encoding == encoding:
+                        return app.get(environ, start_response)
+        file = content = mapping = None
         if not self.content:
-            if not os.path.exists(self.filename):
+            if (self.file_cache is None
+                and not os.path.exists(self.filename)):
                 exc = HTTPNotFound(
                     'The resource does not exist',
                     comment="No file at %r" % self.filename)
                 return exc(environ, start_response)
             try:
-                file = open(self.filename, 'rb')
+                if self.content_cache is not None:
+                    content = self.cached_content()
+                if (content is None and self.use_mmap
+                    and not environ.get('paste.httpserver.sendfile')):
+                    mapping = self.map()
+                if content is None and mapping is None:
+                    file = self.open()
             except (IOError, OSError) as e:
                 exc = HTTPForbidden(
                     'You are not permitted to view this file (%s)' % e)
@@ -224,12 +439,43 @@ class FileApp(DataApp):
         retval = DataApp.get(self, environ, start_response)
         if isinstance(retval, list):
             # cached content, exception, or not-modified
+            if file is not None:
+                file.close()
             if is_head:
                 return [b'']
             return retval
-        (lower, content_length) = retval
         if is_head:
+            if file is not None:
+                file.close()
             return [b'']
+        buffers = (self.buffers
+                   and environ.get('paste.httpserver.accepts_buffers'))
+        if isinstance(retval, _ByteRanges):
+            # multipart/byteranges, with each part read from where the
+            # content is
+            if content is not None:
+                if buffers:
+                    content = memoryview(content)
+                return retval.body(
+                    lambda lower, size: [content[lower:lower + size]])
+            if mapping is not None:
+                return retval.body(
+                    lambda lower, size: _MappingIter(
+                        mapping, lower, size, buffers))
+            def read(lower, size):
+                file.seek(lower)
+                return _FileIter(file, size=size)
+            return retval.body(read, file.close)
+        (lower, content_length) = retval
+        if content is not None:
+            if content_length == len(content):
+                return [content]
+            if buffers:
+                # A range of the content, without copying it
+                return [memoryview(content)[lower:lower + content_length]]
+            return [content[lower:lower + content_length]]
+        if mapping is not None:
+            return _MappingIter(mapping, lower, content_length, buffers)
         file.seek(lower)
         file_wrapper = environ.get('wsgi.file_wrapper', None)
         if file_wrapper:
@@ -237,6 +483,147 @@ class FileApp(DataApp):
         else:
             return _FileIter(file, size=content_length)
 
+    def encoded_apps(self):
+        """
+        Returns the precompressed copies of the file that can be sent,
+        as (content-coding, FileApp) pairs.  Once there are any,
+        ``Vary: Accept-Encoding`` is added to the headers.
+        """
+        file_cache = self.file_cache
+        if file_cache is None:
+            file_cache = _precompressed_file_cache
+        suffixes = dict(PRECOMPRESSED)
+        encoded = []
+        for encoding in self.precompressed:
+            filename = self.filename + suffixes[encoding]
+            try:
+                stat = file_cache.stat(filename)
+            except OSError:
+                continue
+            if (not S_ISREG(stat.st_mode)
+                or stat.st_mtime < self.last_modified):
+                # Not a copy of this version of the file
+                continue
+            app = self._encoded_apps.get(encoding)
+            if app is None:
+                app = self.make_encoded_app(filename, encoding)
+                self._encoded_apps[encoding] = app
+            encoded.append((encoding, app))
+        vary = VARY(self.headers)
+        if encoded and 'accept-encoding' not in vary.lower():
+            VARY.update(self.headers,
+                        *[v for v in (vary, 'Accept-Encoding') if v])
+        return encoded
+
+    def make_encoded_app(self, filename, encoding):
+        """
+        Returns a FileApp sending ``filename``, this file compressed
+        with the content-coding ``encoding``
+        """
+        headers = [(name, value) for (name, value) in self.headers
+                   if name.lower() not in ('content-type', 'content-encoding',
+                                           'content-length', 'last-modified',
+                                           'vary')]
+        app = _EncodedFileApp(
+            filename, headers, file_cache=self.file_cache,
+            content_cache=self.content_cache, use_mmap=self.use_mmap,
+            buffers=self.buffers, content_type=CONTENT_TYPE(self.headers),
+            content_encoding=encoding, vary='Accept-Encoding')
+        app.expires = self.expires
+        return app
+
+    def open(self):
+        """
+        Returns the file, opened for reading (through the
+        ``file_cache``, if there is one)
+        """
+        if self.file_cache is None:
+            return open(self.filename, 'rb')
+        return self.file_cache.open(self.filename)
+
+    def cached_content(self):
+        """
+        Returns the file's content from the ``content_cache`` (reading
+        it into the cache if it isn't there yet), or None if the file
+        is too big to cache.
+        """
+        version = (self.last_modified, self.content_length)
+        content = self.content_cache.get(self.filename, version)
+        if (content is None
+            and self.content_length <= self.content_cache.max_file_size):
+            fh = self.open()
+            try:
+                content = fh.read()
+            finally:
+                fh.close()
+            if len(content) != self.content_length:
+                # Changed since it was looked at
+                return None
+            self.content_cache.put(self.filename, version, content)
+        return content
+
+    def map(self):
+        """
+        Returns the shared ``mmap`` of the file (from the
+        ``file_cache``, or a process-wide FileCache), or None if that
+        doesn't match the size the file was found to have
+        """
+        file_cache = self.file_cache
+        if file_cache is None:
+            file_cache = _mmap_file_cache
+        try:
+            mapping = file_cache.map(self.filename)
+            if len(mapping) != self.content_length:
+                # The cache hasn't noticed a change yet
+                file_cache.invalidate(self.filename)
+                mapping = file_cache.map(self.filename)
+        except ValueError:
+            # An empty file can't be mapped
+            return None
+        if len(mapping) != self.content_length:
+            return None
+        return mapping
+
+class _EncodedFileApp(FileApp):
+    """
+    Sends a precompressed copy of a file for a FileApp, with an ETag
+    of its own
+    """
+
+    def calculate_etag(self):
+        return '"%s-%s-%s"' % (self.last_modified, self.content_length,
+                               CONTENT_ENCODING(self.headers))
+
+def _choose_encoding(accept_encoding, encodings):
+    """
+    Returns which of ``encodings`` (content-codings, in order of
+    preference) to send to a client with the given ``Accept-Encoding``
+    values, or None to send the content as it is
+    """
+    qs = {}
+    for value in accept_encoding:
+        pieces = value.split(';')
+        coding = pieces[0].strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        q = 1.0
+        for param in pieces[1:]:
+            (name, sep, number) = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        qs[coding] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = qs.get(encoding, qs.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    if qs.get('identity', 0.0) > best_q:
+        return None
+    return best
+
 class _FileIter(object):
 
     def __init__(self, file, block_size=None, size=None):
@@ -262,31 +649,383 @@ class _FileIter(object):
     def close(self):
         self.file.close()
 
+class _MappingIter(object):
+    """
+    Iterates over the pieces of ``mapping`` from ``start``, up to
+    ``size`` bytes, as memoryviews if ``buffers`` is true (and bytes
+    otherwise).  Raises IOError instead of reading past the end of a
+    file that has been truncated in place.
+    """
+
+    def __init__(self, mapping, start, size, buffers=False):
+        self.mmap = mapping
+        if buffers:
+            try:
+                mapping = memoryview(mapping)
+            except TypeError:
+                # Python 2 can't make one of an mmap
+                pass
+        self.mapping = mapping
+        self.pos = start
+        self.end = start + size
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.pos >= self.end:
+            raise StopIteration
+        end = min(self.pos + MMAP_BLOCK_SIZE, self.end)
+        # The size of the mapped file (mmap keeps a descriptor of its
+        # own), since touching pages past its end raises SIGBUS
+        if self.mmap.size() < end:
+            raise IOError('File shrank while it was being sent')
+        data = self.mapping[self.pos:end]
+        self.pos = end
+        return data
+    __next__ = next
+
+
+class FileCache(object):
+    """
+    A thread-safe cache of ``os.stat`` results, and of descriptors open
+    on the files, to share between FileApps (and DirectoryApps and
+    StaticURLParsers), so a file that is served often doesn't cost a
+    ``stat`` and an ``open`` on every request.
+
+    Constructor Arguments:
+
+        ``max_entries`` the number of files to remember; the least
+                        recently used one is forgotten first
+
+        ``ttl``         how many seconds the file is trusted not to have
+                        changed; after that it is looked at again, and
+                        opened anew if its modification time, size or
+                        inode has changed
+
+    Files that don't exist are remembered for ``ttl`` seconds too.
+    Descriptors are only shared where there is ``os.pread`` (to read
+    from them at each request's own position); otherwise each request
+    opens the file.  ``map`` shares a memory mapping of the file in the
+    same way.
+    """
+
+    def __init__(self, max_entries=1024, ttl=1):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict()
+
+    def stat(self, filename):
+        """
+        Returns ``os.stat(filename)``, or raises the OSError it raises
+        """
+        entry = self._lookup(filename)
+        if entry.error is not None:
+            raise OSError(entry.error.errno, entry.error.strerror, filename)
+        return entry.stat
+
+    def isfile(self, filename):
+        """
+        Like ``os.path.isfile``
+        """
+        try:
+            return S_ISREG(self.stat(filename).st_mode)
+        except OSError:
+            return False
+
+    def open(self, filename):
+        """
+        Returns a new file object for reading ``filename``
+        """
+        entry = self._lookup(filename)
+        if entry.error is not None:
+            raise IOError(entry.error.errno, entry.error.strerror, filename)
+        if not hasattr(os, 'pread') or not S_ISREG(entry.stat.st_mode):
+            file = open(filename, 'rb')
+            if not _same_file(os.fstat(file.fileno()), entry.stat):
+                # Changed since it was looked at
+                self.invalidate(filename)
+            return file
+        if entry.fd is None:
+            fd = os.open(filename, os.O_RDONLY)
+            if not _same_file(os.fstat(fd), entry.stat):
+                os.close(fd)
+                self.invalidate(filename)
+                return open(filename, 'rb')
+            with self.lock:
+                if entry.fd is None and not entry.dropped:
+                    entry.fd = fd
+                    fd = None
+            if fd is not None:
+                os.close(fd)
+        with self.lock:
+            if entry.fd is None:
+                # Dropped meanwhile
+                return open(filename, 'rb')
+            entry.refs += 1
+        return _SharedFile(self, entry)
+
+    def map(self, filename):
+        """
+        Returns a read-only ``mmap`` of ``filename``, shared by all the
+        callers until the file is found to have changed.  A new file
+        has to replace the mapped one (e.g., by being renamed over it),
+        since reading past the end of a file that shrank in place would
+        crash the process.  The mapping is unmapped once it is
+        forgotten and no longer used.
+        """
+        entry = self._lookup(filename)
+        if entry.error is not None:
+            raise IOError(entry.error.errno, entry.error.strerror, filename)
+        mapping = entry.mapping
+        if mapping is None:
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                same = _same_file(os.fstat(fd), entry.stat)
+            finally:
+                os.close(fd)
+            if not same:
+                # Changed since it was looked at
+                self.invalidate(filename)
+                return mapping
+            with self.lock:
+                if entry.mapping is None and not entry.dropped:
+                    entry.mapping = mapping
+        return mapping
+
+    def invalidate(self, filename=None):
+        """
+        Forgets about ``filename`` (or all files)
+        """
+        with self.lock:
+            if filename is None:
+                entries = list(self.entries.values())
+                self.entries.clear()
+            else:
+                entries = [self.entries.pop(filename, None)]
+            for entry in entries:
+                if entry is not None:
+                    self._drop(entry)
+
+    def _lookup(self, filename):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                # The most recently used one goes last
+                self.entries[filename] = entry
+                if now - entry.checked < self.ttl:
+                    return entry
+        try:
+            stat, error = os.stat(filename), None
+        except OSError as e:
+            stat, error = None, e
+        with self.lock:
+            if (entry is not None and stat is not None
+                and entry.stat is not None and _same_file(stat, entry.stat)):
+                entry.checked = now
+                return entry
+            new_entry = _FileCacheEntry(stat, error, now)
+            current = self.entries.pop(filename, None)
+            if current is not None:
+                self._drop(current)
+            self.entries[filename] = new_entry
+            while len(self.entries) > self.max_entries:
+                self._drop(self.entries.popitem(last=False)[1])
+            return new_entry
+
+    def _drop(self, entry):
+        entry.dropped = True
+        # Views of it that are still being sent keep it mapped
+        entry.mapping = None
+        if not entry.refs and entry.fd is not None:
+            os.close(entry.fd)
+            entry.fd = None
+
+    def _release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            if entry.dropped:
+                self._drop(entry)
+
+def _same_file(stat, other):
+    return ((stat.st_ino, stat.st_dev, stat.st_size, stat.st_mtime)
+            == (other.st_ino, other.st_dev, other.st_size, other.st_mtime))
+
+class _FileCacheEntry(object):
+
+    def __init__(self, stat, error, checked):
+        self.stat = stat
+        self.error = error
+        self.checked = checked
+        self.fd = None
+        self.mapping = None
+        self.refs = 0
+        self.dropped = False
+
+class _SharedFile(object):
+    """
+    A read-only file object with its own position on a descriptor
+    shared through a FileCache
+    """
+
+    mode = 'rb'
+
+    def __init__(self, cache, entry):
+        self._cache = cache
+        self._entry = entry
+        self._fd = entry.fd
+        self._pos = 0
+        self.closed = False
+
+    def fileno(self):
+        return self._fd
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += os.fstat(self._fd).st_size
+        self._pos = offset
+        return offset
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(os.fstat(self._fd).st_size - self._pos, 0)
+        data = os.pread(self._fd, size, self._pos)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._cache._release(self._entry)
+
+    __del__ = close
+
+# Shares the mappings of FileApps without a file_cache
+_mmap_file_cache = FileCache()
+# Remembers which precompressed copies of files exist, for FileApps
+# without a file_cache
+_precompressed_file_cache = FileCache(ttl=5)
+
+
+class ContentCache(object):
+    """
+    A thread-safe in-memory cache of file contents, within a budget of
+    ``max_bytes`` in all, for FileApps (and DirectoryApps and
+    StaticURLParsers) to serve the files that are requested most often
+    without reading them from disk.  One instance is meant to be shared
+    by all the applications in the process.
+
+    Constructor Arguments:
+
+        ``max_bytes``       the total size of the contents kept; the
+                            least recently used ones are dropped first
+
+        ``max_file_size``   files bigger than this are not kept
+
+    ``hits`` and ``misses`` count the lookups.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024,
+                 max_file_size=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.lock = threading.Lock()
+        # Maps filenames to (version, content), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, version):
+        """
+        Returns the content kept for ``filename``, if it is of this
+        ``version`` (e.g., the modification time and size), or None
+        """
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                if entry[0] == version:
+                    self.entries[filename] = entry
+                    self.hits += 1
+                    return entry[1]
+                self.size -= len(entry[1])
+            self.misses += 1
+        return None
+
+    def put(self, filename, version, content):
+        """
+        Keeps the ``content`` of this ``version`` of ``filename``, if
+        it isn't too big
+        """
+        if len(content) > self.max_file_size:
+            return
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+            self.entries[filename] = (version, content)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                version, old = self.entries.popitem(last=False)[1]
+                self.size -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
 
 class DirectoryApp(object):
     """
     Returns an application that dispatches requests to corresponding FileApps based on PATH_INFO.
     FileApp instances are cached. This app makes sure not to serve any files that are not in a subdirectory.
     To customize FileApp creation override ``DirectoryApp.make_fileapp``
+    The FileApps share ``file_cache`` (a FileCache) and
+    ``content_cache`` (a ContentCache), if they are given, map the
+    files with ``use_mmap``, send precompressed copies of them with
+    ``precompressed``, and send memoryviews with ``buffers`` (see
+    FileApp).
     """
 
-    def __init__(self, path):
+    def __init__(self, path, file_cache=None, content_cache=None,
+                 use_mmap=False, precompressed=False, buffers=False):
         self.path = os.path.abspath(path)
         if not self.path.endswith(os.path.sep):
             self.path += os.path.sep
         assert os.path.isdir(self.path)
         self.cached_apps = {}
+        self.file_cache = file_cache
+        self.content_cache = content_cache
+        self.use_mmap = use_mmap
+        self.precompressed = precompressed
+        self.buffers = buffers
 
-    make_fileapp = FileApp
+    def make_fileapp(self, path):
+        return FileApp(path, file_cache=self.file_cache,
+                       content_cache=self.content_cache,
+                       use_mmap=self.use_mmap,
+                       precompressed=self.precompressed,
+                       buffers=self.buffers)
 
     def __call__(self, environ, start_response):
         path_info = environ['PATH_INFO']
         app = self.cached_apps.get(path_info)
         if app is None:
             path = os.path.join(self.path, path_info.lstrip('/'))
+            isfile = os.path.isfile
+            if self.file_cache is not None:
+                isfile = self.file_cache.isfile
             if not os.path.normpath(path).startswith(self.path):
                 app = HTTPForbidden()
-            elif os.path.isfile(path):
+            elif isfile(path):
                 app = self.make_fileapp(path)
                 self.cached_apps[path_info] = app
             else:
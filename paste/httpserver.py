@@ -8,21 +8,26 @@
 WSGI HTTP Server
 
 This is a minimalistic WSGI server using Python's built-in BaseHTTPServer;
-if pyOpenSSL is installed, it also provides SSL capabilities.
+it provides SSL capabilities with the standard ``ssl`` module (or with
+pyOpenSSL, if it is installed and given an ``OpenSSL.SSL.Context``).
 """
 
 # @@: add in protection against HTTP/1.0 clients who claim to
 #     be 1.1 but do not send a Content-Length
 
-# @@: add support for chunked encoding, this is not a 1.1 server
-#     till this is completed.
-
 from __future__ import print_function
 import atexit
+import bisect
 import traceback
 import socket, sys, threading
+import collections
+import errno
+import io
 import posixpath
+import re
+import signal
 import six
+from stat import S_ISREG, S_ISSOCK
 import time
 import os
 from itertools import count
@@ -38,10 +43,48 @@ try:
 except ImportError:
     # Not available, probably no ctypes
     killthread = None
+try:
+    import ssl
+except ImportError:
+    # Python built without OpenSSL
+    ssl = None
+try:
+    import selectors
+except ImportError:
+    # Not available before Python 3.4; idle keep-alive connections
+    # then simply stay with their worker thread
+    selectors = None
+
+# The most buffers that can be passed to one sendmsg() call
+try:
+    _IOV_MAX = max(os.sysconf('SC_IOV_MAX'), 16)
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
 
 __all__ = ['WSGIHandlerMixin', 'WSGIServer', 'WSGIHandler', 'serve']
 __version__ = "0.5"
 
+# Guards the wsgi_timeouts counters of servers
+_timeouts_lock = threading.Lock()
+
+# A field name (an RFC 7230 token), and the characters that can't be in
+# a field value
+_field_name = re.compile(r"^[!#$%&'*+\-.^_`|~0-9A-Za-z]+$")
+_bad_field_value = re.compile(r'[\r\n\0]')
+_content_length = re.compile(r'^[0-9]+$')
+
+# Fields that must not be sent in a trailer (RFC 7230, section 4.1.2):
+# framing, routing, request modifiers, authentication, response
+# control and content processing
+_forbidden_trailers = frozenset([
+    'transfer-encoding', 'content-length', 'trailer', 'host',
+    'cache-control', 'expect', 'max-forwards', 'pragma', 'range', 'te',
+    'authorization', 'proxy-authenticate', 'proxy-authorization',
+    'www-authenticate', 'set-cookie', 'age', 'date', 'expires',
+    'location', 'retry-after', 'vary', 'warning', 'content-encoding',
+    'content-type', 'content-range', 'connection', 'keep-alive',
+    'upgrade'])
+
 
 def _get_headers(headers, k):
     """
@@ -55,6 +98,95 @@ def _get_headers(headers, k):
         return headers.getheaders(k)  # Python 2 - mimetools.Message
 
 
+def _is_chunked(transfer_encoding):
+    """
+    Tells whether a request with this Transfer-Encoding header (or
+    ``None``) has a chunked body.
+    """
+    if not transfer_encoding:
+        return False
+    return transfer_encoding.rsplit(',', 1)[-1].strip().lower() == 'chunked'
+
+
+def _split_host(host, default_port='80'):
+    """
+    Splits the value of a Host header into a name and a port
+    """
+    name, sep, port = host.rpartition(':')
+    if not sep or ']' in port:
+        # No port, or a bare IPv6 literal
+        return host, default_port
+    return name, port or default_port
+
+def _normalize_path(path):
+    """
+    Removes ``.`` and ``..`` segments and repeated slashes from the
+    (unquoted) request path, keeping any trailing slash
+    """
+    if path.startswith('/') and '/.' not in path and '//' not in path:
+        # Already normal
+        return path
+    endslash = path.endswith('/')
+    path = posixpath.normpath(path)
+    if endslash and path != '/':
+        # Put the slash back...
+        path += '/'
+    return path
+
+if six.PY3:
+    def _native(data):
+        return data.decode('latin-1')
+else:
+    def _native(data):
+        return data
+
+class _RequestHeaders(object):
+    """
+    The header fields of a request parsed by WSGIHandler, as a list of
+    ``(name, value)`` pairs; lookups are case-insensitive, with
+    methods like those of ``email.message.Message`` (which Python 3's
+    BaseHTTPRequestHandler uses)
+    """
+
+    def __init__(self, headers):
+        self._headers = headers
+
+    def get_all(self, name, failobj=None):
+        name = name.lower()
+        values = [v for (k, v) in self._headers if k.lower() == name]
+        return values or failobj
+
+    def getheaders(self, name):
+        return self.get_all(name, [])
+
+    def get(self, name, failobj=None):
+        name = name.lower()
+        for (k, v) in self._headers:
+            if k.lower() == name:
+                return v
+        return failobj
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def keys(self):
+        return [k for (k, v) in self._headers]
+
+    def values(self):
+        return [v for (k, v) in self._headers]
+
+    def items(self):
+        return list(self._headers)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._headers)
+
 class ContinueHook(object):
     """
     When a client request includes a 'Expect: 100-continue' header, then
@@ -76,14 +208,14 @@ class ContinueHook(object):
                      'mode', 'bufsize', 'softspace'):
             if hasattr(rfile, attr):
                 setattr(self, attr, getattr(rfile, attr))
-        for attr in ('read', 'readline', 'readlines'):
+        for attr in ('read', 'readline', 'readlines', 'readinto'):
             if hasattr(rfile, attr):
                 setattr(self, attr, getattr(self, '_ContinueFile_' + attr))
 
     def _ContinueFile_send(self):
-        self._ContinueFile_write("HTTP/1.1 100 Continue\r\n\r\n")
+        self._ContinueFile_write(b"HTTP/1.1 100 Continue\r\n\r\n")
         rfile = self._ContinueFile_rfile
-        for attr in ('read', 'readline', 'readlines'):
+        for attr in ('read', 'readline', 'readlines', 'readinto'):
             if hasattr(rfile, attr):
                 setattr(self, attr, getattr(rfile, attr))
 
@@ -99,6 +231,36 @@ class ContinueHook(object):
         self._ContinueFile_send()
         return self._ContinueFile_rfile.readlines(sizehint)
 
+    def _ContinueFile_readinto(self, b):
+        self._ContinueFile_send()
+        return self._ContinueFile_rfile.readinto(b)
+
+class FileWrapper(object):
+    """
+    The ``wsgi.file_wrapper`` provided by this server.
+
+    Iterating over it reads ``blksize`` blocks from the file, but when
+    an application returns one around a regular file,
+    WSGIHandlerMixin sends the file with ``socket.sendfile`` instead
+    (see ``wsgi_send_file``).
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if not data:
+            raise StopIteration
+        return data
+    __next__ = next
+
 class WSGIHandlerMixin:
     """
     WSGI mix-in for HTTPRequestHandler
@@ -108,6 +270,21 @@ class WSGIHandlerMixin:
     This assumes a ``wsgi_application`` handler on ``self.server``.
     """
     lookup_addresses = True
+    wsgi_head_environ = None
+    # Output to collect before sending, when the whole response body is
+    # available at once
+    wsgi_output_buffer_size = 65536
+    wsgi_collect_headers = False
+    # Request body left unread by the application that is read and
+    # thrown away to get to the next request on a keep-alive connection;
+    # if more is left, the connection is closed instead
+    wsgi_max_discard_size = 65536
+    # With the server's wsgi_min_upload_rate, the time (in seconds) a
+    # request body gets before it has to arrive at that rate
+    upload_grace_period = 5
+    # When the request was accepted, or queued for a worker (set by the
+    # server; the time the request line arrived if not)
+    wsgi_accepted_at = None
 
     def log_request(self, *args, **kwargs):
         """ disable success request logging
@@ -136,6 +313,10 @@ class WSGIHandlerMixin:
         """
         Write a chunk of the output stream; send headers if they
         have not already been sent.
+
+        Output is collected and sent with ``wsgi_flush``, so the header
+        block and the first chunk go out together.  Unless
+        ``wsgi_hold_output`` is set, the chunk is flushed right away.
         """
         if not self.wsgi_headers_sent and not self.wsgi_curr_headers:
             raise RuntimeError(
@@ -144,27 +325,119 @@ class WSGIHandlerMixin:
             self.wsgi_headers_sent = True
             (status, headers) = self.wsgi_curr_headers
             code, message = status.split(" ", 1)
-            self.send_response(int(code), message)
-            #
-            # HTTP/1.1 compliance; either send Content-Length or
-            # signal that the connection is being closed.
-            #
-            send_close = True
-            for (k, v) in  headers:
-                lk = k.lower()
-                if 'content-length' == lk:
-                    send_close = False
-                if 'connection' == lk:
-                    if 'close' == v.lower():
-                        self.close_connection = 1
+            self.wsgi_collect_headers = True
+            try:
+                self.send_response(int(code), message)
+                #
+                # HTTP/1.1 compliance; either send Content-Length, use
+                # chunked encoding, or signal that the connection is
+                # being closed.
+                #
+                send_close = True
+                for (k, v) in  headers:
+                    lk = k.lower()
+                    if 'content-length' == lk:
                         send_close = False
-                self.send_header(k, v)
-            if send_close:
-                self.close_connection = 1
-                self.send_header('Connection', 'close')
+                    if 'connection' == lk:
+                        if 'close' == v.lower():
+                            self.close_connection = 1
+                            send_close = False
+                    self.send_header(k, v)
+                if send_close and self.wsgi_can_chunk(int(code)):
+                    self.wsgi_chunked = True
+                    self.send_header('Transfer-Encoding', 'chunked')
+                elif send_close:
+                    self.close_connection = 1
+                    self.send_header('Connection', 'close')
+
+                self.end_headers()
+            finally:
+                self.wsgi_collect_headers = False
+        if self.wsgi_chunked:
+            if chunk:
+                self.wsgi_buffer(('%x\r\n' % len(chunk)).encode('ascii'))
+                self.wsgi_buffer(chunk)
+                self.wsgi_buffer(b'\r\n')
+        else:
+            self.wsgi_buffer(chunk)
+        if (not self.wsgi_hold_output
+            or self.wsgi_output_size >= self.wsgi_output_buffer_size):
+            self.wsgi_flush()
+
+    def flush_headers(self):
+        """
+        Python 3's BaseHTTPRequestHandler collects the header block and
+        writes it here; for WSGI responses it is kept to be sent along
+        with the body instead.
+        """
+        if not self.wsgi_collect_headers:
+            return BaseHTTPRequestHandler.flush_headers(self)
+        if getattr(self, '_headers_buffer', None):
+            self.wsgi_buffer(b''.join(self._headers_buffer))
+            self._headers_buffer = []
+
+    def wsgi_buffer(self, data):
+        """
+        Add ``data`` to the output that ``wsgi_flush`` will send.
+        """
+        if data:
+            self.wsgi_output.append(data)
+            self.wsgi_output_size += len(data)
 
-            self.end_headers()
-        self.wfile.write(chunk)
+    def wsgi_flush(self):
+        """
+        Send all the buffered output, using a single ``sendmsg`` call
+        (gathering the pieces without copying them) where possible.
+        """
+        output = self.wsgi_output
+        if not output:
+            return
+        self.wsgi_bytes_written += self.wsgi_output_size
+        self.wsgi_output = []
+        self.wsgi_output_size = 0
+        if len(output) > 1 and hasattr(self.connection, 'sendmsg'):
+            try:
+                _send_buffers(self.connection, output)
+                return
+            except NotImplementedError:
+                # e.g., SSL sockets
+                pass
+        self.wfile.write(b''.join(output))
+
+    def wsgi_can_chunk(self, code):
+        """
+        Returns true if a response with this status code and without a
+        Content-Length can be sent with chunked transfer-coding; this
+        needs both this server and the client to speak HTTP/1.1.
+        """
+        if (self.protocol_version < 'HTTP/1.1'
+            or self.request_version < 'HTTP/1.1'):
+            return False
+        if self.command == 'HEAD' or code < 200 or code in (204, 304):
+            # No body is sent for these anyway
+            return False
+        return True
+
+    def wsgi_write_trailer(self):
+        """
+        Finish a chunked response: write the last (empty) chunk, and
+        any trailer fields the application has added to the
+        ``paste.httpserver.trailers`` list in the environment.  Fields
+        that aren't valid, or that aren't allowed in a trailer (such as
+        Content-Length or Transfer-Encoding), are left out and logged.
+        """
+        if not self.wsgi_chunked:
+            return
+        trailer = ['0\r\n']
+        for (k, v) in self.wsgi_environ.get('paste.httpserver.trailers', ()):
+            k, v = str(k), str(v)
+            if (not _field_name.match(k) or _bad_field_value.search(v)
+                or k.lower() in _forbidden_trailers):
+                self.log_error('Trailer field not sent: %r', (k, v))
+                continue
+            trailer.append('%s: %s\r\n' % (k, v))
+        trailer.append('\r\n')
+        self.wsgi_buffer(''.join(trailer).encode('latin-1'))
 
     def wsgi_start_response(self, status, response_headers, exc_info=None):
         if exc_info:
@@ -193,58 +466,96 @@ class WSGIHandlerMixin:
         argument can be used to override any settings.
         """
 
-        dummy_url = 'http://dummy%s' % (self.path,)
-        (scheme, netloc, path, query, fragment) = urlsplit(dummy_url)
-        path = unquote(path)
-        endslash = path.endswith('/')
-        path = posixpath.normpath(path)
-        if endslash and path != '/':
-            # Put the slash back...
-            path += '/'
-        (server_name, server_port) = self.server.server_address[:2]
+        head = self.wsgi_head_environ
+        if head is None:
+            head = self.wsgi_head_from_headers()
+        server_address = self.server.server_address
+        if isinstance(server_address, tuple):
+            (server_name, server_port) = server_address[:2]
+            remote_address = self.client_address[0]
+        else:
+            # A Unix domain socket, typically behind a proxy on the same
+            # host: the name comes from the Host header, and the client
+            # is local
+            (server_name, server_port) = _split_host(
+                head.get('HTTP_HOST') or 'localhost')
+            remote_address = '127.0.0.1'
+        accepted_at = self.wsgi_accepted_at or time.time()
 
         rfile = self.rfile
-        # We can put in the protection to keep from over-reading the
-        # file
-        try:
-            content_length = int(self.headers.get('Content-Length', '0'))
-        except ValueError:
-            content_length = 0
-        if '100-continue' == self.headers.get('Expect','').lower():
-            rfile = LimitedLengthFile(ContinueHook(rfile, self.wfile.write), content_length)
+        chunked = _is_chunked(head.get('HTTP_TRANSFER_ENCODING'))
+        min_rate = getattr(self.server, 'wsgi_min_upload_rate', None)
+        if min_rate and (chunked or head.get('CONTENT_LENGTH', '0') != '0'):
+            connection = self.connection
+            if connection is None:
+                # e.g., the input stream of paste.asyncserver
+                connection = rfile
+            rfile = MinimumRateFile(
+                rfile, connection.settimeout, min_rate,
+                self.upload_grace_period,
+                timeout=getattr(self.server, 'wsgi_socket_timeout', None),
+                on_timeout=lambda: self.wsgi_timed_out('min_upload_rate'))
+        continue_hook = '100-continue' == head.get('HTTP_EXPECT', '').lower()
+        if continue_hook:
+            rfile = ContinueHook(rfile, self.wfile.write)
+        if chunked:
+            # The body ends where the last chunk says it does
+            rfile = ChunkedInputFile(rfile)
         else:
-            if not hasattr(self.connection, 'get_context'):
+            # We can put in the protection to keep from over-reading
+            # the file
+            try:
+                content_length = int(head.get('CONTENT_LENGTH', '0'))
+            except ValueError:
+                content_length = 0
+            if continue_hook or not hasattr(self.connection, 'get_context'):
                 # @@: LimitedLengthFile is currently broken in connection
-                # with SSL (sporatic errors that are diffcult to trace, but
+                # with pyOpenSSL (sporatic errors that are diffcult to trace, but
                 # ones that go away when you don't use LimitedLengthFile)
                 rfile = LimitedLengthFile(rfile, content_length)
 
-        remote_address = self.client_address[0]
         self.wsgi_environ = {
                 'wsgi.version': (1,0)
                ,'wsgi.url_scheme': 'http'
                ,'wsgi.input': rfile
                ,'wsgi.errors': sys.stderr
+               ,'wsgi.file_wrapper': FileWrapper
                ,'wsgi.multithread': True
-               ,'wsgi.multiprocess': False
+               ,'wsgi.multiprocess': getattr(self.server,
+                                             'wsgi_multiprocess', False)
                ,'wsgi.run_once': False
+               # Reading wsgi.input returns b'' at the end of the body
+               ,'wsgi.input_terminated': isinstance(
+                   rfile, (LimitedLengthFile, ChunkedInputFile))
                # CGI variables required by PEP-333
                ,'REQUEST_METHOD': self.command
                ,'SCRIPT_NAME': '' # application is root of server
-               ,'PATH_INFO': path
-               ,'QUERY_STRING': query
-               ,'CONTENT_TYPE': self.headers.get('Content-Type', '')
-               ,'CONTENT_LENGTH': self.headers.get('Content-Length', '0')
+               ,'CONTENT_TYPE': ''
+               ,'CONTENT_LENGTH': '0'
                ,'SERVER_NAME': server_name
                ,'SERVER_PORT': str(server_port)
                ,'SERVER_PROTOCOL': self.request_version
                # CGI not required by PEP-333
                ,'REMOTE_ADDR': remote_address
+               # Trailer fields for chunked responses
+               ,'paste.httpserver.trailers': []
+               # The response body may be made of memoryviews (or other
+               # buffers), not just bytes; applications only send them
+               # when told to (e.g., FileApp's buffers option), since
+               # middleware may expect bytes
+               ,'paste.httpserver.accepts_buffers': True
+               ,'paste.httpserver.accepted_at': accepted_at
                }
-        if scheme:
-            self.wsgi_environ['paste.httpserver.proxy.scheme'] = scheme
-        if netloc:
-            self.wsgi_environ['paste.httpserver.proxy.host'] = netloc
+        max_request_age = getattr(self.server, 'max_request_age', None)
+        if max_request_age:
+            # The time by which the client has probably given up
+            self.wsgi_environ['paste.httpserver.deadline'] = (
+                accepted_at + max_request_age)
+        # PATH_INFO, QUERY_STRING, and the request headers
+        self.wsgi_environ.update(head)
+        if chunked:
+            # The length isn't known up front
+            del self.wsgi_environ['CONTENT_LENGTH']
 
         if self.lookup_addresses:
             # @@: make lookup_addreses actually work, at this point
@@ -265,16 +576,22 @@ class WSGIHandlerMixin:
             self.server.thread_pool.worker_tracker[_thread.get_ident()][1] = self.wsgi_environ
             self.wsgi_environ['paste.httpserver.thread_pool'] = self.server.thread_pool
 
-        for k, v in self.headers.items():
-            key = 'HTTP_' + k.replace("-","_").upper()
-            if key in ('HTTP_CONTENT_TYPE','HTTP_CONTENT_LENGTH'):
-                continue
-            self.wsgi_environ[key] = ','.join(_get_headers(self.headers, k))
-
+        # Whether wsgi.file_wrapper responses are sent with os.sendfile
+        # (see wsgi_send_file); over SSL, or without a socket (as with
+        # paste.asyncserver), the file is read and sent in blocks
+        sendfile = False
         if hasattr(self.connection,'get_context'):
             self.wsgi_environ['wsgi.url_scheme'] = 'https'
             # @@: extract other SSL parameters from pyOpenSSL at...
             # http://www.modssl.org/docs/2.8/ssl_reference.html#ToC25
+        else:
+            # (a parked connection comes back as a _BufferedConnection)
+            conn = getattr(self.connection, 'wsgi_socket', self.connection)
+            if ssl is not None and isinstance(conn, ssl.SSLSocket):
+                self.wsgi_environ.update(_ssl_environ(conn))
+            else:
+                sendfile = hasattr(conn, 'sendfile')
+        self.wsgi_environ['paste.httpserver.sendfile'] = sendfile
 
         if environ:
             assert isinstance(environ, dict)
@@ -284,6 +601,50 @@ class WSGIHandlerMixin:
 
         self.wsgi_curr_headers = None
         self.wsgi_headers_sent = False
+        self.wsgi_chunked = False
+        self.wsgi_output = []
+        self.wsgi_output_size = 0
+        self.wsgi_hold_output = False
+        self.wsgi_bytes_written = 0
+
+    def wsgi_head_from_headers(self):
+        """
+        Returns the part of the environment that comes from the request
+        head (``PATH_INFO``, ``QUERY_STRING``, ``CONTENT_TYPE``,
+        ``CONTENT_LENGTH`` and the ``HTTP_*`` keys), made from the
+        ``path`` and ``headers`` that BaseHTTPRequestHandler's
+        ``parse_request`` sets.  WSGIHandler parses requests itself,
+        and sets ``wsgi_head_environ`` instead.
+        """
+        dummy_url = 'http://dummy%s' % (self.path,)
+        (scheme, netloc, path, query, fragment) = urlsplit(dummy_url)
+        head = {'PATH_INFO': _normalize_path(unquote(path)),
+                'QUERY_STRING': query}
+        if scheme:
+            head['paste.httpserver.proxy.scheme'] = scheme
+        if netloc:
+            head['paste.httpserver.proxy.host'] = netloc
+        for k in ('Content-Type', 'Content-Length'):
+            v = self.headers.get(k)
+            if v is not None:
+                head[k.replace('-', '_').upper()] = v
+        if hasattr(self.headers, 'get_all'):
+            # Python 3 - email.message.Message lists every header line
+            for k, v in self.headers.items():
+                key = 'HTTP_' + k.replace("-","_").upper()
+                if key in ('HTTP_CONTENT_TYPE','HTTP_CONTENT_LENGTH'):
+                    continue
+                if key in head:
+                    head[key] += ',' + v
+                else:
+                    head[key] = v
+        else:
+            for k in self.headers.keys():
+                key = 'HTTP_' + k.replace("-","_").upper()
+                if key in ('HTTP_CONTENT_TYPE','HTTP_CONTENT_LENGTH'):
+                    continue
+                head[key] = ','.join(_get_headers(self.headers, k))
+        return head
 
     def wsgi_connection_drop(self, exce, environ=None):
         """
@@ -292,6 +653,55 @@ class WSGIHandlerMixin:
         """
         pass
 
+    def wsgi_send_file(self, result):
+        """
+        If ``result`` is a ``FileWrapper`` around a regular file, sends
+        the file from its current position with ``socket.sendfile``
+        (which uses ``os.sendfile`` on plain sockets, and falls back to
+        reading and sending blocks over SSL) and returns True.  Only
+        as many bytes as the Content-Length header gives are sent, so
+        a file that has been seeked to the start of a byte range works
+        too; if there is no Content-Length, the rest of the file is
+        sent and the header is added.
+
+        Returns False if the result has to be iterated over instead.
+        """
+        if (not isinstance(result, FileWrapper) or self.command == 'HEAD'
+            or not self.wsgi_curr_headers
+            or not hasattr(self.connection, 'sendfile')):
+            return False
+        filelike = result.filelike
+        try:
+            st = os.fstat(filelike.fileno())
+            offset = filelike.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            # Not a real file (io.UnsupportedOperation is a ValueError)
+            return False
+        if not S_ISREG(st.st_mode):
+            return False
+        (status, headers) = self.wsgi_curr_headers
+        length = None
+        for (k, v) in headers:
+            if 'content-length' == k.lower():
+                try:
+                    length = int(v)
+                except ValueError:
+                    return False
+        if length is None:
+            length = max(st.st_size - offset, 0)
+            self.wsgi_curr_headers = (
+                status, list(headers) + [('Content-Length', str(length))])
+        self.wsgi_write_chunk(b'')
+        self.wsgi_flush()
+        if length:
+            sent = self.connection.sendfile(filelike, offset, length)
+            self.wsgi_bytes_written += sent
+            if sent < length:
+                # The file got shorter; the client can only tell that
+                # the response is incomplete when the connection closes
+                self.close_connection = 1
+        return True
+
     def wsgi_execute(self, environ=None):
         """
         Invoke the server's ``wsgi_application``.
@@ -299,14 +709,97 @@ class WSGIHandlerMixin:
 
         self.wsgi_setup(environ)
 
+        application = self.server.wsgi_application
+        metrics = getattr(self.server, 'wsgi_metrics', None)
+        if metrics is not None:
+            self.wsgi_environ['paste.httpserver.metrics'] = metrics
+            if metrics.path and metrics.path == self.wsgi_environ['PATH_INFO']:
+                application = metrics_app
+            metrics.request_started()
+            time_started = time.time()
+            try:
+                self.wsgi_run(application, environ)
+            finally:
+                metrics.request_finished(time.time() - time_started,
+                                         self.wsgi_bytes_written)
+        else:
+            self.wsgi_run(application, environ)
+        if not self.close_connection:
+            self.wsgi_discard_input()
+
+    def wsgi_timed_out(self, reason):
+        """
+        Called when the client is too slow (or idle for too long), for
+        ``reason`` (``'header_timeout'``, ``'keepalive_timeout'`` or
+        ``'min_upload_rate'``): the connection is closed after the
+        current request, and the server's ``wsgi_timeouts`` counter for
+        the reason is incremented.
+        """
+        self.close_connection = 1
+        counter = getattr(self.server, 'wsgi_timeouts', None)
+        if counter is not None:
+            with _timeouts_lock:
+                counter[reason] += 1
+
+    def wsgi_discard_input(self):
+        """
+        Reads whatever the application left of the request body, so
+        that the next (possibly pipelined) request on the connection
+        starts where it should.  If more than ``wsgi_max_discard_size``
+        bytes are left, or the length of the body is unknown, the
+        connection is closed after this request instead.
+        """
+        rfile = self.wsgi_environ['wsgi.input']
+        if isinstance(rfile, LimitedLengthFile):
+            left = rfile.length - rfile._consumed
+            if not left:
+                return
+            if left > self.wsgi_max_discard_size:
+                self.close_connection = 1
+                return
+        elif isinstance(rfile, ChunkedInputFile):
+            if rfile._eof:
+                return
+        else:
+            if self.wsgi_environ.get('CONTENT_LENGTH', '0') not in ('', '0'):
+                self.close_connection = 1
+            return
+        hook = rfile.file
+        if isinstance(hook, ContinueHook) and hook.read == hook._ContinueFile_read:
+            # The client hasn't been sent 100 Continue, so it may never
+            # send the body
+            self.close_connection = 1
+            return
+        budget = self.wsgi_max_discard_size
         try:
-            result = self.server.wsgi_application(self.wsgi_environ,
-                                                  self.wsgi_start_response)
+            while budget >= 0:
+                data = rfile.read(min(budget + 1, 8192))
+                if not data:
+                    return
+                budget -= len(data)
+        except (SocketErrors + (IOError,)):
+            # e.g., malformed chunks
+            pass
+        self.close_connection = 1
+
+    def wsgi_run(self, application, environ=None):
+        """
+        Calls ``application`` and sends its response (``environ`` is
+        the argument given to ``wsgi_execute``).
+        """
+        try:
+            result = application(self.wsgi_environ, self.wsgi_start_response)
             try:
-                for chunk in result:
-                    self.wsgi_write_chunk(chunk)
+                if not self.wsgi_send_file(result):
+                    # All of a list is already there, so it can be sent
+                    # in one go; anything else may be streaming
+                    self.wsgi_hold_output = isinstance(result, (list, tuple))
+                    for chunk in result:
+                        self.wsgi_write_chunk(chunk)
                 if not self.wsgi_headers_sent:
-                    self.wsgi_write_chunk('')
+                    self.wsgi_write_chunk(b'')
+                self.wsgi_write_trailer()
+                self.wsgi_flush()
             finally:
                 if hasattr(result,'close'):
                     result.close()
@@ -321,9 +814,238 @@ class WSGIHandlerMixin:
                     '500 Internal Server Error',
                     [('Content-type', 'text/plain'),
                      ('Content-length', str(len(error_msg)))])
-                self.wsgi_write_chunk("Internal Server Error\n")
+                self.wsgi_write_chunk(b"Internal Server Error\n")
+                self.wsgi_flush()
             raise
 
+def _send_buffers(sock, buffers):
+    """
+    Sends all of ``buffers`` with as few ``sendmsg`` calls as possible
+    """
+    buffers = [memoryview(data) for data in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers[:_IOV_MAX])
+        while sent:
+            if sent < len(buffers[0]):
+                buffers[0] = buffers[0][sent:]
+                break
+            sent -= len(buffers[0])
+            del buffers[0]
+
+def _default_backlog():
+    """
+    The listen backlog used when no ``request_queue_size`` is given: as
+    long as the system allows (on Linux, ``net.core.somaxconn``), so
+    bursts of new connections wait to be accepted instead of being
+    dropped (and retried by the client a second or more later).
+    """
+    try:
+        with open('/proc/sys/net/core/somaxconn') as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return socket.SOMAXCONN
+
+def _bind_socket(server_address, request_queue_size=None,
+                 reuse_port=False, listen=True):
+    """
+    Returns a new TCP socket, bound to ``server_address`` (an IPv4 or
+    IPv6 address, or a host name) and listening.  With ``reuse_port``
+    other sockets can be bound to the same address (using
+    ``SO_REUSEPORT``), and the kernel spreads new connections over
+    them; a socket that is not ``listen``-ing only holds on to the
+    address, without getting any of the connections.
+    """
+    host, port = server_address[:2]
+    addresses = socket.getaddrinfo(
+        host or None, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+        socket.AI_PASSIVE)
+    # A host name with both kinds of address binds IPv4, as it always has
+    addresses.sort(key=lambda info: info[0] != socket.AF_INET)
+    family, type, proto, canonname, address = addresses[0]
+    sock = socket.socket(family, type, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        if listen:
+            sock.listen(request_queue_size or _default_backlog())
+    except:
+        sock.close()
+        raise
+    return sock
+
+def _bind_unix_socket(path, request_queue_size=None, mode=None):
+    """
+    Returns a new Unix domain socket, bound to ``path`` and listening.
+    A socket file left behind by an earlier server is replaced, and
+    the new one gets the permissions ``mode`` (e.g., ``0o660`` to let
+    a front-end proxy in the same group connect).
+    """
+    try:
+        if S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    if mode is not None:
+        os.chmod(path, mode)
+    sock.listen(request_queue_size or _default_backlog())
+    return sock
+
+def _unix_socket_file(path):
+    """
+    Identifies the socket file at ``path`` that a server has just
+    bound, for ``_remove_unix_socket``
+    """
+    st = os.stat(path)
+    return (path, st.st_dev, st.st_ino)
+
+def _remove_unix_socket(server):
+    """
+    Removes the socket file that ``server`` was listening on (its
+    ``wsgi_unix_socket``, set by ``serve`` when it bound the socket),
+    unless another server has replaced it in the meantime
+    """
+    socket_file = getattr(server, 'wsgi_unix_socket', None)
+    if socket_file is None:
+        return
+    server.wsgi_unix_socket = None
+    path, dev, ino = socket_file
+    try:
+        st = os.stat(path)
+        if (st.st_dev, st.st_ino) == (dev, ino):
+            os.unlink(path)
+    except OSError:
+        pass
+
+def _name_server(server):
+    """
+    Sets ``server_name`` and ``server_port`` from the server's
+    (bound) ``server_address``.  For a Unix domain socket, the address
+    is the path of the socket file, and there is no port.
+    """
+    if isinstance(server.server_address, tuple):
+        host, port = server.server_address[:2]
+        server.server_name = socket.getfqdn(host)
+        server.server_port = port
+    else:
+        server.server_name = server.server_address
+        server.server_port = None
+
+def _adopt_listen_socket(server, sock):
+    """
+    Makes ``server`` (an HTTPServer that was created without binding
+    its own socket) use the listening socket ``sock``
+    """
+    server.socket.close()
+    server.socket = sock
+    server.server_address = sock.getsockname()
+    _name_server(server)
+
+# Not available on Windows
+_SIGHUP = getattr(signal, 'SIGHUP', None)
+
+# The first file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+def _systemd_listen_fds():
+    """
+    Returns the file descriptors of the listening sockets passed to
+    this process with systemd's socket activation protocol (which
+    ``restart_server`` uses too), and removes the variables from the
+    environment so child processes don't take them for their own.
+    """
+    try:
+        if int(os.environ.get('LISTEN_PID', -1)) != os.getpid():
+            return []
+        nfds = int(os.environ.get('LISTEN_FDS', 0))
+    except ValueError:
+        return []
+    finally:
+        for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            os.environ.pop(name, None)
+    return list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + nfds))
+
+def _socket_from_fd(fd):
+    """
+    Returns a socket object for the inherited listening socket ``fd``
+    (taking over the file descriptor)
+    """
+    if six.PY3:
+        sock = socket.socket(fileno=fd)
+        sock.set_inheritable(False)
+        return sock
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    os.close(fd)
+    return sock
+
+def _notify_systemd(state):
+    """
+    Sends ``state`` (e.g. ``'MAINPID=1234'``) to systemd, if this
+    process was given a ``NOTIFY_SOCKET`` by it; returns true if it
+    was sent.
+    """
+    path = os.environ.get('NOTIFY_SOCKET')
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return False
+    if path.startswith('@'):
+        # An abstract socket
+        path = '\0' + path[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(path)
+        sock.sendall(state.encode('ascii'))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def _is_stdlib_ssl_context(ssl_context):
+    return ssl is not None and isinstance(ssl_context, ssl.SSLContext)
+
+
+def _ssl_context_from_pem(ssl_pem, alpn_protocols=('http/1.1',)):
+    """
+    Makes a standard library ``ssl.SSLContext`` for a server, from a
+    PEM file with the certificate (chain) and the private key.
+
+    Returning clients can resume their sessions instead of doing a
+    full handshake: the server-side session cache and session tickets
+    are on (with TLS 1.3, tickets are sent after the handshake).  The
+    ticket keys belong to the context, so processes forked after it is
+    made (see ``PreforkServer``) accept each other's tickets.  The
+    ``alpn_protocols`` are offered with ALPN.
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(ssl_pem)
+    context.options &= ~getattr(ssl, 'OP_NO_TICKET', 0)
+    if alpn_protocols and getattr(ssl, 'HAS_ALPN', False):
+        context.set_alpn_protocols(list(alpn_protocols))
+    return context
+
+
+def _ssl_environ(ssl_object):
+    """
+    The environment variables describing a TLS connection (given its
+    ``ssl.SSLSocket`` or ``ssl.SSLObject``), named as by mod_ssl
+    """
+    environ = {'wsgi.url_scheme': 'https', 'HTTPS': 'on'}
+    cipher = ssl_object.cipher()
+    if cipher:
+        environ['SSL_CIPHER'] = cipher[0]
+        environ['SSL_PROTOCOL'] = ssl_object.version()
+    environ['SSL_SESSION_RESUMED'] = (
+        getattr(ssl_object, 'session_reused', False)
+        and 'Resumed' or 'Initial')
+    alpn = getattr(ssl_object, 'selected_alpn_protocol', None)
+    if alpn is not None and alpn():
+        environ['paste.httpserver.alpn_protocol'] = alpn()
+    return environ
+
 #
 # SSL Functionality
 #
@@ -340,9 +1062,19 @@ except ImportError:
     SocketErrors = (socket.error,)
     class SecureHTTPServer(HTTPServer):
         def __init__(self, server_address, RequestHandlerClass,
-                     ssl_context=None, request_queue_size=None):
-            assert not ssl_context, "pyOpenSSL not installed"
-            HTTPServer.__init__(self, server_address, RequestHandlerClass)
+                     ssl_context=None, request_queue_size=None,
+                     listen_socket=None):
+            assert not ssl_context or _is_stdlib_ssl_context(ssl_context), (
+                "pyOpenSSL not installed")
+            # A standard library ssl.SSLContext is used by WSGIServerBase
+            self.ssl_context = ssl_context
+            if listen_socket is None:
+                HTTPServer.__init__(self, server_address, RequestHandlerClass)
+            else:
+                HTTPServer.__init__(self, server_address, RequestHandlerClass,
+                                    False)
+                _adopt_listen_socket(self, listen_socket)
+                self.server_activate()
             if request_queue_size:
                 self.socket.listen(request_queue_size)
 else:
@@ -370,15 +1102,23 @@ else:
         """
 
         def __init__(self, server_address, RequestHandlerClass,
-                     ssl_context=None, request_queue_size=None):
+                     ssl_context=None, request_queue_size=None,
+                     listen_socket=None):
             # This overrides the implementation of __init__ in python's
             # SocketServer.TCPServer (which BaseHTTPServer.HTTPServer
             # does not override, thankfully).
-            HTTPServer.__init__(self, server_address, RequestHandlerClass)
-            self.socket = socket.socket(self.address_family,
-                                        self.socket_type)
+            if listen_socket is None:
+                HTTPServer.__init__(self, server_address, RequestHandlerClass)
+                self.socket = socket.socket(self.address_family,
+                                            self.socket_type)
+            else:
+                HTTPServer.__init__(self, server_address, RequestHandlerClass,
+                                    False)
+                _adopt_listen_socket(self, listen_socket)
             self.ssl_context = ssl_context
-            if ssl_context:
+            # (a standard library ssl.SSLContext is used by
+            # WSGIServerBase instead)
+            if ssl_context and not _is_stdlib_ssl_context(ssl_context):
                 class TSafeConnection(tsafe.Connection):
                     def settimeout(self, *args):
                         self._lock.acquire()
@@ -393,7 +1133,8 @@ else:
                         finally:
                             self._lock.release()
                 self.socket = TSafeConnection(ssl_context, self.socket)
-            self.server_bind()
+            if listen_socket is None:
+                self.server_bind()
             if request_queue_size:
                 self.socket.listen(request_queue_size)
             self.server_activate()
@@ -403,7 +1144,7 @@ else:
             # ``makefile(mode, bufsize)`` method as expected by
             # Socketserver.StreamRequestHandler.
             (conn, info) = self.socket.accept()
-            if self.ssl_context:
+            if self.ssl_context and not _is_stdlib_ssl_context(self.ssl_context):
                 conn = _ConnFixer(conn)
             return (conn, info)
 
@@ -436,6 +1177,16 @@ class WSGIHandler(WSGIHandlerMixin, BaseHTTPRequestHandler):
     requests to the server's ``wsgi_application``.
     """
     server_version = 'PasteWSGIServer/' + __version__
+    wsgi_parked = False
+    wsgi_requests_handled = 0
+    # The time by which the request head being read has to be complete,
+    # with the server's wsgi_header_timeout
+    wsgi_head_deadline = None
+    # Limits on the request head: a longer request line gets a 414
+    # response, and more header fields, or more bytes of them, a 431
+    max_request_line = 65536
+    max_header_count = 100
+    max_header_size = 65536
 
     def handle_one_request(self):
         """Handle a single HTTP request.
@@ -445,21 +1196,307 @@ class WSGIHandler(WSGIHandlerMixin, BaseHTTPRequestHandler):
         commands such as GET and POST.
 
         """
-        self.raw_requestline = self.rfile.readline()
-        if not self.raw_requestline:
-            self.close_connection = 1
-            return
-        if not self.parse_request(): # An error code has been sent, just exit
-            return
+        server = self.server
+        keepalive_timeout = (self.wsgi_requests_handled
+                             and getattr(server, 'keepalive_timeout', None))
+        header_timeout = getattr(server, 'wsgi_header_timeout', None)
+        # These replace the server's socket_timeout while waiting for
+        # the request head
+        set_timeouts = bool(keepalive_timeout or header_timeout)
+        if set_timeouts:
+            default_timeout = getattr(server, 'wsgi_socket_timeout', None)
+        if self.wsgi_requests_handled:
+            # The server's time was for the first request
+            self.wsgi_accepted_at = None
+        try:
+            if self.wsgi_requests_handled and hasattr(self.rfile, 'peek'):
+                # Wait for the next request to start
+                if keepalive_timeout:
+                    self.connection.settimeout(keepalive_timeout)
+                try:
+                    if not self.wsgi_wait_for_request():
+                        self.close_connection = 1
+                        return
+                except socket.timeout:
+                    if not keepalive_timeout:
+                        raise
+                    self.wsgi_timed_out('keepalive_timeout')
+                    return
+                keepalive_timeout = 0
+            if self.wsgi_requests_handled:
+                self.wsgi_track_request(time.time())
+            if header_timeout:
+                self.wsgi_head_deadline = (
+                    time.time() + header_timeout + (keepalive_timeout or 0))
+            try:
+                self.raw_requestline = self.wsgi_read_head_line(
+                    self.max_request_line + 1)
+                if not self.raw_requestline:
+                    self.close_connection = 1
+                    return
+                if self.wsgi_accepted_at is None:
+                    self.wsgi_accepted_at = time.time()
+                if not self.parse_request(): # An error code has been sent, just exit
+                    return
+            except socket.timeout:
+                if not header_timeout:
+                    raise
+                self.wsgi_timed_out('header_timeout')
+                return
+        finally:
+            self.wsgi_head_deadline = None
+            if set_timeouts:
+                self.connection.settimeout(default_timeout)
+        self.wsgi_requests_handled += 1
         self.wsgi_execute()
+        # Until the next request arrives this worker isn't running one
+        # (nor hung, nor to be reported by a drain)
+        self.wsgi_track_request(None)
+
+    def wsgi_track_request(self, time_started):
+        """
+        Records in the thread pool's ``worker_tracker`` when this
+        worker started on its current request, or None while it waits
+        for the next request on a keep-alive connection.
+        """
+        pool = getattr(self.server, 'thread_pool', None)
+        if pool is not None:
+            tracker = pool.worker_tracker.get(_thread.get_ident())
+            if tracker is not None:
+                tracker[:] = [time_started, None]
+
+    def wsgi_wait_for_request(self):
+        """
+        Waits for the next request on a keep-alive connection to start
+        arriving.  Returns False if the client closed the connection,
+        or if the server is draining: a ThreadPoolMixIn server keeps
+        the connections waiting here in its ``idle_connections``, and
+        shuts down their reading side when it drains.
+        """
+        server = self.server
+        idle_connections = getattr(server, 'idle_connections', None)
+        if idle_connections is None:
+            return bool(self.rfile.peek(1))
+        with server.idle_lock:
+            idle_connections.add(self.connection)
+        try:
+            if not server.running:
+                return False
+            return bool(self.rfile.peek(1))
+        finally:
+            with server.idle_lock:
+                idle_connections.discard(self.connection)
+
+    def wsgi_read_head_line(self, size):
+        """
+        Reads a line of the request head, raising ``socket.timeout``
+        if the ``wsgi_head_deadline`` (a time) passes first.
+        """
+        if self.wsgi_head_deadline is not None:
+            remaining = self.wsgi_head_deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('Request head arriving too slowly')
+            self.connection.settimeout(remaining)
+        return self.rfile.readline(size)
+
+    def parse_request(self):
+        """
+        Parses ``raw_requestline`` and reads and parses the header
+        fields after it, setting ``command``, ``path``,
+        ``request_version``, ``headers`` and ``close_connection`` as
+        BaseHTTPRequestHandler's ``parse_request`` does.  Rather than
+        going through the ``email`` package, the header lines are
+        split as bytes and the request's part of the WSGI environment
+        is built right away, as ``wsgi_head_environ``.
+
+        Returns False if the request can't be handled (after sending
+        an error response, if there is anyone to send it to).
+        """
+        self.command = None
+        # Not HTTP/0.9 (yet), so that errors get a status line
+        self.request_version = ''
+        self.close_connection = 1
+        self.wsgi_head_environ = None
+        line = self.raw_requestline
+        # Empty lines before the request line are ignored (RFC 7230 3.5)
+        for i in range(4):
+            if line not in (b'\r\n', b'\n'):
+                break
+            line = self.wsgi_read_head_line(self.max_request_line + 1)
+        self.requestline = _native(line.rstrip(b'\r\n'))
+        if len(line) > self.max_request_line:
+            self.requestline = ''
+            self.send_error(414, "Request-URI Too Long")
+            return False
+        words = line.split()
+        if len(words) == 3:
+            (method, target, version) = words
+            try:
+                if not version.startswith(b'HTTP/'):
+                    raise ValueError
+                major, minor = version[5:].split(b'.')
+                version_number = (int(major), int(minor))
+            except ValueError:
+                self.send_error(400, "Bad request version (%r)"
+                                % _native(version))
+                return False
+            if version_number >= (2, 0):
+                self.send_error(505, "Invalid HTTP Version (%s)"
+                                % _native(version))
+                return False
+            if version_number >= (1, 1) and self.protocol_version >= "HTTP/1.1":
+                self.close_connection = 0
+            self.request_version = _native(version)
+        elif len(words) == 2 and words[0] == b'GET':
+            # HTTP/0.9; no headers follow
+            (method, target) = words
+            self.request_version = self.default_request_version
+        elif not words:
+            return False
+        else:
+            self.send_error(400, "Bad request syntax (%r)" % self.requestline)
+            return False
+        self.command = _native(method)
+        self.path = _native(target)
+
+        headers = []
+        size = 0
+        while len(words) == 3:
+            line = self.wsgi_read_head_line(self.max_header_size + 1)
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                # The client has gone away
+                self.close_connection = 1
+                return False
+            size += len(line)
+            if size > self.max_header_size:
+                self.send_error(431, "Request Header Fields Too Large")
+                return False
+            if line[:1] in (b' ', b'\t') and headers:
+                # Obsolete line folding, continuing the last field
+                (name, value) = headers[-1]
+                headers[-1] = (name, value + ' ' + _native(line.strip()))
+                continue
+            (name, sep, value) = line.partition(b':')
+            if not sep or not name or name.strip() != name or b' ' in name:
+                self.send_error(400, "Bad header line (%r)"
+                                % _native(line.rstrip(b'\r\n')))
+                return False
+            headers.append((_native(name), _native(value.strip())))
+            if len(headers) > self.max_header_count:
+                self.send_error(431, "Too many header fields")
+                return False
+        self.headers = _RequestHeaders(headers)
+
+        head = {}
+        for (name, value) in headers:
+            key = name.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                if key not in head:
+                    head[key] = value
+                elif key == 'CONTENT_LENGTH' and head[key] != value:
+                    self.send_error(400, "Conflicting Content-Length")
+                    return False
+                continue
+            key = 'HTTP_' + key
+            if key in head:
+                head[key] += ',' + value
+            else:
+                head[key] = value
+        if ('CONTENT_LENGTH' in head
+            and not _content_length.match(head['CONTENT_LENGTH'])):
+            # Where the body ends can't be told, so neither can where
+            # the next request starts
+            self.send_error(400, "Bad Content-Length")
+            return False
+
+        conntype = head.get('HTTP_CONNECTION', '').lower()
+        if conntype == 'close':
+            self.close_connection = 1
+        elif conntype == 'keep-alive' and self.protocol_version >= "HTTP/1.1":
+            self.close_connection = 0
+
+        if 'HTTP_TRANSFER_ENCODING' in head:
+            codings = head['HTTP_TRANSFER_ENCODING'].lower().split(',')
+            codings = [coding.strip() for coding in codings]
+            if codings[-1] != 'chunked':
+                # The end of the body can't be found (RFC 7230 3.3.3)
+                self.send_error(400, "Bad Transfer-Encoding")
+                return False
+            if codings != ['chunked']:
+                self.send_error(501, "Unsupported Transfer-Encoding")
+                return False
+            if 'CONTENT_LENGTH' in head:
+                # Transfer-Encoding wins, but someone may be trying to
+                # smuggle a request past a proxy that thinks otherwise
+                del head['CONTENT_LENGTH']
+                self.close_connection = 1
+
+        url = self.path
+        if not url.startswith('/') and '://' in url:
+            # absolute-form, as sent to proxies
+            (scheme, sep, url) = url.partition('://')
+            (netloc, slash, url) = url.partition('/')
+            head['paste.httpserver.proxy.scheme'] = scheme
+            head['paste.httpserver.proxy.host'] = netloc
+            url = '/' + url
+        (path, sep, query) = url.partition('#')[0].partition('?')
+        if '%' in path:
+            path = unquote(path)
+        head['PATH_INFO'] = _normalize_path(path)
+        head['QUERY_STRING'] = query
+        self.wsgi_head_environ = head
+        return True
 
     def handle(self):
         # don't bother logging disconnects while handling a request
         try:
-            BaseHTTPRequestHandler.handle(self)
+            # This is BaseHTTPRequestHandler.handle, except that an idle
+            # keep-alive connection may be given back to the server
+            self.close_connection = 1
+            self.handle_one_request()
+            while not self.close_connection:
+                if self.wsgi_park_connection():
+                    break
+                self.handle_one_request()
         except SocketErrors as exce:
             self.wsgi_connection_drop(exce)
 
+    def wsgi_park_connection(self):
+        """
+        Called between requests on a keep-alive connection.  If the
+        server has a ``connection_manager`` and the client has not
+        already sent its next request, this marks the connection as
+        parked and returns True; the server then hands the connection
+        to its manager instead of closing it once this handler has
+        finished, and this worker thread is free for other requests.
+        """
+        if getattr(self.server, 'connection_manager', None) is None:
+            return False
+        if self.wsgi_input_pending():
+            return False
+        self.wsgi_parked = True
+        return True
+
+    def wsgi_input_pending(self):
+        """
+        Returns true if there is more input from the client (e.g., a
+        pipelined request) that can be read without blocking.
+        """
+        if not hasattr(self.rfile, 'peek'):
+            # Can't tell without blocking, so assume there is
+            return True
+        timeout = self.connection.gettimeout()
+        self.connection.setblocking(0)
+        try:
+            try:
+                return bool(self.rfile.peek(1))
+            except socket.error:
+                return False
+        finally:
+            self.connection.settimeout(timeout)
+
     def address_string(self):
         """Return the client address formatted for logging.
 
@@ -468,6 +1505,12 @@ class WSGIHandler(WSGIHandlerMixin, BaseHTTPRequestHandler):
         return ''
 
 class LimitedLengthFile(object):
+    """
+    The ``wsgi.input`` of a request with a Content-Length: reads no
+    more than ``length`` bytes from ``file``, so that the application
+    can't read into the next request on the connection.
+    """
+
     def __init__(self, file, length):
         self.file = file
         self.length = length
@@ -481,38 +1524,71 @@ class LimitedLengthFile(object):
 
     def read(self, length=None):
         left = self.length - self._consumed
-        if length is None:
+        if length is None or length < 0:
             length = left
         else:
             length = min(length, left)
         # next two lines are hnecessary only if read(0) blocks
-        if not left:
-            return ''
+        if not length:
+            return b''
         data = self.file.read(length)
         self._consumed += len(data)
         return data
 
-    def readline(self, *args):
+    def readinto(self, b):
+        """
+        Reads into the buffer ``b`` (e.g., a ``bytearray``) and returns
+        the number of bytes read, without making a new ``bytes`` object
+        when the underlying file has ``readinto`` too.
+        """
+        view = memoryview(b)
+        left = self.length - self._consumed
+        if len(view) > left:
+            view = view[:left]
+        if not len(view):
+            return 0
+        if hasattr(self.file, 'readinto'):
+            count = self.file.readinto(view) or 0
+        else:
+            data = self.file.read(len(view))
+            count = len(data)
+            view[:count] = data
+        self._consumed += count
+        return count
+
+    def readline(self, size=None):
         max_read = self.length - self._consumed
-        if len(args):
-            max_read = min(args[0], max_read)
+        if size is not None and size >= 0:
+            max_read = min(size, max_read)
+        if not max_read:
+            return b''
         data = self.file.readline(max_read)
         self._consumed += len(data)
         return data
 
     def readlines(self, hint=None):
-        data = self.file.readlines(hint)
-        for chunk in data:
-            self._consumed += len(chunk)
-        return data
+        lines = []
+        total = 0
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if hint and total >= hint:
+                break
+        return lines
 
     def __iter__(self):
         return self
 
     def next(self):
-        if self.length - self._consumed <= 0:
+        line = self.readline()
+        if not line:
             raise StopIteration
-        return self.readline()
+        return line
+
+    __next__ = next
 
     ## Optional methods ##
 
@@ -526,6 +1602,224 @@ class LimitedLengthFile(object):
         else:
             return self._consumed
 
+class MinimumRateFile(object):
+    """
+    Wraps the ``rfile`` of a request to give up on clients that send
+    the request body too slowly: reading may take ``grace`` seconds,
+    plus one second for every ``min_rate`` bytes read so far.  Before
+    each read, ``settimeout`` (the connection's) is called with the
+    time left, and after it with ``timeout``, the connection's usual
+    timeout.  Once the time is up, reads raise ``socket.timeout``, and
+    ``on_timeout`` is called (once).
+    """
+
+    def __init__(self, file, settimeout, min_rate, grace, timeout=None,
+                 on_timeout=None):
+        self.file = file
+        self.settimeout = settimeout
+        self.min_rate = float(min_rate)
+        self.deadline = time.time() + grace
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.timed_out = False
+        for attr in ('close', 'closed', 'fileno', 'mode'):
+            if hasattr(file, attr):
+                setattr(self, attr, getattr(file, attr))
+
+    def __repr__(self):
+        base_repr = repr(self.file)
+        return base_repr[:-1] + ' min_rate=%s>' % self.min_rate
+
+    def _call(self, method, *args):
+        remaining = self.deadline - time.time()
+        try:
+            if remaining <= 0 or self.timed_out:
+                raise socket.timeout('Request body arriving too slowly')
+            self.settimeout(remaining)
+            try:
+                result = method(*args)
+            finally:
+                self.settimeout(self.timeout)
+        except socket.timeout:
+            if not self.timed_out:
+                self.timed_out = True
+                if self.on_timeout is not None:
+                    self.on_timeout()
+            raise
+        if not isinstance(result, six.integer_types):
+            result_size = len(result or b'')
+        else:
+            result_size = result
+        self.deadline += result_size / self.min_rate
+        return result
+
+    def read(self, size=-1):
+        return self._call(self.file.read, size)
+
+    def readline(self, size=-1):
+        return self._call(self.file.readline, size)
+
+    def readinto(self, b):
+        if hasattr(self.file, 'readinto'):
+            return self._call(self.file.readinto, b) or 0
+        data = self.read(len(b))
+        memoryview(b)[:len(data)] = data
+        return len(data)
+
+    def readlines(self, hint=None):
+        lines = []
+        total = 0
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if hint and total >= hint:
+                break
+        return lines
+
+class ChunkedInputFile(object):
+    """
+    The ``wsgi.input`` of a request sent with ``Transfer-Encoding:
+    chunked``, which has no Content-Length: the chunks are decoded as
+    they are read from ``file``, and at the end of the body reading
+    returns ``b''``, as at the end of a file (the environment has
+    ``wsgi.input_terminated`` set to tell applications they can read
+    until then).  Trailer fields after the last chunk are skipped.
+
+    A malformed or truncated body raises ``IOError``.
+    """
+    max_line_size = 4096
+    max_trailer_size = 65536
+
+    def __init__(self, file):
+        self.file = file
+        # Left of the current chunk:
+        self._left = 0
+        # Whether the CRLF after the current chunk is still to be read:
+        self._crlf = False
+        self._eof = False
+
+    def __repr__(self):
+        base_repr = repr(self.file)
+        return base_repr[:-1] + ' chunked>'
+
+    def _fill(self):
+        """
+        Makes sure there is some of the current chunk left to read,
+        reading the size of the next chunk if necessary.  Returns False
+        at the end of the body.
+        """
+        if self._left:
+            return True
+        if self._eof:
+            return False
+        if self._crlf:
+            if self.file.readline(self.max_line_size + 1) not in (b'\r\n', b'\n'):
+                raise IOError("Missing CRLF after chunk")
+            self._crlf = False
+        line = self.file.readline(self.max_line_size + 1)
+        if not line.endswith(b'\n'):
+            raise IOError("Truncated or overlong chunk size line")
+        size = line.split(b';', 1)[0].strip()
+        if not size or size.strip(b'0123456789abcdefABCDEF'):
+            raise IOError("Bad chunk size line (%r)" % line)
+        self._left = int(size, 16)
+        if self._left:
+            self._crlf = True
+            return True
+        trailer_size = 0
+        while True:
+            line = self.file.readline(self.max_line_size + 1)
+            if line in (b'\r\n', b'\n'):
+                break
+            trailer_size += len(line)
+            if not line.endswith(b'\n') or trailer_size > self.max_trailer_size:
+                raise IOError("Truncated or overlong trailer")
+        self._eof = True
+        return False
+
+    def _read(self, size):
+        data = self.file.read(min(size, self._left))
+        if not data:
+            raise IOError("Truncated chunk")
+        self._left -= len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        chunks = []
+        while (size is None or size > 0) and self._fill():
+            data = self._read(self._left if size is None else size)
+            chunks.append(data)
+            if size is not None:
+                size -= len(data)
+        return b''.join(chunks)
+
+    def readinto(self, b):
+        """
+        Reads into the buffer ``b`` (e.g., a ``bytearray``) and returns
+        the number of bytes read.
+        """
+        view = memoryview(b)
+        count = 0
+        while count < len(view) and self._fill():
+            part = view[count:count + min(len(view) - count, self._left)]
+            if hasattr(self.file, 'readinto'):
+                got = self.file.readinto(part) or 0
+            else:
+                data = self.file.read(len(part))
+                got = len(data)
+                part[:got] = data
+            if not got:
+                raise IOError("Truncated chunk")
+            self._left -= got
+            count += got
+        return count
+
+    def readline(self, size=-1):
+        chunks = []
+        while (size is None or size < 0 or size > 0) and self._fill():
+            max_read = self._left
+            if size is not None and size >= 0:
+                max_read = min(size, max_read)
+            data = self.file.readline(max_read)
+            if not data:
+                raise IOError("Truncated chunk")
+            self._left -= len(data)
+            chunks.append(data)
+            if data.endswith(b'\n'):
+                break
+            if size is not None and size >= 0:
+                size -= len(data)
+        return b''.join(chunks)
+
+    def readlines(self, hint=None):
+        lines = []
+        total = 0
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if hint and total >= hint:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    __next__ = next
+
 class ThreadPool(object):
     """
     Generic thread pool with a queue of callables to consume.
@@ -570,8 +1864,33 @@ class ThreadPool(object):
 
     Each worker thread only processes ``max_requests`` tasks before it
     dies and replaces itself with a new worker thread.
+
+    The queue holds ``(time_queued, task)`` pairs.  ``add_task`` only
+    puts the task on the queue.  Checking for hung
+    threads, spawning and culling workers is done by a supervisor
+    thread every ``supervisor_period`` seconds, or as soon as a task
+    comes in while there are no idle workers.  ``idle_count`` and
+    ``busy_count`` keep the number of idle workers and of workers
+    running a task.
+
+    If ``max_workers`` is given, the pool autoscales between
+    ``min_workers`` (default ``nworkers``) and ``max_workers`` instead
+    of using ``spawn_if_under`` and culling: when the oldest queued
+    task has waited more than ``scale_up_wait`` seconds, or nearly all
+    workers are busy while tasks are queued, about a quarter more
+    workers are added.  Only when less than half of the workers have
+    been busy, with nothing queued, for ``scale_down_delay`` seconds
+    are some of the idle ones stopped (and then not again for another
+    ``scale_down_delay`` seconds), so the pool doesn't flap between
+    sizes.  Workers replacing themselves after ``max_requests`` tasks
+    don't change the size of the pool.
     """
 
+    # Fractions of busy workers over which the autoscaler grows the
+    # pool (if tasks are queued), and under which it may shrink it:
+    scale_up_busy = 0.9
+    scale_down_busy = 0.5
+
 
     SHUTDOWN = object()
 
@@ -584,6 +1903,11 @@ class ThreadPool(object):
         spawn_if_under=5, # spawn if there's too many hung threads
         max_zombie_threads_before_die=0, # when to give up on the process
         hung_check_period=100, # every 100 requests check for hung workers
+        supervisor_period=1, # seconds between runs of the supervisor thread
+        min_workers=None, # autoscaling: the smallest pool size (default nworkers)
+        max_workers=None, # autoscaling: the largest pool size (None disables autoscaling)
+        scale_up_wait=0.1, # autoscaling: grow when tasks wait longer than this
+        scale_down_delay=60, # autoscaling: shrink after being under-used this long
         logger=None, # Place to log messages to
         error_email=None, # Person(s) to notify if serious problem occurs
         ):
@@ -603,6 +1927,8 @@ class ThreadPool(object):
         self.logger = logger
         self.error_email = error_email
         self._worker_count = count()
+        # A ServerMetrics to record how long tasks wait in the queue:
+        self.metrics = None
 
         assert (not kill_thread_limit
                 or kill_thread_limit >= hung_thread_limit), (
@@ -615,44 +1941,151 @@ class ThreadPool(object):
         self.kill_thread_limit = kill_thread_limit
         self.dying_limit = dying_limit
         self.hung_thread_limit = hung_thread_limit
-        assert spawn_if_under <= nworkers, (
-            "spawn_if_under (%s) should be less than nworkers (%s)"
-            % (spawn_if_under, nworkers))
+        if max_workers:
+            if min_workers is None:
+                min_workers = min(nworkers, max_workers)
+            assert 0 < min_workers <= max_workers, (
+                "min_workers (%s) should be between 1 and max_workers (%s)"
+                % (min_workers, max_workers))
+            nworkers = max(min_workers, min(nworkers, max_workers))
+        else:
+            assert spawn_if_under <= nworkers, (
+                "spawn_if_under (%s) should be less than nworkers (%s)"
+                % (spawn_if_under, nworkers))
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_up_wait = scale_up_wait
+        self.scale_down_delay = scale_down_delay
+        # When the pool started being under-used (for scaling down):
+        self._underused_since = None
         self.spawn_if_under = spawn_if_under
         self.max_zombie_threads_before_die = max_zombie_threads_before_die
         self.hung_check_period = hung_check_period
         self.requests_since_last_hung_check = 0
+        self.supervisor_period = supervisor_period
         # Used to keep track of what worker is doing what:
         self.worker_tracker = {}
         # Used to keep track of the workers not doing anything:
         self.idle_workers = []
+        # The number of idle workers, and of workers running a task;
+        # these (and idle_workers and requests_since_last_hung_check)
+        # are only changed with _count_lock held:
+        self.idle_count = 0
+        self.busy_count = 0
+        # Worker threads that have been started but haven't registered
+        # themselves in self.workers yet:
+        self.starting_count = 0
+        self._count_lock = threading.Lock()
         # Used to keep track of threads that have been killed, but maybe aren't dead yet:
         self.dying_threads = {}
         # This is used to track when we last had to add idle workers;
         # we shouldn't cull extra workers until some time has passed
         # (hung_thread_limit) since workers were added:
         self._last_added_new_idle_workers = 0
+        # Set when the supervisor decides the process should exit:
+        self.server_exit = None
+        self._shutting_down = False
         if not daemon:
             atexit.register(self.shutdown)
         for i in range(self.nworkers):
             self.add_worker_thread(message='Initial worker pool')
+        self._supervisor_wakeup = threading.Event()
+        self.supervisor = threading.Thread(
+            target=self.supervisor_thread_callback,
+            name="%s supervisor" % name)
+        self.supervisor.daemon = True
+        self.supervisor.start()
 
     def add_task(self, task):
         """
         Add a task to the queue
+
+        This only puts the task on the queue; checking for hung
+        workers and adding or culling workers is left to the
+        supervisor thread (see ``supervise``), which is woken up right
+        away when there are no idle workers to take the task.
+        """
+        if self.server_exit is not None:
+            # The supervisor thread gave up on the process
+            raise self.server_exit
+        with self._count_lock:
+            self.requests_since_last_hung_check += 1
+        self.queue.put((time.time(), task))
+        if not self.idle_count and (self.spawn_if_under or self.max_workers):
+            self._supervisor_wakeup.set()
+
+    def queue_wait(self):
+        """
+        Returns the number of seconds the oldest task in the queue has
+        been waiting (0 if the queue is empty).
+        """
+        try:
+            time_queued = self.queue.queue[0][0]
+        except IndexError:
+            return 0
+        return max(0, time.time() - time_queued)
+
+    def wait_for_tasks(self, timeout=None):
+        """
+        Waits until no tasks are queued or being worked on, for at most
+        ``timeout`` seconds.  Returns true if that happened.
+        """
+        deadline = timeout and time.time() + timeout
+        while not self.queue.empty() or self.busy_count:
+            if deadline and time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def supervisor_thread_callback(self):
+        """
+        The supervisor thread runs this; it calls ``supervise`` every
+        ``supervisor_period`` seconds (or sooner, when woken up by
+        ``add_task``) until the pool is shut down.
+        """
+        while not self._shutting_down:
+            self._supervisor_wakeup.wait(self.supervisor_period)
+            self._supervisor_wakeup.clear()
+            if self._shutting_down:
+                break
+            try:
+                self.supervise()
+            except ServerExit as exc:
+                # Raised again by add_task and serve_forever, in the
+                # thread accepting requests
+                self.server_exit = exc
+                break
+            except:
+                print('Unexpected exception in thread pool supervisor',
+                      file=sys.stderr)
+                traceback.print_exc()
+
+    def supervise(self):
+        """
+        Checks for hung workers (once ``hung_check_period`` requests
+        have come in since the last check), spawns workers if tasks are
+        waiting and none are idle, and culls workers that are no longer
+        needed.
         """
-        self.logger.debug('Added task (%i tasks queued)', self.queue.qsize())
+        check_hung = False
         if self.hung_check_period:
-            self.requests_since_last_hung_check += 1
-            if self.requests_since_last_hung_check > self.hung_check_period:
-                self.requests_since_last_hung_check = 0
-                self.kill_hung_threads()
-        if not self.idle_workers and self.spawn_if_under:
+            with self._count_lock:
+                if (self.requests_since_last_hung_check
+                    > self.hung_check_period):
+                    self.requests_since_last_hung_check = 0
+                    check_hung = True
+        if check_hung:
+            self.kill_hung_threads()
+        if self.max_workers:
+            self.autoscale()
+            return
+        if (not self.idle_count and self.spawn_if_under
+            and not self.queue.empty()):
             # spawn_if_under can come into effect...
             busy = 0
             now = time.time()
             self.logger.debug('No idle workers for task; checking if we need to make more workers')
-            for worker in self.workers:
+            for worker in list(self.workers):
                 if not hasattr(worker, 'thread_id'):
                     # Not initialized
                     continue
@@ -673,18 +2106,70 @@ class ThreadPool(object):
                     'No extra workers needed (%s busy workers)',
                     busy)
         if (len(self.workers) > self.nworkers
-            and len(self.idle_workers) > 3
+            and self.idle_count > 3
             and time.time()-self._last_added_new_idle_workers > self.hung_thread_limit):
             # We've spawned worers in the past, but they aren't needed
             # anymore; kill off some
             self.logger.info(
                 'Culling %s extra workers (%s idle workers present)',
-                len(self.workers)-self.nworkers, len(self.idle_workers))
+                len(self.workers)-self.nworkers, self.idle_count)
             self.logger.debug(
                 'Idle workers: %s', self.idle_workers)
             for i in range(len(self.workers) - self.nworkers):
-                self.queue.put(self.SHUTDOWN)
-        self.queue.put(task)
+                self.queue.put((time.time(), self.SHUTDOWN))
+            # Don't cull again until these have been picked up
+            self._last_added_new_idle_workers = time.time()
+
+    def autoscale(self):
+        """
+        Grows or shrinks the pool, when autoscaling (see the class
+        docstring)
+        """
+        now = time.time()
+        size = len(self.workers) + self.starting_count
+        busy = self.busy_count
+        queued = self.queue.qsize()
+        wait = self.queue_wait()
+        if size < self.max_workers and (
+            wait > self.scale_up_wait
+            or (queued and busy >= size * self.scale_up_busy)):
+            add = min(self.max_workers - size, max(1, size // 4))
+            self.logger.info(
+                'Tasks waiting %.2fsec (%s queued, %s of %s workers busy); '
+                'adding %s workers', wait, queued, busy, size, add)
+            self._underused_since = None
+            for i in range(add):
+                self.add_worker_thread(message='Autoscaling up')
+        elif (size > self.min_workers and not queued
+              and busy < size * self.scale_down_busy):
+            if self._underused_since is None:
+                self._underused_since = now
+            elif now - self._underused_since > self.scale_down_delay:
+                remove = min(size - self.min_workers,
+                             max(1, (size - busy) // 4))
+                self.logger.info(
+                    'Only %s of %s workers busy for %i seconds; stopping %s '
+                    'workers', busy, size, now - self._underused_since, remove)
+                # Wait another scale_down_delay before shrinking again
+                self._underused_since = now
+                for i in range(remove):
+                    self.queue.put((now, self.SHUTDOWN))
+        else:
+            self._underused_since = None
+
+    def _set_idle(self, thread_id, idle):
+        """
+        Moves a worker between the idle and busy counts
+        """
+        with self._count_lock:
+            if idle:
+                self.idle_workers.append(thread_id)
+                self.idle_count += 1
+                self.busy_count -= 1
+            else:
+                self.idle_workers.remove(thread_id)
+                self.idle_count -= 1
+                self.busy_count += 1
 
     def track_threads(self):
         """
@@ -757,6 +2242,8 @@ class ThreadPool(object):
                                   args=args, kwargs=kwargs,
                                   name=("worker %d" % index))
         worker.setDaemon(self.daemon)
+        with self._count_lock:
+            self.starting_count += 1
         worker.start()
 
     def kill_hung_threads(self):
@@ -867,8 +2354,12 @@ class ThreadPool(object):
         """
         thread_obj = threading.currentThread()
         thread_id = thread_obj.thread_id = _thread.get_ident()
-        self.workers.append(thread_obj)
-        self.idle_workers.append(thread_id)
+        with self._count_lock:
+            self.workers.append(thread_obj)
+            self.starting_count -= 1
+            self.idle_workers.append(thread_id)
+            self.idle_count += 1
+        idle = True
         requests_processed = 0
         add_replacement_worker = False
         self.logger.debug('Started new worker %s: %s', thread_id, message)
@@ -880,14 +2371,14 @@ class ThreadPool(object):
                                       % (thread_id, requests_processed, self.max_requests))
                     add_replacement_worker = True
                     break
-                runnable = self.queue.get()
+                time_queued, runnable = self.queue.get()
                 if runnable is ThreadPool.SHUTDOWN:
                     self.logger.debug('Worker %s asked to SHUTDOWN', thread_id)
                     break
-                try:
-                    self.idle_workers.remove(thread_id)
-                except ValueError:
-                    pass
+                if self.metrics is not None:
+                    self.metrics.task_dequeued(time.time() - time_queued)
+                self._set_idle(thread_id, False)
+                idle = False
                 self.worker_tracker[thread_id] = [time.time(), None]
                 requests_processed += 1
                 try:
@@ -911,16 +2402,19 @@ class ThreadPool(object):
                         pass
                     if six.PY2:
                         sys.exc_clear()
-                self.idle_workers.append(thread_id)
+                self._set_idle(thread_id, True)
+                idle = True
         finally:
             try:
                 del self.worker_tracker[thread_id]
             except KeyError:
                 pass
-            try:
-                self.idle_workers.remove(thread_id)
-            except ValueError:
-                pass
+            with self._count_lock:
+                if idle:
+                    self.idle_workers.remove(thread_id)
+                    self.idle_count -= 1
+                else:
+                    self.busy_count -= 1
             try:
                 self.workers.remove(thread_obj)
             except ValueError:
@@ -937,14 +2431,18 @@ class ThreadPool(object):
         Shutdown the queue (after finishing any pending requests).
         """
         self.logger.info('Shutting down threadpool')
+        self._shutting_down = True
+        self._supervisor_wakeup.set()
+        if self.supervisor is not threading.current_thread():
+            self.supervisor.join(1)
         # Add a shutdown request for every worker
         for i in range(len(self.workers)):
-            self.queue.put(ThreadPool.SHUTDOWN)
+            self.queue.put((time.time(), ThreadPool.SHUTDOWN))
         # Wait for each thread to terminate
         hung_workers = []
         for worker in self.workers:
             worker.join(0.5)
-            if worker.isAlive():
+            if worker.is_alive():
                 hung_workers.append(worker)
         zombies = []
         for thread_id in self.dying_threads:
@@ -960,24 +2458,33 @@ class ThreadPool(object):
             if force_quit_timeout:
                 timed_out = False
                 need_force_quit = bool(zombies)
-                for worker in self.workers:
-                    if not timed_out and worker.isAlive():
+                # (the workers just killed are among the dying threads)
+                workers = list(self.workers) + [
+                    worker for (time_killed, worker)
+                    in list(self.dying_threads.values())
+                    if worker is not None]
+                for worker in workers:
+                    if not timed_out and worker.is_alive():
                         timed_out = True
                         worker.join(force_quit_timeout)
-                    if worker.isAlive():
+                    if worker.is_alive():
                         print("Worker %s won't die" % worker)
                         need_force_quit = True
                 if need_force_quit:
                     import atexit
-                    # Remove the threading atexit callback
-                    for callback in list(atexit._exithandlers):
-                        func = getattr(callback[0], 'im_func', None)
-                        if not func:
-                            continue
-                        globs = getattr(func, 'func_globals', {})
-                        mod = globs.get('__name__')
-                        if mod == 'threading':
-                            atexit._exithandlers.remove(callback)
+                    if hasattr(atexit, '_exithandlers'):
+                        # Python 2: remove the threading atexit callback
+                        for callback in list(atexit._exithandlers):
+                            func = getattr(callback[0], 'im_func', None)
+                            if not func:
+                                continue
+                            globs = getattr(func, 'func_globals', {})
+                            mod = globs.get('__name__')
+                            if mod == 'threading':
+                                atexit._exithandlers.remove(callback)
+                    else:
+                        # Joining the workers again would hang too
+                        atexit.unregister(self.shutdown)
                     atexit._run_exitfuncs()
                     print('Forcefully exiting process')
                     os._exit(3)
@@ -1040,33 +2547,723 @@ class ThreadPool(object):
         server.quit()
         print('email sent to', error_emails, message)
 
+class _PrefixedReader(io.RawIOBase):
+    """
+    Raw file that returns ``data`` before reading from ``raw``
+    """
+
+    def __init__(self, raw, data):
+        self.raw = raw
+        self.data = data
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        left = len(self.data) - self.pos
+        if not left:
+            return self.raw.readinto(b)
+        size = min(len(b), left)
+        b[:size] = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        io.RawIOBase.close(self)
+
+class _BufferedConnection(object):
+    """
+    Wraps a connection whose first bytes have already been read from
+    the socket (by a ConnectionManager); the file returned by
+    ``makefile`` gives them back before reading any further.
+    """
+
+    def __init__(self, conn, data):
+        self.wsgi_socket = conn
+        self.__data = data
+
+    def makefile(self, mode, bufsize=-1):
+        if 'r' not in mode or self.__data is None:
+            return self.wsgi_socket.makefile(mode, bufsize)
+        data, self.__data = self.__data, None
+        raw = _PrefixedReader(self.wsgi_socket.makefile('rb', 0), data)
+        if not bufsize:
+            return raw
+        if bufsize < 0:
+            bufsize = io.DEFAULT_BUFFER_SIZE
+        return io.BufferedReader(raw, bufsize)
+
+    def __getattr__(self, attrib):
+        return getattr(self.wsgi_socket, attrib)
+
+class ConnectionManager(object):
+    """
+    Watches idle connections for a ThreadPoolMixIn server, so that
+    they don't each hold on to a worker thread.
+
+    The listening socket and all idle connections are watched with a
+    single ``selectors`` selector (epoll, kqueue, etc.) in the thread
+    that accepts connections.  Newly accepted connections, and
+    keep-alive connections that a worker hands back with ``park()``,
+    are read from without blocking until a complete request head has
+    arrived; only then is the connection passed on to
+    ``dispatch(request, client_address)``.  The bytes read so far are
+    given back by the request's ``makefile``.
+
+    When the server stops, ``drain`` closes the idle keep-alive
+    connections (clients retry requests on those), but first gives
+    connections that haven't sent their first request yet up to
+    ``drain_timeout`` seconds to do so.
+
+    Connections that have been idle for more than ``keepalive_timeout``
+    seconds are closed, and so are connections that take more than
+    ``header_timeout`` seconds to send a request head (counted from
+    when a new connection was accepted, or from the first byte of the
+    next request on a keep-alive one).  When more than ``max_parked``
+    connections are waiting, the ones that have waited longest are
+    closed.  ``dropped`` counts the connections closed for each of
+    these reasons.
+    """
+
+    LISTENER = object()
+    WAKEUP = object()
+
+    # When this much has been read without finding the end of the
+    # request head, the request is dispatched anyway (and rejected by
+    # the handler)
+    max_head_size = 65536 + 4096
+    read_size = 8192
+    drain_timeout = 5
+
+    def __init__(self, listener, dispatch, keepalive_timeout=None,
+                 max_parked=1000, header_timeout=None):
+        self.listener = listener
+        self.dispatch = dispatch
+        self.keepalive_timeout = keepalive_timeout
+        self.header_timeout = header_timeout
+        self.max_parked = max_parked
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ, self.LISTENER)
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(0)
+        self._wakeup_send.setblocking(0)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ,
+                               self.WAKEUP)
+        # Connections handed back by workers; they are registered
+        # with the selector by the accepting thread:
+        self._incoming = collections.deque()
+        self._lock = threading.Lock()
+        # Maps each watched socket to [client_address, time_parked, head,
+        # new, head_started] (new being true until the connection's
+        # first request, and head_started the time the request head
+        # started, if it has)
+        self.parked = {}
+        self.dropped = collections.Counter()
+        self.closed = False
+        self._last_expired = time.time()
+
+    def park(self, request, client_address):
+        """
+        Hand an idle connection back to be watched.  This can be called
+        from any thread.
+        """
+        request = getattr(request, 'wsgi_socket', request)
+        with self._lock:
+            if self.closed:
+                self._close_socket(request)
+                return
+            self._incoming.append((request, client_address, False))
+        self.wakeup()
+
+    def wakeup(self):
+        """
+        Makes a ``poll`` that is waiting return.  This can be called
+        from any thread (or signal handler).
+        """
+        try:
+            self._wakeup_send.send(b'x')
+        except socket.error:
+            # The wakeup socket is full (so the selector is awake
+            # anyway), or closed
+            pass
+
+    def watch(self, request, client_address, new=True):
+        """
+        Start watching a newly accepted connection (or, if ``new`` is
+        false, a parked one).  This must be called from the accepting
+        thread.
+        """
+        if len(self.parked) >= self.max_parked:
+            oldest = min(self.parked, key=lambda sock: self.parked[sock][1])
+            self.dropped['max_parked'] += 1
+            self._close(oldest)
+        request.setblocking(0)
+        now = time.time()
+        conn = [client_address, now, bytearray(), new, new and now or None]
+        self.parked[request] = conn
+        self.selector.register(request, selectors.EVENT_READ, conn)
+
+    def poll(self, timeout=None):
+        """
+        Waits up to ``timeout`` seconds, reading from any connections
+        that are ready.  Returns True if the listening socket has a
+        connection ready to be accepted.
+        """
+        if self.closed:
+            return False
+        while self._incoming:
+            self.watch(*self._incoming.popleft())
+        try:
+            events = self.selector.select(timeout)
+        except (ValueError, socket.error):
+            if self.closed:
+                return False
+            raise
+        ready = False
+        for key, mask in events:
+            if key.data is self.LISTENER:
+                ready = True
+            elif key.data is self.WAKEUP:
+                try:
+                    self._wakeup_recv.recv(4096)
+                except socket.error:
+                    pass
+            else:
+                self._read(key.fileobj, key.data)
+        self.expire()
+        return ready
+
+    def _read(self, sock, conn):
+        try:
+            data = sock.recv(self.read_size)
+            # An ssl.SSLSocket may have decrypted data left over, which
+            # the selector can't see
+            pending = getattr(sock, 'pending', None)
+            while data and pending is not None and pending():
+                data += sock.recv(self.read_size)
+        except socket.error as exce:
+            if exce.args and exce.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            if ssl is not None and isinstance(
+                    exce, (ssl.SSLWantReadError, ssl.SSLWantWriteError)):
+                # Only part of a TLS record has arrived
+                return
+            data = None
+        if not data:
+            # Closed by the client
+            self._close(sock)
+            return
+        head = conn[2]
+        if conn[4] is None:
+            conn[4] = time.time()
+        start = max(0, len(head) - 3)
+        head += data
+        if (head.find(b'\n\r\n', start) != -1
+            or head.find(b'\n\n', start) != -1
+            or len(head) >= self.max_head_size):
+            self._forget(sock)
+            self.dispatch(_BufferedConnection(sock, bytes(head)), conn[0])
+
+    def expire(self):
+        """
+        Closes connections that have been idle for too long.
+        """
+        now = time.time()
+        if (not (self.keepalive_timeout or self.header_timeout)
+            or now - self._last_expired < 1):
+            return
+        self._last_expired = now
+        for sock, conn in list(self.parked.items()):
+            head_started = conn[4]
+            if self.header_timeout and head_started is not None:
+                if now - head_started > self.header_timeout:
+                    self.dropped['header_timeout'] += 1
+                    self._close(sock)
+            elif (self.keepalive_timeout
+                  and now - conn[1] > self.keepalive_timeout):
+                self.dropped['keepalive_timeout'] += 1
+                self._close(sock)
+
+    def stop_listening(self):
+        """
+        Stops watching the listening socket (``poll`` won't report it
+        as ready anymore).
+        """
+        if self.listener is not None:
+            try:
+                self.selector.unregister(self.listener)
+            except (KeyError, ValueError):
+                # The socket has been closed already (by server_close)
+                pass
+            self.listener = None
+
+    def drain(self):
+        """
+        Stops watching the listening socket and closes the connections
+        waiting for their next request, except that connections that
+        have not sent a first request get up to ``drain_timeout``
+        seconds for it to arrive (it is dispatched as usual).
+        """
+        if self.closed:
+            return
+        self.stop_listening()
+        deadline = time.time() + self.drain_timeout
+        while True:
+            while self._incoming:
+                self.watch(*self._incoming.popleft())
+            waiting = False
+            for sock, conn in list(self.parked.items()):
+                if conn[3]:
+                    waiting = True
+                else:
+                    self._close(sock)
+            remaining = deadline - time.time()
+            if not waiting or remaining <= 0:
+                break
+            self.poll(min(remaining, 0.1))
+        self.close()
+
+    def _forget(self, sock):
+        del self.parked[sock]
+        self.selector.unregister(sock)
+
+    def _close(self, sock):
+        self._forget(sock)
+        self._close_socket(sock)
+
+    def _close_socket(self, sock):
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def close(self):
+        """
+        Closes all the idle connections; the listening socket is left
+        alone.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        for sock in list(self.parked):
+            self._close_socket(sock)
+        self.parked.clear()
+        while self._incoming:
+            self._close_socket(self._incoming.popleft()[0])
+        self.selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+class Histogram(object):
+    """
+    Counts observed values in cumulative ``buckets`` (upper bounds),
+    as a Prometheus histogram
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, help, labels=None):
+        lines = ['# HELP %s %s' % (name, help),
+                 '# TYPE %s histogram' % name]
+        extra = ''.join(',%s="%s"' % item
+                        for item in sorted((labels or {}).items()))
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('%s_bucket{le="%s"%s} %d'
+                         % (name, bound, extra, total))
+        suffix = extra and '{%s}' % extra[1:]
+        lines.append('%s_sum%s %r' % (name, suffix, self.sum))
+        lines.append('%s_count%s %d' % (name, suffix, total))
+        return lines
+
+class ServerMetrics(object):
+    """
+    Collects statistics about a server (requests, queueing, workers
+    and connections), reported in the Prometheus text format by
+    ``render``.
+
+    Once this is set as the server's ``wsgi_metrics``, the handler
+    records every request, and puts it in the environment as
+    ``paste.httpserver.metrics``, so ``metrics_app`` can be mounted
+    anywhere in an application.  If ``path`` is given, requests for
+    that path are answered with ``metrics_app`` by the server itself
+    (see the ``metrics_path`` option of ``serve``).
+
+    The statistics are those of one server in one process.  With
+    ``PreforkServer`` each child keeps its own, and whichever child
+    accepts a scrape answers it, so every metric is then labelled with
+    the child's ``pid``: the series of different children are kept
+    apart instead of looking like one counter jumping up and down.
+    They are not added up across the children.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                        1, 2.5, 5, 10)
+    queue_wait_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                          0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, server, path=None):
+        self.server = server
+        self.path = path
+        self.requests_served = 0
+        self.requests_in_flight = 0
+        self.bytes_written = 0
+        self.request_duration = Histogram(self.duration_buckets)
+        self.queue_wait = Histogram(self.queue_wait_buckets)
+        self._lock = threading.Lock()
+        thread_pool = getattr(server, 'thread_pool', None)
+        if thread_pool is not None:
+            thread_pool.metrics = self
+
+    def request_started(self):
+        with self._lock:
+            self.requests_in_flight += 1
+
+    def request_finished(self, duration, bytes_written):
+        with self._lock:
+            self.requests_in_flight -= 1
+            self.requests_served += 1
+            self.bytes_written += bytes_written
+            self.request_duration.observe(duration)
+
+    def task_dequeued(self, queue_wait):
+        with self._lock:
+            self.queue_wait.observe(queue_wait)
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format (as a native
+        string)
+        """
+        lines = []
+        server = self.server
+        process_labels = {}
+        if getattr(server, 'wsgi_multiprocess', False):
+            process_labels['pid'] = os.getpid()
+
+        def add(name, type, help, value, labels=None):
+            if not lines or lines[-1].split(' ')[0].split('{')[0] != name:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, type))
+            labels = dict(process_labels, **(labels or {}))
+            if labels:
+                name = '%s{%s}' % (name, ','.join(
+                    '%s="%s"' % item for item in sorted(labels.items())))
+            lines.append('%s %s' % (name, value))
+
+        with self._lock:
+            add('paste_requests_total', 'counter',
+                'Requests served.', self.requests_served)
+            add('paste_requests_in_flight', 'gauge',
+                'Requests being handled.', self.requests_in_flight)
+            add('paste_bytes_written_total', 'counter',
+                'Bytes of responses written.', self.bytes_written)
+            lines.extend(self.request_duration.render(
+                'paste_request_duration_seconds',
+                'Time taken to handle requests.', process_labels))
+            lines.extend(self.queue_wait.render(
+                'paste_queue_wait_seconds',
+                'Time requests waited for a worker thread.', process_labels))
+        thread_pool = getattr(server, 'thread_pool', None)
+        if thread_pool is not None:
+            add('paste_queue_depth', 'gauge',
+                'Requests waiting for a worker thread.',
+                thread_pool.queue.qsize())
+            for state, workers in sorted(thread_pool.track_threads().items()):
+                add('paste_workers', 'gauge', 'Worker threads by state.',
+                    len(workers), {'state': state})
+        if hasattr(server, 'requests_shed'):
+            add('paste_requests_shed_total', 'counter',
+                'Requests answered with 503 because of overload.',
+                server.requests_shed)
+        if hasattr(server, 'requests_expired'):
+            add('paste_requests_expired_total', 'counter',
+                'Requests answered with 503 after waiting longer than '
+                'max_request_age.',
+                server.requests_expired)
+        manager = getattr(server, 'connection_manager', None)
+        if manager is not None:
+            add('paste_connections_parked', 'gauge',
+                'Idle connections waiting for a request.',
+                len(manager.parked))
+        with _timeouts_lock:
+            dropped = collections.Counter(getattr(server, 'wsgi_timeouts', ()))
+        if manager is not None:
+            dropped.update(manager.dropped)
+        for reason, count in sorted(dropped.items()):
+            add('paste_connections_dropped_total', 'counter',
+                'Connections closed by the server for being idle or slow.',
+                count, {'reason': reason})
+        lines.append('')
+        return '\n'.join(lines)
+
+def metrics_app(environ, start_response):
+    """
+    WSGI application reporting the ``paste.httpserver.metrics`` of the
+    server (see ``ServerMetrics``)
+    """
+    metrics = environ.get('paste.httpserver.metrics')
+    if metrics is None:
+        body = b'Server metrics are not enabled\n'
+        start_response('404 Not Found',
+                       [('Content-Type', 'text/plain'),
+                        ('Content-Length', str(len(body)))])
+        return [body]
+    body = metrics.render().encode('utf-8')
+    start_response('200 OK', [('Content-Type', metrics.content_type),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+def _shutdown_read(conn):
+    """
+    Shuts down the reading side of a connection (a socket, an
+    ``ssl.SSLSocket``, or a pyOpenSSL connection), so that a thread
+    blocked reading from it gets the end of the input
+    """
+    conn = getattr(conn, 'wsgi_socket', conn)
+    try:
+        if isinstance(conn, socket.socket):
+            # Not SSLSocket.shutdown, which drops the TLS state from
+            # under the thread reading
+            socket.socket.shutdown(conn, socket.SHUT_RD)
+        elif hasattr(conn, 'sock_shutdown'):
+            conn.sock_shutdown(socket.SHUT_RD)
+    except SocketErrors:
+        pass
+
 class ThreadPoolMixIn(object):
     """
     Mix-in class to process requests from a thread pool
+
+    Unless ``park_connections`` is false (or there is no ``selectors``
+    module, or the ``ssl_context`` is a pyOpenSSL one), connections are
+    only given to a worker thread once their request has arrived, and
+    idle keep-alive connections are handed back to a ConnectionManager;
+    see that class for ``keepalive_timeout`` and ``header_timeout``
+    (which the handler applies itself to connections that are not
+    parked).  With a standard library ``ssl.SSLContext``, new
+    connections go straight to a worker, which does the TLS handshake,
+    and are only parked between requests.
+
+    When the server is overloaded, requests are shed: if
+    ``max_queue_size`` requests are already waiting for a worker, or
+    the oldest of them has waited more than ``max_queue_wait``
+    seconds, the accepting thread answers with a ``503 Service
+    Unavailable`` (with a ``Retry-After`` of ``shed_retry_after``
+    seconds) and closes the connection, instead of queueing it.
+    ``requests_shed`` counts these requests.
+
+    Requests that waited in the queue for longer than
+    ``max_request_age`` seconds (from when they were handed to the
+    thread pool) are not run at all once a worker gets to them, since
+    the client has probably given up: they get the same 503 response,
+    and are counted by ``requests_expired``.  The request's environment
+    has the time it was queued as ``paste.httpserver.accepted_at``, and
+    with ``max_request_age``, the time after which there is no point in
+    going on as ``paste.httpserver.deadline``.
+
+    Each time the listening socket is ready, up to ``accept_batch``
+    connections waiting in the listen backlog are accepted, so a burst
+    of new connections doesn't take a trip round the loop each.  When
+    accepting fails (e.g., for lack of file descriptors), see
+    ``accept_failed``.
+
+    ``drain()`` (which can be called from a signal handler or another
+    thread) stops ``serve_forever`` gracefully: the listening socket is
+    closed right away, idle keep-alive connections are closed (parked
+    or not: a worker waiting for the next request on one is woken up
+    by shutting down its reading side), and the
+    requests that have already been accepted (queued or in progress)
+    get up to ``stop_timeout`` seconds to finish.  Requests still
+    unfinished then are logged, and ``drained_cleanly`` is set to
+    False (True if everything finished).  Setting ``running`` to false
+    does the same, but may take a second to be noticed.
     """
-    def __init__(self, nworkers, daemon=False, **threadpool_options):
+
+    shed_retry_after = 1
+    stop_timeout = 60
+    drained_cleanly = None
+    accept_batch = 64
+    accept_error_delay = 0.1
+    accept_error_log_interval = 10
+    _accept_error_logged = 0
+    # Set (e.g., by a SIGHUP handler) to have the loop call
+    # restart_server
+    restart_requested = False
+
+    def __init__(self, nworkers, daemon=False, park_connections=True,
+                 keepalive_timeout=None, max_queue_size=None,
+                 max_queue_wait=None, header_timeout=None,
+                 max_request_age=None, **threadpool_options):
         # Create and start the workers
         self.running = True
+        self.keepalive_timeout = keepalive_timeout
+        self.wsgi_header_timeout = header_timeout
+        self.max_queue_size = max_queue_size
+        self.max_queue_wait = max_queue_wait
+        self.max_request_age = max_request_age
+        self.requests_shed = 0
+        self.requests_expired = 0
+        # Connections (not parked) whose worker is waiting for their
+        # next request; see WSGIHandler.wsgi_wait_for_request
+        self.idle_connections = set()
+        self.idle_lock = threading.Lock()
         assert nworkers > 0, "ThreadPoolMixIn servers must have at least one worker"
+        if self.server_port is None:
+            # A Unix domain socket
+            name = "ThreadPoolMixIn HTTP server on %s" % self.server_name
+        else:
+            name = ("ThreadPoolMixIn HTTP server on %s:%d"
+                    % (self.server_name, self.server_port))
         self.thread_pool = ThreadPool(
             nworkers,
-            "ThreadPoolMixIn HTTP server on %s:%d"
-            % (self.server_name, self.server_port),
+            name,
             daemon,
             **threadpool_options)
+        self.connection_manager = None
+        ssl_context = getattr(self, 'ssl_context', None)
+        if (park_connections and selectors is not None
+            and (not ssl_context or _is_stdlib_ssl_context(ssl_context))):
+            self.connection_manager = ConnectionManager(
+                self.socket, self.dispatch_request,
+                keepalive_timeout=keepalive_timeout,
+                header_timeout=header_timeout)
+            # The manager waits for connections to accept
+            self.socket.settimeout(0)
 
     def process_request(self, request, client_address):
+        """
+        Queue the request to be processed by on of the thread pool
+        threads (once it has arrived, if there is a connection manager
+        and no TLS handshake to do first)
+        """
+        if (self.connection_manager is not None
+            and not _is_stdlib_ssl_context(getattr(self, 'ssl_context', None))):
+            self.connection_manager.watch(request, client_address)
+        else:
+            self.dispatch_request(request, client_address)
+
+    def dispatch_request(self, request, client_address):
         """
         Queue the request to be processed by on of the thread pool threads
         """
-        # This sets the socket to blocking mode (and no timeout) since it
-        # may take the thread pool a little while to get back to it. (This
-        # is the default but since we set a timeout on the parent socket so
-        # that we can trap interrupts we need to restore this,.)
-        request.setblocking(1)
+        # This sets the socket back to blocking mode (with the server's
+        # socket_timeout, if any), since the connection manager watches
+        # it without blocking, and it may take the thread pool a little
+        # while to get back to it.
+        if self.overloaded():
+            self.shed_request(request)
+            return
+        request.settimeout(getattr(self, 'wsgi_socket_timeout', None))
         # Queue processing of the request
+        accepted_at = time.time()
         self.thread_pool.add_task(
-             lambda: self.process_request_in_thread(request, client_address))
+             lambda: self.process_request_in_thread(
+                 request, client_address, accepted_at))
+
+    def overloaded(self):
+        """
+        Returns true if new requests should be shed (see
+        ``max_queue_size`` and ``max_queue_wait``)
+        """
+        pool = self.thread_pool
+        if self.max_queue_size and pool.queue.qsize() >= self.max_queue_size:
+            return True
+        if self.max_queue_wait and pool.queue_wait() > self.max_queue_wait:
+            return True
+        return False
+
+    def expired(self, accepted_at):
+        """
+        Returns true if a request queued at ``accepted_at`` has been
+        waiting too long to be worth running (see ``max_request_age``)
+        """
+        return bool(self.max_request_age and accepted_at
+                    and time.time() - accepted_at > self.max_request_age)
+
+    def expire_request(self, request):
+        """
+        Answers a request that waited too long like a shed request
+        """
+        with _timeouts_lock:
+            self.requests_expired += 1
+        self._reject_request(request)
+
+    def shed_request(self, request):
+        """
+        Answers the request with a minimal 503 response and closes the
+        connection, without blocking the accepting thread (SSL
+        connections are just closed).
+        """
+        self.requests_shed += 1
+        self._reject_request(request)
+
+    def _reject_request(self, request):
+        if getattr(self, 'ssl_context', None):
+            # There is no time to do a TLS handshake
+            self.close_request(request)
+            return
+        request = getattr(request, 'wsgi_socket', request)
+        try:
+            request.setblocking(0)
+            request.send(self.shed_response())
+            request.shutdown(socket.SHUT_WR)
+            # Read what has arrived of the request, so closing the
+            # socket doesn't reset the connection (losing the response)
+            request.recv(65536)
+        except socket.error:
+            pass
+        self.close_request(request)
+
+    def shed_response(self):
+        """
+        The response sent to shed requests
+        """
+        return ('HTTP/1.1 503 Service Unavailable\r\n'
+                'Retry-After: %s\r\n'
+                'Content-Length: 0\r\n'
+                'Connection: close\r\n\r\n'
+                % self.shed_retry_after).encode('ascii')
+
+    def finish_request(self, request, client_address, accepted_at=None):
+        """
+        Like the standard ``finish_request``, but returns the handler
+        (or None, if a TLS handshake failed).  The handler's
+        ``wsgi_accepted_at`` is set to ``accepted_at``.  A connection
+        coming back from the connection manager has had its handshake
+        already.
+        """
+        if (_is_stdlib_ssl_context(getattr(self, 'ssl_context', None))
+            and not isinstance(getattr(request, 'wsgi_socket', request),
+                               ssl.SSLSocket)):
+            request = self.wsgi_ssl_handshake(request)
+            if request is None:
+                return None
+        return self._make_handler(request, client_address, accepted_at)
+
+    def _make_handler(self, request, client_address, accepted_at):
+        # The handler handles the request as it is created, so this has
+        # to be set before __init__
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.wsgi_accepted_at = accepted_at
+        handler.__init__(request, client_address, self)
+        return handler
 
     def handle_error(self, request, client_address):
         exc_class, exc, tb = sys.exc_info()
@@ -1075,15 +3272,26 @@ class ThreadPoolMixIn(object):
             raise
         return super(ThreadPoolMixIn, self).handle_error(request, client_address)
 
-    def process_request_in_thread(self, request, client_address):
+    def process_request_in_thread(self, request, client_address,
+                                  accepted_at=None):
         """
         The worker thread should call back here to do the rest of the
         request processing. Error handling normaller done in 'handle_request'
         must be done here.
         """
+        if self.expired(accepted_at):
+            self.expire_request(request)
+            return
         try:
-            self.finish_request(request, client_address)
-            self.close_request(request)
+            handler = self.finish_request(
+                request, client_address, accepted_at)
+            if handler is not None:
+                # The TLS handshake replaces the socket
+                request = handler.request
+            if getattr(handler, 'wsgi_parked', False):
+                self.connection_manager.park(request, client_address)
+            else:
+                self.close_request(request)
         except:
             self.handle_error(request, client_address)
             self.close_request(request)
@@ -1091,21 +3299,175 @@ class ThreadPoolMixIn(object):
             if isinstance(exc, (MemoryError, KeyboardInterrupt)):
                 raise
 
+    def drain(self, timeout=None):
+        """
+        Stops ``serve_forever`` gracefully (see the class docstring);
+        ``timeout`` overrides ``stop_timeout``.
+        """
+        if timeout is not None:
+            self.stop_timeout = timeout
+        self.running = False
+        if self.connection_manager is not None:
+            self.connection_manager.wakeup()
+
     def serve_forever(self):
         """
         Overrides `serve_forever` to shut the threadpool down cleanly.
         """
         try:
             while self.running:
+                if self.thread_pool.server_exit is not None:
+                    raise self.thread_pool.server_exit
+                _restart_if_requested(self)
+                if not self.running:
+                    break
                 try:
-                    self.handle_request()
+                    if self.connection_manager is None:
+                        self.handle_request()
+                        self.accept_connections()
+                    elif self.connection_manager.poll(1) and self.running:
+                        self.accept_connections()
                 except socket.timeout:
                     # Timeout is expected, gives interrupts a chance to
                     # propogate, just keep handling
                     pass
+            self.drained_cleanly = self.finish_requests()
         finally:
+            if self.connection_manager is not None:
+                self.connection_manager.close()
             if hasattr(self, 'thread_pool'):
-                self.thread_pool.shutdown()
+                # Workers still busy after an unclean drain are killed,
+                # or the process is ended if they won't die
+                self.thread_pool.shutdown(
+                    self.drained_cleanly is False and 1 or 0)
+
+    def accept_connections(self):
+        """
+        Accepts and processes the connections waiting to be accepted
+        (up to ``accept_batch`` of them), without blocking; returns how
+        many there were.
+        """
+        listener = self.socket
+        try:
+            timeout = listener.gettimeout()
+            if timeout != 0:
+                listener.settimeout(0)
+        except SocketErrors:
+            # Closed by server_close() or a drain in another thread
+            return 0
+        try:
+            for accepted in range(self.accept_batch):
+                try:
+                    request, client_address = self.get_request()
+                except SocketErrors as exce:
+                    code = getattr(exce, 'errno', None)
+                    if (code in (errno.EAGAIN, errno.EWOULDBLOCK)
+                        or code == errno.EBADF or not self.running):
+                        # Nothing more to accept (or no more listening)
+                        return accepted
+                    if code == errno.ECONNABORTED:
+                        # A client that gave up
+                        continue
+                    self.accept_failed(exce)
+                    return accepted
+                if not self.verify_request(request, client_address):
+                    self.shutdown_request(request)
+                    continue
+                try:
+                    self.process_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                    self.shutdown_request(request)
+                except:
+                    self.shutdown_request(request)
+                    raise
+            return self.accept_batch
+        finally:
+            if timeout != 0:
+                try:
+                    listener.settimeout(timeout)
+                except SocketErrors:
+                    pass
+
+    def accept_failed(self, exce):
+        """
+        Called when accepting a connection fails for another reason
+        than there being none to accept, most likely because the
+        process has run out of file descriptors (``EMFILE``) or the
+        system has (``ENFILE``).  The listening socket is still
+        readable then, so instead of trying again right away, this
+        logs the error (at most every ``accept_error_log_interval``
+        seconds) and waits ``accept_error_delay`` seconds, giving
+        requests in progress a chance to finish and close theirs.
+        """
+        now = time.time()
+        if now - self._accept_error_logged > self.accept_error_log_interval:
+            self._accept_error_logged = now
+            self.thread_pool.logger.error(
+                'Error accepting connections (waiting %s seconds before '
+                'trying again): %s', self.accept_error_delay, exce)
+        time.sleep(self.accept_error_delay)
+
+    def finish_requests(self):
+        """
+        Called when ``serve_forever`` has been stopped gracefully: stops
+        accepting connections and waits up to ``stop_timeout`` seconds
+        for the accepted requests to finish.  Returns true if they all
+        did.
+        """
+        deadline = time.time() + self.stop_timeout
+        if self.connection_manager is not None:
+            self.connection_manager.stop_listening()
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+        _remove_unix_socket(self)
+        if self.connection_manager is not None:
+            self.connection_manager.drain()
+        self.close_idle_connections()
+        if self.thread_pool.wait_for_tasks(max(0, deadline - time.time())):
+            return True
+        self.report_unfinished()
+        return False
+
+    def close_idle_connections(self):
+        """
+        Makes the workers waiting for the next request on a keep-alive
+        connection that isn't parked close it, by shutting down the
+        reading side of the connection
+        """
+        with self.idle_lock:
+            idle_connections = list(self.idle_connections)
+        for conn in idle_connections:
+            _shutdown_read(conn)
+
+    def report_unfinished(self):
+        """
+        Logs the requests still queued and running after a drain timed
+        out.
+        """
+        pool = self.thread_pool
+        now = time.time()
+        running = []
+        for thread_id, (time_started, environ) in list(
+                pool.worker_tracker.items()):
+            if time_started is None:
+                # Waiting for a request on a keep-alive connection
+                continue
+            if environ:
+                request = '%s %s%s' % (
+                    environ.get('REQUEST_METHOD'),
+                    environ.get('SCRIPT_NAME', ''),
+                    environ.get('PATH_INFO', ''))
+            else:
+                request = '(no request read yet)'
+            running.append('  thread %s: %s (running for %.1f seconds)'
+                           % (thread_id, request, now - time_started))
+        pool.logger.warning(
+            'Drain did not finish in %s seconds; %s requests queued, '
+            '%s running:\n%s', self.stop_timeout, pool.queue.qsize(),
+            len(running), '\n'.join(running))
 
     def server_activate(self):
         """
@@ -1120,26 +3482,117 @@ class ThreadPoolMixIn(object):
         """
         self.running = False
         self.socket.close()
+        _remove_unix_socket(self)
+        if self.connection_manager is not None:
+            self.connection_manager.close()
         if hasattr(self, 'thread_pool'):
             self.thread_pool.shutdown(60)
 
 class WSGIServerBase(SecureHTTPServer):
+    wsgi_multiprocess = False
+    # A ServerMetrics, if statistics are collected:
+    wsgi_metrics = None
+    # Limits on slow clients (see serve); keepalive_timeout is only used
+    # by the handler when connections aren't parked
+    keepalive_timeout = None
+    wsgi_header_timeout = None
+    wsgi_min_upload_rate = None
+    # Only sets paste.httpserver.deadline without a thread pool
+    max_request_age = None
+    # With a standard library ssl.SSLContext, the seconds a client gets
+    # to complete the TLS handshake (the header_timeout, if any, is used
+    # instead)
+    ssl_handshake_timeout = 10
+    # Set (e.g., by a SIGHUP handler) to have the loop call
+    # restart_server
+    restart_requested = False
+    # The Unix domain socket file to remove when the server is closed
+    # (see _remove_unix_socket)
+    wsgi_unix_socket = None
+
     def __init__(self, wsgi_application, server_address,
                  RequestHandlerClass=None, ssl_context=None,
-                 request_queue_size=None):
+                 request_queue_size=None, listen_socket=None):
+        if not request_queue_size:
+            request_queue_size = _default_backlog()
+        if listen_socket is None and isinstance(server_address, tuple):
+            # HTTPServer only binds IPv4 addresses
+            listen_socket = _bind_socket(server_address, request_queue_size)
         SecureHTTPServer.__init__(self, server_address,
                                   RequestHandlerClass, ssl_context,
-                                  request_queue_size=request_queue_size)
+                                  request_queue_size=request_queue_size,
+                                  listen_socket=listen_socket)
         self.wsgi_application = wsgi_application
         self.wsgi_socket_timeout = None
+        # Connections closed by handlers for being slow, by reason
+        self.wsgi_timeouts = collections.Counter()
 
     def get_request(self):
         # If there is a socket_timeout, set it on the accepted
         (conn,info) = SecureHTTPServer.get_request(self)
         if self.wsgi_socket_timeout:
             conn.settimeout(self.wsgi_socket_timeout)
+        # Responses are written in as few pieces as possible, so there
+        # is no point in Nagle's algorithm delaying small packets
+        if isinstance(info, tuple):
+            try:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except socket.error:
+                pass
         return (conn, info)
 
+    def service_actions(self):
+        """
+        Called by ``serve_forever`` on every trip round its loop
+        """
+        _restart_if_requested(self)
+
+    def server_close(self):
+        SecureHTTPServer.server_close(self)
+        _remove_unix_socket(self)
+
+    def finish_request(self, request, client_address):
+        """
+        Does the TLS handshake first, with a standard library
+        ``ssl.SSLContext`` (see ``wsgi_ssl_handshake``)
+        """
+        if not _is_stdlib_ssl_context(self.ssl_context):
+            return SecureHTTPServer.finish_request(
+                self, request, client_address)
+        request = self.wsgi_ssl_handshake(request)
+        if request is not None:
+            try:
+                self.RequestHandlerClass(request, client_address, self)
+            finally:
+                self.shutdown_request(request)
+
+    def wsgi_ssl_handshake(self, request):
+        """
+        Does the TLS handshake on a newly accepted connection, with the
+        server's ``ssl_context`` (a standard library ``ssl.SSLContext``).
+        This is called in the thread that handles the connection, not
+        the one accepting connections, so a slow handshake doesn't hold
+        up other clients.
+
+        Returns the ``ssl.SSLSocket``, or None (having closed the
+        connection) if the handshake fails or takes longer than
+        ``ssl_handshake_timeout``.
+        """
+        try:
+            request.settimeout(self.wsgi_header_timeout
+                               or self.ssl_handshake_timeout)
+            request = self.ssl_context.wrap_socket(
+                request, server_side=True, do_handshake_on_connect=False)
+            request.do_handshake()
+            request.settimeout(self.wsgi_socket_timeout)
+        except (ssl.SSLError, socket.error) as exc:
+            if isinstance(exc, socket.timeout):
+                with _timeouts_lock:
+                    self.wsgi_timeouts['ssl_handshake_timeout'] += 1
+            self.shutdown_request(request)
+            return None
+        return request
+
 class WSGIServer(ThreadingMixIn, WSGIServerBase):
     daemon_threads = False
 
@@ -1147,13 +3600,24 @@ class WSGIThreadPoolServer(ThreadPoolMixIn, WSGIServerBase):
     def __init__(self, wsgi_application, server_address,
                  RequestHandlerClass=None, ssl_context=None,
                  nworkers=10, daemon_threads=False,
-                 threadpool_options=None, request_queue_size=None):
+                 threadpool_options=None, request_queue_size=None,
+                 park_connections=True, keepalive_timeout=None,
+                 listen_socket=None, max_queue_size=None,
+                 max_queue_wait=None, header_timeout=None,
+                 max_request_age=None):
         WSGIServerBase.__init__(self, wsgi_application, server_address,
                                 RequestHandlerClass, ssl_context,
-                                request_queue_size=request_queue_size)
+                                request_queue_size=request_queue_size,
+                                listen_socket=listen_socket)
         if threadpool_options is None:
             threadpool_options = {}
         ThreadPoolMixIn.__init__(self, nworkers, daemon_threads,
+                                 park_connections=park_connections,
+                                 keepalive_timeout=keepalive_timeout,
+                                 max_queue_size=max_queue_size,
+                                 max_queue_wait=max_queue_wait,
+                                 header_timeout=header_timeout,
+                                 max_request_age=max_request_age,
                                  **threadpool_options)
 
 class ServerExit(SystemExit):
@@ -1162,11 +3626,287 @@ class ServerExit(SystemExit):
     caught)
     """
 
+class PreforkServer(object):
+    """
+    Serves from ``processes`` forked child processes.
+
+    Each child calls ``make_server(listen_socket)`` and runs the
+    ``serve_forever()`` of the server it returns; since servers are
+    only created after forking, every child has its own ThreadPool.
+    Normally all the children accept connections from one listening
+    socket bound by the parent (or inherited, given as
+    ``listen_socket``); with ``reuse_port`` each child binds its own
+    socket with ``SO_REUSEPORT`` instead, and the kernel spreads
+    connections over the children.  The parent still binds the address
+    first (without listening), so a bad address fails before forking,
+    and port 0 is resolved to the one the children then all bind.
+
+    The parent process only supervises: children that die are
+    replaced, and when the parent gets SIGTERM or SIGINT it passes
+    SIGTERM on to the children and waits for them to finish (children
+    drain their requests, see ThreadPoolMixIn).  ``drained_cleanly``
+    is then set to False if any child had to be killed, or exited
+    with a non-zero status.
+    """
+
+    # If a child dies within this many seconds of starting, wait this
+    # long before starting its replacement
+    restart_delay = 1
+    # Seconds to wait for children to stop before killing them
+    stop_timeout = 60
+    # With reuse_port, the parent's socket bound to the address (but
+    # not listening)
+    _reserved_socket = None
+    # Set (e.g., by a SIGHUP handler) to have the loop call
+    # restart_server
+    restart_requested = False
+    # The Unix domain socket file to remove once the children have
+    # stopped (see _remove_unix_socket)
+    wsgi_unix_socket = None
+
+    def __init__(self, make_server, processes, server_address,
+                 request_queue_size=None, reuse_port=False, logger=None,
+                 listen_socket=None):
+        assert hasattr(os, 'fork'), "Pre-forking is not available on this platform"
+        assert processes > 0, "PreforkServer must have at least one process"
+        self.make_server = make_server
+        self.processes = processes
+        self.request_queue_size = request_queue_size
+        self.reuse_port = reuse_port
+        if listen_socket is not None:
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
+        elif reuse_port:
+            self.socket = None
+            self._reserved_socket = _bind_socket(
+                server_address, reuse_port=True, listen=False)
+            self.server_address = self._reserved_socket.getsockname()
+        else:
+            self.socket = _bind_socket(server_address, request_queue_size)
+            self.server_address = self.socket.getsockname()
+        if logger is None:
+            logger = logging.getLogger('paste.httpserver.PreforkServer')
+        self.logger = logger
+        # Maps the pid of each child to the time it was started:
+        self.children = {}
+        self.running = False
+        self.drained_cleanly = None
+
+    def serve_forever(self):
+        """
+        Starts the children, and keeps them running until signalled to
+        stop.
+        """
+        self.running = True
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+        try:
+            while self.running:
+                while self.running and len(self.children) < self.processes:
+                    self.spawn_child()
+                _restart_if_requested(self)
+                try:
+                    # Polled, so that restart_requested is noticed
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError as exce:
+                    if exce.errno == errno.EINTR:
+                        continue
+                    raise
+                if not pid:
+                    time.sleep(0.1)
+                    continue
+                started = self.children.pop(pid, None)
+                if started is None:
+                    continue
+                if not self.running:
+                    if status:
+                        self.drained_cleanly = False
+                    continue
+                self.logger.warning(
+                    'Child process %s exited unexpectedly (status %s); '
+                    'starting a new one', pid, status)
+                if time.time() - started < self.restart_delay:
+                    time.sleep(self.restart_delay)
+        finally:
+            self.stop_children()
+            _remove_unix_socket(self)
+
+    def spawn_child(self):
+        """
+        Forks a child process that serves requests until it gets
+        SIGTERM or SIGINT.
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+        status = 1
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT, _SIGHUP):
+                if signum is not None:
+                    signal.signal(signum, signal.SIG_DFL)
+            listen_socket = self.socket
+            if listen_socket is None:
+                listen_socket = _bind_socket(
+                    self.server_address, self.request_queue_size,
+                    reuse_port=True)
+            server = self.make_server(listen_socket)
+            server.wsgi_multiprocess = True
+            def stop(signum, frame):
+                if hasattr(server, 'drain'):
+                    # ThreadPoolMixIn servers finish what they're doing
+                    server.drain()
+                else:
+                    raise ServerExit(0)
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, stop)
+            server.serve_forever()
+            if getattr(server, 'drained_cleanly', None) is False:
+                status = 1
+            else:
+                status = 0
+        except ServerExit:
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def handle_signal(self, signum, frame):
+        self.logger.info('Got signal %s; stopping child processes', signum)
+        self.running = False
+        self.signal_children(signal.SIGTERM)
+
+    def signal_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                # Already gone
+                pass
+
+    def stop_children(self):
+        """
+        Stops all the children, killing those that haven't exited
+        after ``stop_timeout`` seconds.
+        """
+        self.running = False
+        if self.drained_cleanly is None:
+            self.drained_cleanly = True
+        self.signal_children(signal.SIGTERM)
+        deadline = time.time() + self.stop_timeout
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as exce:
+                if exce.errno == errno.EINTR:
+                    continue
+                # No children left
+                self.children.clear()
+                break
+            if pid:
+                if self.children.pop(pid, None) is not None and status:
+                    self.drained_cleanly = False
+            elif time.time() > deadline:
+                self.logger.warning(
+                    'Killing child processes that did not stop: %s',
+                    ', '.join(map(str, self.children)))
+                self.drained_cleanly = False
+                self.signal_children(signal.SIGKILL)
+                deadline = time.time() + self.stop_timeout
+            else:
+                time.sleep(0.1)
+
+    def server_close(self):
+        """
+        Stops the children and closes the listening socket.
+        """
+        self.stop_children()
+        if self.socket is not None:
+            self.socket.close()
+        _remove_unix_socket(self)
+        if self._reserved_socket is not None:
+            self._reserved_socket.close()
+
+def _restart_if_requested(server):
+    """
+    Calls ``restart_server`` if the server's ``restart_requested`` has
+    been set (by ``serve``'s SIGHUP handler)
+    """
+    if server.restart_requested:
+        server.restart_requested = False
+        restart_server(server)
+
+def restart_server(server, args=None):
+    """
+    Replaces the process serving with ``server`` without refusing any
+    connections: a new process is started with the command line
+    ``args`` (by default the one this process was started with), and
+    given the listening socket the way systemd socket activation does
+    (which ``serve`` picks up).  ``server`` then stops accepting
+    connections, and stops once it has finished the requests it has
+    already accepted.
+
+    This is what ``serve`` does on SIGHUP with ``restart_on_hup``; the
+    signal handler only sets the server's ``restart_requested``, and
+    the server's loop calls this, since forking from a signal handler
+    in a process with threads can deadlock the child.
+
+    The new process is a child of this one.  If this process was
+    started by systemd with a ``NOTIFY_SOCKET`` (e.g., ``Type=simple``
+    or ``Type=exec`` with ``NotifyAccess=main``), systemd is told that
+    the new process is the service's main process (``MAINPID``), so
+    the old one exiting doesn't stop the service.  Without that,
+    systemd (and any supervisor that tracks the process it started)
+    takes the old process exiting for the service stopping;
+    ``Type=forking`` and ``Type=notify`` services are not supported.
+    """
+    if args is None:
+        args = [sys.executable] + sys.argv
+    listen_socket = getattr(server, 'socket', None)
+    # The new process serves from the same socket file
+    server.wsgi_unix_socket = None
+    pid = os.fork()
+    if not pid:
+        try:
+            env = dict(os.environ)
+            if listen_socket is not None:
+                # A PreforkServer with reuse_port has no socket; the new
+                # children just bind their own next to the old ones
+                fd = listen_socket.fileno()
+                if fd == SD_LISTEN_FDS_START:
+                    if hasattr(os, 'set_inheritable'):
+                        os.set_inheritable(fd, True)
+                else:
+                    os.dup2(fd, SD_LISTEN_FDS_START)
+                env['LISTEN_FDS'] = '1'
+                env['LISTEN_PID'] = str(os.getpid())
+                env.pop('LISTEN_FDNAMES', None)
+            os.execve(args[0], args, env)
+        finally:
+            os._exit(127)
+    _notify_systemd('MAINPID=%d' % pid)
+    if isinstance(server, PreforkServer):
+        server.handle_signal(_SIGHUP, None)
+    elif hasattr(server, 'drain'):
+        # ThreadPoolMixIn servers finish what they're doing
+        server.drain()
+    else:
+        # WSGIServer threads are waited for as the process exits
+        raise ServerExit(0)
+    return pid
+
 def serve(application, host=None, port=None, handler=None, ssl_pem=None,
           ssl_context=None, server_version=None, protocol_version=None,
           start_loop=True, daemon_threads=None, socket_timeout=None,
           use_threadpool=None, threadpool_workers=10,
-          threadpool_options=None, request_queue_size=5):
+          threadpool_options=None, request_queue_size=None,
+          park_connections=True, keepalive_timeout=None,
+          processes=None, reuse_port=False, max_queue_size=None,
+          max_queue_wait=None, metrics_path=None, listen_fd=None,
+          restart_on_hup=False, drain_timeout=None, engine=None,
+          header_timeout=None, min_upload_rate=None, socket_mode=None,
+          max_request_age=None):
     """
     Serves your ``application`` over HTTP(S) via WSGI interface
 
@@ -1174,13 +3914,31 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
 
         This is the ipaddress to bind to (or a hostname if your
         nameserver is properly configured).  This defaults to
-        127.0.0.1, which is not a public interface.
+        127.0.0.1, which is not a public interface.  IPv6 addresses
+        (e.g. ``::1``) work too; a host name that has both kinds of
+        address is bound to its IPv4 one.
+
+        With ``unix:/path/to/socket``, the server listens on a Unix
+        domain socket instead (``port`` is ignored), e.g., for a
+        front-end proxy on the same host.  ``SERVER_NAME`` and
+        ``SERVER_PORT`` then come from the ``Host`` header, and
+        ``REMOTE_ADDR`` is ``127.0.0.1``.
 
     ``port``
 
         The port to run on, defaults to 8080 for HTTP, or 4443 for
         HTTPS. This can be a string or an integer value.
 
+    ``socket_mode``
+
+        The permissions of the socket file of a ``unix:`` ``host``, as
+        an integer or an octal string (e.g., ``'660'``, to let the
+        proxy connect through its group).  By default the umask
+        decides.  A socket file left behind by an earlier server is
+        replaced, and the socket file is removed again when the server
+        is closed (or has drained).  ``reuse_port`` can't be used with
+        a Unix domain socket.
+
     ``handler``
 
         This is the HTTP request handler to use, it defaults to
@@ -1188,8 +3946,12 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
 
     ``ssl_pem``
 
-        This an optional SSL certificate file (via OpenSSL). You can
-        supply ``*`` and a development-only certificate will be
+        This an optional SSL certificate file, holding the certificate
+        (chain) and private key, used with the standard ``ssl`` module.
+        Session resumption (a session cache, and session tickets) and
+        ALPN are enabled, and the TLS handshake is done by the thread
+        that then handles the connection.  With pyOpenSSL installed,
+        you can supply ``*`` and a development-only certificate will be
         created for you, or you can generate a self-signed test PEM
         certificate file as follows::
 
@@ -1205,7 +3967,8 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
         This an optional SSL context object for the server.  A SSL
         context will be automatically constructed for you if you supply
         ``ssl_pem``.  Supply this to use a context of your own
-        construction.
+        construction: an ``ssl.SSLContext``, or a pyOpenSSL
+        ``OpenSSL.SSL.Context`` (not with the ``asyncio`` engine).
 
     ``server_version``
 
@@ -1218,12 +3981,19 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
         This sets the protocol used by the server, by default
         ``HTTP/1.0``. There is some support for ``HTTP/1.1``, which
         defaults to nicer keep-alive connections.  This server supports
-        ``100 Continue``, but does not yet support HTTP/1.1 Chunked
-        Encoding. Hence, if you use HTTP/1.1, you're somewhat in error
-        since chunked coding is a mandatory requirement of a HTTP/1.1
-        server.  If you specify HTTP/1.1, every response *must* have a
-        ``Content-Length`` and you must be careful not to read past the
-        end of the socket.
+        ``100 Continue``, and with ``HTTP/1.1`` clients responses
+        without a ``Content-Length`` are sent with chunked
+        transfer-coding, so the connection can be kept open; trailer
+        fields can be sent by adding ``(name, value)`` pairs to the
+        ``environ['paste.httpserver.trailers']`` list before the
+        response body is finished.  Request bodies sent with chunked
+        transfer-coding are decoded as they are read (there is no
+        ``CONTENT_LENGTH`` for them).  ``environ['wsgi.input_terminated']``
+        is true when reading ``wsgi.input`` returns ``b''`` at the end
+        of the body, whether it is chunked or has a ``Content-Length``,
+        so an application can read it to the end; otherwise (e.g., with
+        pyOpenSSL) you must be careful not to read past
+        ``CONTENT_LENGTH``.
 
     ``start_loop``
 
@@ -1266,29 +4036,191 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
     ``request_queue_size``
 
         The 'backlog' argument to socket.listen(); specifies the
-        maximum number of queued connections.
+        maximum number of queued connections.  This defaults to as
+        many as the system allows (``net.core.somaxconn`` on Linux).
+
+    ``park_connections``
+
+        When using the threadpool, wait for requests (and for the next
+        request on idle ``HTTP/1.1`` keep-alive connections) in the
+        thread accepting connections, instead of in a worker thread.
+        Worker threads are then only busy while actually handling a
+        request, so many idle clients don't exhaust the pool.  This
+        defaults to ``True``, but needs the ``selectors`` module
+        (Python 3.4+).  With SSL, a new connection goes to a worker
+        right away for its TLS handshake, and is parked between
+        requests after that (but not with a pyOpenSSL context).
+
+    ``keepalive_timeout``
+
+        The number of seconds a connection may sit idle between
+        requests before the server closes it.  This can be a string or
+        an integer value; the default is to keep idle connections open
+        (unless ``socket_timeout`` closes them).
+
+    ``header_timeout``
+
+        The number of seconds a client gets to send a complete request
+        head, counted from when the connection is accepted (or, for
+        the next request on a keep-alive connection, from its first
+        byte).  Slower clients are disconnected, without a worker
+        thread waiting for them if connections are parked.  This can
+        be a string or a number.
+
+    ``min_upload_rate``
+
+        The minimum rate, in bytes per second, at which a request body
+        has to arrive once it has had a few seconds (the handler's
+        ``upload_grace_period``) to start.  Reading the body of a
+        slower upload raises ``socket.timeout`` in the application,
+        and the connection is closed after the response, so stuck
+        uploads don't hold on to worker threads.  This can be a string
+        or a number.
+
+        Connections closed because of these timeouts are counted by
+        reason in the server's ``wsgi_timeouts`` (and the connection
+        manager's ``dropped``), which the metrics report.
+
+    ``processes``
+
+        Fork this many processes to serve requests (each with its own
+        thread pool, if ``use_threadpool`` is true), so that
+        applications can use more than one CPU.  The parent process
+        restarts children that die, and stops them when it gets
+        SIGTERM or SIGINT.  This can be a string or an integer value.
+        Only available on Unix.
+
+    ``reuse_port``
+
+        With ``processes``, have each process bind its own listening
+        socket using ``SO_REUSEPORT`` (where the operating system
+        supports it), instead of all of them sharing one socket.
+
+    ``max_queue_size``
+
+        When using the threadpool, answer new requests with ``503
+        Service Unavailable`` (and ``Retry-After``) right away while
+        this many requests are already waiting for a worker thread,
+        instead of letting them wait until the client gives up.  This
+        can be a string or an integer value; the default is no limit.
+
+    ``max_queue_wait``
+
+        Like ``max_queue_size``, but sheds requests while the oldest
+        queued request has been waiting more than this many seconds.
+        This can be a string or a number.
+
+    ``max_request_age``
+
+        Requests that have waited more than this many seconds for a
+        worker thread are answered with a 503 instead of being run,
+        since the client has most likely given up on them by then.
+        The application finds the time the request was queued in
+        ``environ['paste.httpserver.accepted_at']``, and the time
+        after which its work is probably wasted in
+        ``environ['paste.httpserver.deadline']``, e.g., to give
+        backend calls a timeout.  This can be a string or a number.
+
+    ``metrics_path``
+
+        Collect statistics about requests, the thread pool and
+        connections, and report them in the Prometheus text format at
+        this path (e.g. ``/_metrics``), which is then not passed on to
+        the application.  See ``ServerMetrics``.
+
+        With ``processes``, each process reports only its own
+        statistics, labelled with its ``pid``, and a scrape gets
+        whichever process accepted it; they are not added up across
+        processes.
+
+    ``listen_fd``
+
+        Serve from the already listening socket with this file
+        descriptor (inherited from the parent process), instead of
+        binding to ``host`` and ``port``.  If this process was started
+        with systemd socket activation (``LISTEN_FDS``), the first
+        socket passed is used by default.
+
+    ``restart_on_hup``
+
+        On SIGHUP, start a new copy of this process (with the same
+        command line), hand it the listening socket, and exit once the
+        requests that have been accepted are finished; so a new
+        version of the application can be deployed without any
+        connection being refused.  See ``restart_server``.  Only
+        available on Unix.  The new process is a child of the old
+        one; under systemd, use ``Type=simple`` (or ``exec``) with
+        ``NotifyAccess=main``, so the old process can tell systemd
+        which process to follow.
+
+    ``drain_timeout``
+
+        On SIGTERM, stop accepting connections, close idle ones, and
+        give the requests already accepted up to this many seconds to
+        finish before exiting (with the threadpool; see
+        ``ThreadPoolMixIn.drain``).  Requests still running then are
+        logged, and the process exits with status 1 instead of 0, so
+        whatever supervises it can tell the drain was not clean.  This
+        is also how long the old process drains with
+        ``restart_on_hup`` (60 seconds by default).
+
+    ``engine``
+
+        With ``'asyncio'``, connections are handled on an ``asyncio``
+        event loop, and only requests are run by the threadpool, so
+        many idle or slow clients don't need a thread each (Python 3
+        only; see ``paste.asyncserver``).  The threadpool options
+        apply as usual.
 
     """
     is_ssl = False
+    assert engine in (None, 'threads', 'asyncio'), (
+        "Unknown engine: %r" % engine)
     if ssl_pem or ssl_context:
-        assert SSL, "pyOpenSSL is not installed"
         is_ssl = True
         port = int(port or 4443)
         if not ssl_context:
             if ssl_pem == '*':
+                assert SSL and engine != 'asyncio', (
+                    "ssl_pem='*' needs pyOpenSSL")
                 ssl_context = _auto_ssl_context()
             else:
-                ssl_context = SSL.Context(SSL.SSLv23_METHOD)
-                ssl_context.use_privatekey_file(ssl_pem)
-                ssl_context.use_certificate_chain_file(ssl_pem)
+                assert ssl, "The ssl module is not available"
+                ssl_context = _ssl_context_from_pem(ssl_pem)
+        elif not _is_stdlib_ssl_context(ssl_context):
+            assert SSL and engine != 'asyncio', (
+                "ssl_context should be an ssl.SSLContext")
 
     host = host or '127.0.0.1'
-    if port is None:
-        if ':' in host:
-            host, port = host.split(':', 1)
-        else:
-            port = 8080
-    server_address = (host, int(port))
+    unix_path = None
+    if host.startswith('unix:'):
+        unix_path = host[len('unix:'):]
+        server_address = unix_path
+        assert not converters.asbool(reuse_port), (
+            "reuse_port can't be used with a unix: host (the processes "
+            "share the one socket file)")
+    else:
+        if port is None:
+            if host.count(':') == 1:
+                host, port = host.split(':', 1)
+            else:
+                port = 8080
+        server_address = (host, int(port))
+
+    listen_socket = None
+    unix_socket_file = None
+    if listen_fd is None:
+        listen_fds = _systemd_listen_fds()
+        if listen_fds:
+            listen_fd = listen_fds[0]
+    if listen_fd is not None:
+        listen_socket = _socket_from_fd(int(listen_fd))
+    elif unix_path is not None:
+        if isinstance(socket_mode, six.string_types):
+            socket_mode = int(socket_mode, 8)
+        listen_socket = _bind_unix_socket(
+            unix_path, request_queue_size, socket_mode)
+        unix_socket_file = _unix_socket_file(unix_path)
 
     if not handler:
         handler = WSGIHandler
@@ -1302,34 +4234,112 @@ def serve(application, host=None, port=None, handler=None, ssl_pem=None,
     if use_threadpool is None:
         use_threadpool = True
 
-    if converters.asbool(use_threadpool):
-        server = WSGIThreadPoolServer(application, server_address, handler,
-                                      ssl_context, int(threadpool_workers),
-                                      daemon_threads,
-                                      threadpool_options=threadpool_options,
-                                      request_queue_size=request_queue_size)
+    if keepalive_timeout:
+        keepalive_timeout = int(keepalive_timeout)
+    if header_timeout:
+        header_timeout = float(header_timeout)
+    if max_queue_size:
+        max_queue_size = int(max_queue_size)
+    if max_queue_wait:
+        max_queue_wait = float(max_queue_wait)
+    if max_request_age:
+        max_request_age = float(max_request_age)
+
+    def make_server(listen_socket=listen_socket):
+        if engine == 'asyncio':
+            from paste.asyncserver import AsyncioWSGIServer
+            server = AsyncioWSGIServer(
+                application, server_address, handler, ssl_context,
+                int(threadpool_workers), daemon_threads,
+                threadpool_options=threadpool_options,
+                request_queue_size=request_queue_size,
+                park_connections=park_connections,
+                keepalive_timeout=keepalive_timeout,
+                listen_socket=listen_socket,
+                max_queue_size=max_queue_size,
+                max_queue_wait=max_queue_wait,
+                header_timeout=header_timeout,
+                max_request_age=max_request_age)
+        elif converters.asbool(use_threadpool):
+            server = WSGIThreadPoolServer(
+                application, server_address, handler, ssl_context,
+                int(threadpool_workers), daemon_threads,
+                threadpool_options=threadpool_options,
+                request_queue_size=request_queue_size,
+                park_connections=park_connections,
+                keepalive_timeout=keepalive_timeout,
+                listen_socket=listen_socket,
+                max_queue_size=max_queue_size,
+                max_queue_wait=max_queue_wait,
+                header_timeout=header_timeout,
+                max_request_age=max_request_age)
+        else:
+            server = WSGIServer(application, server_address, handler,
+                                ssl_context,
+                                request_queue_size=request_queue_size,
+                                listen_socket=listen_socket)
+            if daemon_threads:
+                server.daemon_threads = daemon_threads
+            server.keepalive_timeout = keepalive_timeout
+            server.wsgi_header_timeout = header_timeout
+            server.max_request_age = max_request_age
+        if socket_timeout:
+            server.wsgi_socket_timeout = int(socket_timeout)
+        if min_upload_rate:
+            server.wsgi_min_upload_rate = float(min_upload_rate)
+        if metrics_path:
+            server.wsgi_metrics = ServerMetrics(server, metrics_path)
+        if drain_timeout is not None:
+            server.stop_timeout = drain_timeout
+        return server
+
+    if drain_timeout is not None:
+        drain_timeout = float(drain_timeout)
+
+    if processes and int(processes) > 1:
+        server = PreforkServer(make_server, int(processes), server_address,
+                               request_queue_size=request_queue_size,
+                               reuse_port=converters.asbool(reuse_port),
+                               listen_socket=listen_socket)
+        if drain_timeout is not None:
+            # Leave the children time to shut their thread pools down
+            server.stop_timeout = drain_timeout + 10
     else:
-        server = WSGIServer(application, server_address, handler, ssl_context,
-                            request_queue_size=request_queue_size)
-        if daemon_threads:
-            server.daemon_threads = daemon_threads
-
-    if socket_timeout:
-        server.wsgi_socket_timeout = int(socket_timeout)
+        server = make_server()
+        if drain_timeout is not None and hasattr(server, 'drain'):
+            signal.signal(signal.SIGTERM,
+                          lambda signum, frame: server.drain())
+    # Removed when the server is closed (not by the children of a
+    # PreforkServer, nor after handing the socket on to a new process)
+    server.wsgi_unix_socket = unix_socket_file
+
+    if converters.asbool(restart_on_hup):
+        assert _SIGHUP is not None, "restart_on_hup needs SIGHUP"
+        def request_restart(signum, frame):
+            # The server's loop does the restart (see restart_server)
+            server.restart_requested = True
+        signal.signal(_SIGHUP, request_restart)
 
     if converters.asbool(start_loop):
         protocol = is_ssl and 'https' or 'http'
-        host, port = server.server_address[:2]
-        if host == '0.0.0.0':
-            print('serving on 0.0.0.0:%s view at %s://127.0.0.1:%s'
-                  % (port, protocol, port))
+        if not isinstance(server.server_address, tuple):
+            print("serving on %s://unix:%s"
+                  % (protocol, server.server_address))
         else:
-            print("serving on %s://%s:%s" % (protocol, host, port))
+            host, port = server.server_address[:2]
+            if host == '0.0.0.0':
+                print('serving on 0.0.0.0:%s view at %s://127.0.0.1:%s'
+                      % (port, protocol, port))
+            else:
+                print("serving on %s://%s:%s" % (protocol, host, port))
         try:
             server.serve_forever()
         except KeyboardInterrupt:
             # allow CTRL+C to shutdown
             pass
+        _remove_unix_socket(server)
+        if getattr(server, 'drained_cleanly', None) is False:
+            raise ServerExit(1)
     return server
 
 # For paste.deploy server instantiation (egg:Paste#http)
@@ -1343,14 +4353,24 @@ def server_runner(wsgi_app, global_conf, **kwargs):
                  'threadpool_dying_limit', 'threadpool_spawn_if_under',
                  'threadpool_max_zombie_threads_before_die',
                  'threadpool_hung_check_period',
-                 'threadpool_max_requests', 'request_queue_size']:
+                 'threadpool_max_requests', 'request_queue_size',
+                 'threadpool_min_workers', 'threadpool_max_workers',
+                 'threadpool_scale_down_delay',
+                 'keepalive_timeout', 'processes', 'max_queue_size',
+                 'listen_fd', 'drain_timeout']:
         if name in kwargs:
             kwargs[name] = int(kwargs[name])
-    for name in ['use_threadpool', 'daemon_threads']:
+    for name in ['threadpool_supervisor_period', 'max_queue_wait',
+                 'threadpool_scale_up_wait', 'header_timeout',
+                 'min_upload_rate', 'max_request_age']:
+        if name in kwargs:
+            kwargs[name] = float(kwargs[name])
+    for name in ['use_threadpool', 'daemon_threads', 'park_connections',
+                 'reuse_port', 'restart_on_hup']:
         if name in kwargs:
             kwargs[name] = asbool(kwargs[name])
     threadpool_options = {}
-    for name, value in kwargs.items():
+    for name, value in list(kwargs.items()):
         if name.startswith('threadpool_') and name != 'threadpool_workers':
             threadpool_options[name[len('threadpool_'):]] = value
             del kwargs[name]
@@ -1411,6 +4431,35 @@ server_runner.__doc__ = (serve.__doc__ or '') + """
         or for zombie threads that should cause a restart.  Default 100
         requests.
 
+    ``threadpool_supervisor_period``:
+
+        The number of seconds between runs of the supervisor thread,
+        which checks for hung threads and adds or removes workers (so
+        that this isn't done while accepting requests).  It also runs
+        as soon as a request finds no idle worker.  Default 1 second.
+
+    ``threadpool_max_workers``:
+
+        Autoscale the pool up to this many worker threads, growing it
+        when requests have to wait for a worker and shrinking it again
+        when it is under-used (``threadpool_spawn_if_under`` is then
+        not used).  Default None (no autoscaling).
+
+    ``threadpool_min_workers``:
+
+        When autoscaling, never shrink the pool below this many
+        workers.  Defaults to ``threadpool_workers``.
+
+    ``threadpool_scale_up_wait``:
+
+        When autoscaling, add workers once a request has waited this
+        many seconds for a worker.  Default 0.1 seconds.
+
+    ``threadpool_scale_down_delay``:
+
+        When autoscaling, remove workers only after the pool has been
+        under-used for this many seconds.  Default 60 seconds.
+
     ``threadpool_logger``:
 
         Logging messages will go the logger named here.
@@ -9,6 +9,7 @@ import six
 import sys
 import imp
 import mimetypes
+from stat import S_ISDIR
 try:
     import pkg_resources
 except ImportError:
@@ -423,14 +424,44 @@ class StaticURLParser(object):
 
     ``cache_max_age``:
       integer specifies Cache-Control max_age in seconds
+
+    ``file_cache``:
+      a ``paste.fileapp.FileCache`` to look up and open files with
+
+    ``content_cache``:
+      a ``paste.fileapp.ContentCache`` to keep file contents in
+
+    ``use_mmap``:
+      send files from shared memory mappings (see ``paste.fileapp.FileApp``);
+      files must then be replaced rather than rewritten in place
+
+    ``precompressed``:
+      send precompressed copies of files (``app.js.gz`` for ``app.js``)
+      to clients that accept them (see ``paste.fileapp.FileApp``)
+
+    ``buffers``:
+      send memoryviews instead of copies to servers that accept them
+      (see ``paste.fileapp.FileApp``)
     """
     # @@: Should URLParser subclass from this?
 
+    file_cache = None
+    content_cache = None
+    use_mmap = False
+    precompressed = False
+    buffers = False
+
     def __init__(self, directory, root_directory=None,
-                 cache_max_age=None):
+                 cache_max_age=None, file_cache=None, content_cache=None,
+                 use_mmap=False, precompressed=False, buffers=False):
         self.directory = self.normpath(directory)
         self.root_directory = self.normpath(root_directory or directory)
         self.cache_max_age = cache_max_age
+        self.file_cache = file_cache
+        self.content_cache = content_cache
+        self.use_mmap = use_mmap
+        self.precompressed = precompressed
+        self.buffers = buffers
 
     def normpath(path):
         return os.path.normcase(os.path.abspath(path))
@@ -449,18 +480,28 @@ class StaticURLParser(object):
         if not full.startswith(self.root_directory):
             # Out of bounds
             return self.not_found(environ, start_response)
-        if not os.path.exists(full):
+        try:
+            if self.file_cache is not None:
+                stat = self.file_cache.stat(full)
+            else:
+                stat = os.stat(full)
+        except OSError:
             return self.not_found(environ, start_response)
-        if os.path.isdir(full):
+        if S_ISDIR(stat.st_mode):
             # @@: Cache?
             return self.__class__(full, root_directory=self.root_directory,
-                                  cache_max_age=self.cache_max_age)(environ,
-                                                                   start_response)
+                                  cache_max_age=self.cache_max_age,
+                                  file_cache=self.file_cache,
+                                  content_cache=self.content_cache,
+                                  use_mmap=self.use_mmap,
+                                  precompressed=self.precompressed,
+                                  buffers=self.buffers)(
+                                      environ, start_response)
         if environ.get('PATH_INFO') and environ.get('PATH_INFO') != '/':
             return self.error_extra_path(environ, start_response)
         if_none_match = environ.get('HTTP_IF_NONE_MATCH')
         if if_none_match:
-            mytime = os.stat(full).st_mtime
+            mytime = stat.st_mtime
             if str(mytime) == if_none_match:
                 headers = []
                 ## FIXME: probably should be
@@ -475,7 +516,11 @@ class StaticURLParser(object):
         return fa(environ, start_response)
 
     def make_app(self, filename):
-        return fileapp.FileApp(filename)
+        return fileapp.FileApp(filename, file_cache=self.file_cache,
+                               content_cache=self.content_cache,
+                               use_mmap=self.use_mmap,
+                               precompressed=self.precompressed,
+                               buffers=self.buffers)
 
     def add_slash(self, environ, start_response):
         """
@@ -509,17 +554,59 @@ class StaticURLParser(object):
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, self.directory)
 
-def make_static(global_conf, document_root, cache_max_age=None):
+def make_static(global_conf, document_root, cache_max_age=None,
+                file_cache_entries=None, file_cache_ttl=None,
+                content_cache_size=None, use_mmap=False,
+                precompressed=False, buffers=False):
     """
     Return a WSGI application that serves a directory (configured
     with document_root)
 
     cache_max_age - integer specifies CACHE_CONTROL max_age in seconds
+
+    file_cache_entries, file_cache_ttl - if either is given, stat
+    results and open files are cached (see paste.fileapp.FileCache)
+
+    content_cache_size - if given, file contents are kept in memory, up
+    to this many bytes (see paste.fileapp.ContentCache)
+
+    use_mmap - send files from shared memory mappings, where the server
+    doesn't send them with sendfile; files must then be replaced (e.g.,
+    by renaming a new file over them), as rewriting one in place while
+    it is being sent can crash the process
+
+    precompressed - send precompressed copies of files (.br, .zst or
+    .gz next to them) to clients that accept them; true, or a list of
+    the content-codings to look for
+
+    buffers - send memoryviews of cached contents and mapped files
+    instead of copies, to servers that accept them (paste.httpserver
+    does); only for when no middleware looks at the response body
     """
     if cache_max_age is not None:
         cache_max_age = int(cache_max_age)
+    file_cache = None
+    if file_cache_entries or file_cache_ttl:
+        file_cache = fileapp.FileCache(
+            max_entries=int(file_cache_entries or 1024),
+            ttl=float(file_cache_ttl or 1))
+    content_cache = None
+    if content_cache_size:
+        content_cache = fileapp.ContentCache(int(content_cache_size))
     return StaticURLParser(
-        document_root, cache_max_age=cache_max_age)
+        document_root, cache_max_age=cache_max_age, file_cache=file_cache,
+        content_cache=content_cache,
+        use_mmap=converters.asbool(use_mmap),
+        precompressed=_precompressed_option(precompressed),
+        buffers=converters.asbool(buffers))
+
+def _precompressed_option(value):
+    if isinstance(value, six.string_types):
+        try:
+            return converters.asbool(value)
+        except ValueError:
+            return converters.aslist(value, ',', strip=True)
+    return value
 
 class PkgResourcesParser(StaticURLParser):
 
@@ -0,0 +1,87 @@
+"""
+Microbenchmarks for paste.httpserver
+
+Run with ``python tests/bench_httpserver.py``.  This compares going from
+a request head to a WSGI environment with ``WSGIHandler`` (which parses
+the head itself) and with the ``parse_request`` of the standard
+library's ``BaseHTTPRequestHandler``, which ``WSGIHandlerMixin`` falls
+back to for other handlers.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from six import BytesIO
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler
+from paste.httpserver import WSGIHandler, WSGIHandlerMixin
+
+BROWSER_REQUEST = (
+    b'GET /static/js/app.js?v=1234 HTTP/1.1\r\n'
+    b'Host: www.example.com\r\n'
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n'
+    b'Accept: */*\r\n'
+    b'Accept-Language: en-US,en;q=0.5\r\n'
+    b'Accept-Encoding: gzip, deflate, br\r\n'
+    b'Referer: https://www.example.com/\r\n'
+    b'Cookie: session=0123456789abcdef; theme=dark\r\n'
+    b'Connection: keep-alive\r\n'
+    b'\r\n')
+
+REPEATED_HEADERS_REQUEST = (
+    b'POST /api/items/../items/42 HTTP/1.1\r\n'
+    b'Host: api.example.com\r\n'
+    b'Content-Type: application/json\r\n'
+    b'Content-Length: 2\r\n'
+    + b''.join(b'X-Forwarded-For: 10.0.0.%d\r\n' % i for i in range(40))
+    + b''.join(b'X-Trace-%d: abc\r\n' % i for i in range(40))
+    + b'\r\n{}')
+
+
+class StdlibHandler(WSGIHandlerMixin, BaseHTTPRequestHandler):
+    """
+    WSGIHandlerMixin on the standard library's request parsing
+    """
+
+
+class MockServer(object):
+    server_address = ('127.0.0.1', 80)
+
+
+def make_handler(handler_class, data):
+    # Skip the socket setup done by the constructor
+    handler = handler_class.__new__(handler_class)
+    handler.server = MockServer()
+    handler.client_address = ('127.0.0.1', 54321)
+    handler.connection = None
+    handler.protocol_version = 'HTTP/1.1'
+    handler.rfile = BytesIO(data)
+    handler.wfile = BytesIO()
+    return handler
+
+
+def build_environ(handler_class, data):
+    handler = make_handler(handler_class, data)
+    handler.raw_requestline = handler.rfile.readline(65537)
+    assert handler.parse_request()
+    handler.wsgi_setup()
+    return handler.wsgi_environ
+
+
+def main(number=10000):
+    for request_name, data in [('browser request', BROWSER_REQUEST),
+                               ('80 header fields', REPEATED_HEADERS_REQUEST)]:
+        print('%s:' % request_name)
+        for name, handler_class in [('BaseHTTPRequestHandler', StdlibHandler),
+                                    ('WSGIHandler', WSGIHandler)]:
+            timing = min(timeit.repeat(
+                lambda: build_environ(handler_class, data),
+                number=number, repeat=3))
+            print('  %-24s %7.2f usec/request'
+                  % (name, timing / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
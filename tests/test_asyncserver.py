@@ -0,0 +1,219 @@
+import shutil
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+if sys.version_info < (3, 4):
+    pytest.skip("asyncio needs Python 3.4", allow_module_level=True)
+
+from .test_httpserver import (
+    _UploadHandler, _closed, _get, _hello_app, _make_pem, _read_until, _serve)
+
+
+def _echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'got ', body]
+
+
+def test_keepalive_and_pipelining():
+    server = _serve(_hello_app, engine='asyncio')
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        assert _get(sock, '/a').endswith(b'hello /a')
+        assert _get(sock, '/b').endswith(b'hello /b')
+        sock.sendall(b'GET /c HTTP/1.1\r\nHost: x\r\n\r\n'
+                     b'GET /d HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = _read_until(sock, b'hello /d')
+        assert data.count(b'HTTP/1.1 200 OK') == 2
+        assert data.index(b'hello /c') < data.index(b'hello /d')
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def test_request_body_and_chunked_response():
+    server = _serve(_echo_app, engine='asyncio')
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        body = b'x' * 100000
+        sock.sendall(b'POST / HTTP/1.1\r\nHost: x\r\n'
+                     b'Content-Length: 100000\r\n\r\n' + body)
+        data = _read_until(sock, b'\r\n0\r\n\r\n')
+        assert b'Transfer-Encoding: chunked' in data
+        assert b'\r\n4\r\ngot \r\n186a0\r\n' + body + b'\r\n' in data
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def test_long_request_body_line():
+    # A line longer than the connection buffers doesn't stall reading
+    def app(environ, start_response):
+        size = 0
+        while True:
+            line = environ['wsgi.input'].readline()
+            if not line:
+                break
+            size += len(line)
+        body = str(size).encode('ascii')
+        start_response('200 OK', [('Content-Length', str(len(body)))])
+        return [body]
+
+    server = _serve(app, engine='asyncio')
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'POST / HTTP/1.1\r\nHost: x\r\n'
+                     b'Content-Length: 1000000\r\n\r\n' + b'x' * 1000000)
+        assert _read_until(sock, b'\r\n\r\n1000000')
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def test_chunked_request():
+    server = _serve(_echo_app, engine='asyncio')
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'POST / HTTP/1.1\r\nHost: x\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n'
+                     b'3\r\nabc\r\n4\r\ndefg\r\n0\r\n\r\n'
+                     b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = _read_until(sock, b'\r\n4\r\ngot \r\n0\r\n\r\n')
+        assert b'\r\n7\r\nabcdefg\r\n' in data
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def test_idle_connections_need_no_worker():
+    server = _serve(_hello_app, engine='asyncio', threadpool_workers=2,
+                    threadpool_options={'spawn_if_under': 0})
+    idle = []
+    try:
+        for i in range(50):
+            idle.append(socket.create_connection(server.server_address, 5))
+        # Half a request head doesn't hold on to a worker either
+        for sock in idle[:10]:
+            sock.sendall(b'GET /slow HTTP/1.1\r\n')
+        sock = socket.create_connection(server.server_address, 5)
+        assert _get(sock, '/').endswith(b'hello /')
+        sock.close()
+        assert len(server.thread_pool.workers) == 2
+        idle[0].sendall(b'Host: x\r\n\r\n')
+        assert _read_until(idle[0], b'hello /slow').endswith(b'hello /slow')
+    finally:
+        for sock in idle:
+            sock.close()
+        server.server_close()
+
+
+def test_slow_clients():
+    def app(environ, start_response):
+        try:
+            body = environ['wsgi.input'].read()
+        except socket.timeout:
+            body = b'timeout'
+        start_response('200 OK', [('Content-Length', str(len(body)))])
+        return [body]
+
+    server = _serve(app, engine='asyncio', handler=_UploadHandler,
+                    header_timeout=0.5, keepalive_timeout=1,
+                    min_upload_rate=1000)
+    try:
+        slow = socket.create_connection(server.server_address, 5)
+        slow.sendall(b'GET / HTTP/1.1\r\n')
+        upload = socket.create_connection(server.server_address, 5)
+        upload.sendall(b'POST / HTTP/1.1\r\nHost: x\r\n'
+                       b'Content-Length: 2000\r\n\r\n' + b'x' * 1000)
+        assert _closed(slow)
+        assert _read_until(upload, b'\r\n\r\ntimeout')
+        assert _closed(upload)
+        assert server.wsgi_timeouts == {'header_timeout': 1,
+                                        'min_upload_rate': 1}
+    finally:
+        server.server_close()
+
+
+def test_ssl():
+    def app(environ, start_response):
+        body = ('%s %s' % (environ['wsgi.url_scheme'],
+                           environ['paste.httpserver.alpn_protocol']))
+        body = body.encode('ascii')
+        start_response('200 OK', [('Content-Length', str(len(body)))])
+        return [body]
+
+    directory = tempfile.mkdtemp()
+    server = _serve(app, engine='asyncio', ssl_pem=_make_pem(directory))
+    try:
+        client = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        client.check_hostname = False
+        client.verify_mode = ssl.CERT_NONE
+        client.set_alpn_protocols(['http/1.1'])
+        sock = client.wrap_socket(
+            socket.create_connection(server.server_address, 5))
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert _read_until(sock, b'https http/1.1')
+        sock.close()
+    finally:
+        server.server_close()
+        shutil.rmtree(directory)
+
+
+def test_bad_request():
+    server = _serve(_hello_app, engine='asyncio')
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'GET / HTTP/2.0\r\n\r\n')
+        data = b''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        assert data.startswith(b'HTTP/1.1 505 ')
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def test_write_backpressure():
+    chunk = b'x' * 16384
+    loop_blocked = threading.Event()
+    yielded = []
+
+    def block_loop():
+        loop_blocked.set()
+        time.sleep(0.5)
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', str(len(chunk) * 64))])
+        server.loop.call_soon_threadsafe(block_loop)
+        loop_blocked.wait(5)
+        for i in range(64):
+            yielded.append(i)
+            yield memoryview(chunk)
+
+    server = _serve(app, engine='asyncio')
+    server.write_buffer_size = 65536
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert loop_blocked.wait(5)
+        time.sleep(0.3)
+        # While the event loop is busy, the worker only gets to queue
+        # about write_buffer_size bytes
+        assert len(yielded) * len(chunk) <= (
+            server.write_buffer_size + 2 * len(chunk))
+        data = _read_until(sock, chunk)
+        while len(data.split(b'\r\n\r\n', 1)[1]) < len(chunk) * 64:
+            data += sock.recv(65536)
+        assert len(data.split(b'\r\n\r\n', 1)[1]) == len(chunk) * 64
+        sock.close()
+    finally:
+        server.server_close()
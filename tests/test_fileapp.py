@@ -4,6 +4,7 @@
 import time
 import random
 import os
+import shutil
 import tempfile
 try:
     # Python 3
@@ -163,9 +164,12 @@ def _excercize_range(build,content):
     assert res.header('accept-ranges') == 'bytes'
     assert res.body == content
     assert res.header('content-length') == str(len(content))
-    res = build("bytes=-%d" % (len(content)-1))
+    res = build("bytes=-%d" % (len(content)+1))
     assert res.body == content
     assert res.header('content-length') == str(len(content))
+    res = build("bytes=-%d" % (len(content)-1))
+    assert res.body == content[1:]
+    assert res.header('content-length') == str(len(content)-1)
     res = build("bytes=0-")
     assert res.body == content
     assert res.header('content-length') == str(len(content))
@@ -188,7 +192,12 @@ def test_range():
         app = DataApp(content)
         return TestApp(app).get("/",headers={'Range': range}, status=status)
     _excercize_range(build,content)
-    build('bytes=0-%d' % (len(content)+1), 416)
+    # a range that ends past the content is cut to its length
+    res = build('bytes=0-%d' % (len(content)+1))
+    assert res.body == content
+    assert res.header('content-range') == 'bytes 0-%d/%d' % (
+        len(content)-1, len(content))
+    build('bytes=%d-%d' % (len(content), len(content)+5), 416)
 
 def test_file_range():
     tempfile = "test_fileapp.%s.txt" % (random.random())
@@ -210,6 +219,84 @@ def test_file_range():
     finally:
         os.unlink(tempfile)
 
+def _parse_byteranges(res):
+    content_type = res.header('content-type')
+    assert content_type.startswith('multipart/byteranges; boundary=')
+    boundary = content_type.split('=', 1)[1].encode('ascii')
+    assert res.header('content-length') == str(len(res.body))
+    assert res.body.endswith(b'\r\n--' + boundary + b'--\r\n')
+    parts = []
+    for part in res.body.split(b'\r\n--' + boundary)[1:-1]:
+        (head, body) = part.split(b'\r\n\r\n', 1)
+        assert b'Content-Type: text/plain' in head
+        content_range = head.split(b'Content-Range: bytes ')[1]
+        parts.append((content_range.decode('ascii'), body))
+    return parts
+
+def _excercize_multiple_ranges(build, content):
+    total = len(content)
+    res = build("bytes=0-9,20-29")
+    assert _parse_byteranges(res) == [
+        ('0-9/%d' % total, content[:10]),
+        ('20-29/%d' % total, content[20:30])]
+    # suffix ranges, out of order
+    res = build("bytes=-5, 3-7")
+    assert _parse_byteranges(res) == [
+        ('3-7/%d' % total, content[3:8]),
+        ('%d-%d/%d' % (total-5, total-1, total), content[-5:])]
+    # overlapping and adjacent ranges are coalesced
+    res = build("bytes=0-9,5-14,15-19")
+    assert not res.header('content-type').startswith('multipart')
+    assert res.header('content-range') == 'bytes 0-19/%d' % total
+    assert res.body == content[:20]
+    # unsatisfiable ranges are left out, unless all are
+    res = build("bytes=%d-,2-4" % total)
+    assert res.body == content[2:5]
+    res = build("bytes=%d-,-0" % total, status=416)
+    assert res.header('content-range') == 'bytes */%d' % total
+    # too many, or malformed, ranges are ignored
+    res = build(
+        "bytes=" + ",".join("%d-%d" % (i, i) for i in range(0, 400, 2)),
+        status=200)
+    assert res.body == content
+    res = build("bytes=5-3", status=200)
+    assert res.body == content
+    res = build("bytes=0-0,5-3", status=200)
+    assert res.body == content
+    # a range that ends past the content is cut to its length
+    res = build("bytes=0-0,%d-%d" % (total-3, total+100))
+    assert _parse_byteranges(res) == [
+        ('0-0/%d' % total, content[:1]),
+        ('%d-%d/%d' % (total-3, total-1, total), content[-3:])]
+
+def test_multiple_ranges():
+    content = LETTERS * 5
+    if six.PY3:
+        content = content.encode('utf8')
+    def build(range, status=206):
+        app = DataApp(content, content_type='text/plain')
+        return TestApp(app).get("/", headers={'Range': range}, status=status)
+    _excercize_multiple_ranges(build, content)
+
+def test_file_multiple_ranges():
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'test.txt')
+    content = LETTERS * (1+(fileapp.CACHE_SIZE // len(LETTERS)))
+    if six.PY3:
+        content = content.encode('utf8')
+    with open(filename, "wb") as fp:
+        fp.write(content)
+    try:
+        for options in ({}, {'use_mmap': True},
+                        {'content_cache': fileapp.ContentCache()}):
+            def build(range, status=206):
+                app = fileapp.FileApp(filename, **options)
+                return TestApp(app).get("/", headers={'Range': range},
+                                        status=status)
+            _excercize_multiple_ranges(build, content)
+    finally:
+        shutil.rmtree(tmpdir)
+
 def test_file_cache():
     filename = os.path.join(os.path.dirname(__file__),
                             'urlparser_data', 'secured.txt')
@@ -230,6 +317,200 @@ def test_file_cache():
     res = app.get('/', headers={'If-Modified-Since': 'invalid date'},
                   status=400)
 
+def test_shared_file_cache():
+    tmpdir = tempfile.mkdtemp()
+    cache = fileapp.FileCache(max_entries=2, ttl=60)
+    content = LETTERS.encode('ascii') * (1 + fileapp.CACHE_SIZE // len(LETTERS))
+    filenames = [os.path.join(tmpdir, name) for name in 'abc']
+    try:
+        for filename in filenames:
+            with open(filename, 'wb') as fp:
+                fp.write(content)
+        app = TestApp(fileapp.DirectoryApp(tmpdir, file_cache=cache))
+        assert app.get('/a').body == content
+        res = app.get('/a', headers={'Range': 'bytes=3-17'}, status=206)
+        assert res.body == content[3:18]
+        entry = cache.entries[filenames[0]]
+        assert entry.refs == 0
+        if hasattr(os, 'pread'):
+            # The descriptor is kept open for the next request
+            fd = entry.fd
+            assert fd is not None
+            assert app.get('/a').body == content
+            assert cache.entries[filenames[0]].fd == fd
+        app.get('/nothing', status=404)
+        # Only the two most recently used files are remembered
+        assert list(cache.entries) == [filenames[0],
+                                       os.path.join(tmpdir, 'nothing')]
+        assert app.get('/b').body == content
+        assert filenames[0] not in cache.entries
+        assert entry.fd is None
+        # A replaced file is noticed once the ttl has passed
+        with open(filenames[2], 'wb') as fp:
+            fp.write(b'new content')
+        os.rename(filenames[2], filenames[1])
+        if hasattr(os, 'pread'):
+            assert app.get('/b').body == content
+        cache.ttl = 0
+        assert app.get('/b').body == b'new content'
+    finally:
+        cache.invalidate()
+        shutil.rmtree(tmpdir)
+
+def test_content_cache():
+    tmpdir = tempfile.mkdtemp()
+    size = 2 * fileapp.CACHE_SIZE
+    cache = fileapp.ContentCache(max_bytes=int(size * 2.5))
+    try:
+        for name in 'abc':
+            with open(os.path.join(tmpdir, name), 'wb') as fp:
+                fp.write(name.encode('ascii') * size)
+        app = TestApp(fileapp.DirectoryApp(tmpdir, content_cache=cache))
+        assert app.get('/a').body == b'a' * size
+        assert app.get('/a').body == b'a' * size
+        assert (cache.hits, cache.misses) == (1, 1)
+        res = app.get('/a', headers={'Range': 'bytes=3-17'}, status=206)
+        assert res.body == b'a' * 15
+        # Ranges are served from the cached content without copying it
+        fa = fileapp.FileApp(os.path.join(tmpdir, 'a'), content_cache=cache)
+        environ = {'wsgi.version': (1, 0), 'REQUEST_METHOD': 'GET',
+                   'HTTP_RANGE': 'bytes=3-17',
+                   'paste.httpserver.accepts_buffers': True}
+        body = fa(dict(environ), lambda status, headers: None)
+        # Not unless the application asks for it
+        assert body == [b'a' * 15]
+        fa = fileapp.FileApp(os.path.join(tmpdir, 'a'), content_cache=cache,
+                             buffers=True)
+        body = fa(dict(environ), lambda status, headers: None)
+        assert isinstance(body[0], memoryview)
+        assert body[0].tobytes() == b'a' * 15
+        # Only the most recently used contents fit in the budget
+        app.get('/b')
+        app.get('/c')
+        assert list(cache.entries) == [os.path.join(tmpdir, 'b'),
+                                       os.path.join(tmpdir, 'c')]
+        assert cache.size == 2 * size
+        # A changed file is read again
+        with open(os.path.join(tmpdir, 'c'), 'ab') as fp:
+            fp.write(b'!')
+        assert app.get('/c', headers={'Cache-Control': 'max-age=0'}
+                       ).body == b'c' * size + b'!'
+        assert cache.size == 2 * size + 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_mmap():
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'big')
+    content = LETTERS.encode('ascii') * 50000
+    cache = fileapp.FileCache(ttl=60)
+    try:
+        with open(filename, 'wb') as fp:
+            fp.write(content)
+        app = fileapp.FileApp(filename, file_cache=cache, use_mmap=True,
+                              buffers=True)
+        res = TestApp(app).get('/')
+        assert res.body == content
+        mapping = cache.entries[filename].mapping
+        assert mapping is not None
+        res = TestApp(app).get('/', headers={'Range': 'bytes=3-17'},
+                               status=206)
+        assert res.body == content[3:18]
+        assert cache.entries[filename].mapping is mapping
+        environ = {'wsgi.version': (1, 0), 'REQUEST_METHOD': 'GET',
+                   'paste.httpserver.accepts_buffers': True}
+        body = list(app(environ, lambda status, headers: None))
+        assert len(body) == 3
+        assert isinstance(body[0], (memoryview, bytes))
+        assert b''.join(body) == content
+        # A file truncated in place isn't read past its end
+        body = app(dict(environ), lambda status, headers: None)
+        assert len(next(body)) == fileapp.MMAP_BLOCK_SIZE
+        with open(filename, 'r+b') as fp:
+            fp.truncate(fileapp.MMAP_BLOCK_SIZE + 10)
+        try:
+            next(body)
+        except IOError:
+            pass
+        else:
+            assert False, "Read past the end of the file"
+        with open(filename, 'wb') as fp:
+            fp.write(content)
+        # Servers that send files with sendfile are given the file
+        # instead; a wsgi.file_wrapper alone doesn't mean they do
+        cache.invalidate()
+        environ['wsgi.file_wrapper'] = lambda file, block_size: [file.read()]
+        body = list(app(dict(environ), lambda status, headers: None))
+        assert b''.join(body) == content
+        assert cache.entries[filename].mapping is not None
+        cache.invalidate()
+        environ['paste.httpserver.sendfile'] = True
+        body = app(dict(environ), lambda status, headers: None)
+        assert body == [content]
+        assert cache.entries[filename].mapping is None
+        del environ['wsgi.file_wrapper'], environ['paste.httpserver.sendfile']
+        # A replacement file is mapped anew
+        with open(filename + '.new', 'wb') as fp:
+            fp.write(content[:-1])
+        os.rename(filename + '.new', filename)
+        res = TestApp(app).get('/', headers={'Cache-Control': 'max-age=0'})
+        assert res.body == content[:-1]
+        assert cache.entries[filename].mapping is not mapping
+    finally:
+        cache.invalidate()
+        shutil.rmtree(tmpdir)
+
+def test_precompressed():
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'app.js')
+    content = LETTERS.encode('ascii') * 10
+    cache = fileapp.FileCache(ttl=60)
+    try:
+        with open(filename, 'wb') as fp:
+            fp.write(content)
+        for (suffix, data) in [('.gz', b'gzipped'), ('.br', b'brotli')]:
+            with open(filename + suffix, 'wb') as fp:
+                fp.write(data)
+        app = TestApp(fileapp.FileApp(filename, file_cache=cache,
+                                      precompressed=True))
+        res = app.get('/')
+        assert res.body == content
+        assert res.header('vary') == 'Accept-Encoding'
+        assert not res.all_headers('content-encoding')
+        identity_etag = res.header('etag')
+        content_type = res.header('content-type')
+        res = app.get('/', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        assert res.body == b'brotli'
+        assert res.header('content-encoding') == 'br'
+        assert res.header('content-type') == content_type
+        assert res.header('vary') == 'Accept-Encoding'
+        br_etag = res.header('etag')
+        assert br_etag != identity_etag
+        res = app.get('/', headers={'Accept-Encoding': 'br;q=0.5, gzip'})
+        assert res.body == b'gzipped'
+        assert res.header('content-encoding') == 'gzip'
+        assert res.header('etag') not in (identity_etag, br_etag)
+        res = app.get('/', headers={'Accept-Encoding': '*;q=0.1, br;q=0'})
+        assert res.body == b'gzipped'
+        res = app.get('/', headers={'Accept-Encoding': 'gzip;q=0.5, identity'})
+        assert res.body == content
+        res = app.get('/', headers={'Accept-Encoding': 'deflate'})
+        assert res.body == content
+        res = app.get('/', headers={'Accept-Encoding': 'br',
+                                    'If-None-Match': br_etag}, status=304)
+        app = TestApp(fileapp.DirectoryApp(tmpdir, precompressed=['gzip']))
+        res = app.get('/app.js', headers={'Accept-Encoding': 'br, gzip'})
+        assert res.body == b'gzipped'
+        # A copy older than the file is not sent
+        os.utime(filename + '.gz', (0, 0))
+        app = TestApp(fileapp.FileApp(filename, precompressed=True,
+                                      file_cache=fileapp.FileCache()))
+        res = app.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert res.body == content
+    finally:
+        cache.invalidate()
+        shutil.rmtree(tmpdir)
+
 def test_methods():
     filename = os.path.join(os.path.dirname(__file__),
                             'urlparser_data', 'secured.txt')
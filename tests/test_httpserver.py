@@ -1,6 +1,21 @@
 import email
+import errno
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
-from paste.httpserver import WSGIHandler
+import pytest
+from paste.httpserver import (
+    ChunkedInputFile, LimitedLengthFile, PreforkServer, ThreadPool,
+    WSGIHandler, serve)
+from six import BytesIO
 from six.moves import StringIO
 
 
@@ -43,3 +58,1091 @@ def test_environ_with_multiple_values():
     wsgi_handler.wsgi_setup()
 
     assert wsgi_handler.wsgi_environ['HTTP_HOST'] == 'host1,host2'
+
+
+def _parse(data):
+    wsgi_handler = WSGIHandler(MockSocket(), '1.2.3.4', MockServer())
+    wsgi_handler.protocol_version = 'HTTP/1.1'
+    wsgi_handler.rfile = BytesIO(data)
+    wsgi_handler.wfile = BytesIO()
+    wsgi_handler.raw_requestline = wsgi_handler.rfile.readline()
+    return wsgi_handler, wsgi_handler.parse_request()
+
+
+def test_parse_request():
+    handler, ok = _parse(
+        b'GET /a/./b/../%7Ec/?x=1&y=%20#frag HTTP/1.1\r\n'
+        b'Host: example.com\r\n'
+        b'Accept: text/html\r\n'
+        b'X-Folded: one\r\n'
+        b'  two\r\n'
+        b'accept: text/plain\r\n'
+        b'Content-Type: text/plain\r\n'
+        b'Content-Length: 5\r\n'
+        b'\r\nhello')
+    assert ok
+    assert handler.command == 'GET'
+    assert handler.request_version == 'HTTP/1.1'
+    assert not handler.close_connection
+    assert handler.headers['content-length'] == '5'
+    assert handler.rfile.read() == b'hello'
+    assert handler.wsgi_head_environ == {
+        'PATH_INFO': '/a/~c/',
+        'QUERY_STRING': 'x=1&y=%20',
+        'HTTP_HOST': 'example.com',
+        'HTTP_ACCEPT': 'text/html,text/plain',
+        'HTTP_X_FOLDED': 'one two',
+        'CONTENT_TYPE': 'text/plain',
+        'CONTENT_LENGTH': '5',
+        }
+    handler.wsgi_setup()
+    assert handler.wsgi_environ['PATH_INFO'] == '/a/~c/'
+    assert handler.wsgi_environ['HTTP_ACCEPT'] == 'text/html,text/plain'
+
+    handler, ok = _parse(b'GET http://example.com:8080/p?q HTTP/1.0\r\n\r\n')
+    assert ok
+    assert handler.close_connection
+    env = handler.wsgi_head_environ
+    assert env['PATH_INFO'] == '/p'
+    assert env['QUERY_STRING'] == 'q'
+    assert env['paste.httpserver.proxy.scheme'] == 'http'
+    assert env['paste.httpserver.proxy.host'] == 'example.com:8080'
+
+
+def test_parse_request_errors():
+    for data, status in [
+            (b'GET / HTTP/1.1\r\n' + b'X: y\r\n' * 101 + b'\r\n', b'431'),
+            (b'GET / HTTP/1.1\r\nX: ' + b'y' * 70000 + b'\r\n\r\n', b'431'),
+            (b'GET /' + b'a' * 70000 + b' HTTP/1.1\r\n\r\n', b'414'),
+            (b'GET / HTTP/1.1\r\nBad Header: x\r\n\r\n', b'400'),
+            (b'GET / HTTP/1.1\r\nContent-Length: 1\r\n'
+             b'Content-Length: 2\r\n\r\n', b'400'),
+            (b'POST / HTTP/1.1\r\nContent-Length: abc\r\n\r\n', b'400'),
+            (b'POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n', b'400'),
+            (b'GET / HTTP/2.0\r\n\r\n', b'505'),
+            (b'GET / FTP/1.0\r\n\r\n', b'400'),
+            ]:
+        handler, ok = _parse(data)
+        assert not ok
+        assert handler.wfile.getvalue().split()[1] == status
+
+
+def _serve(app, **kwargs):
+    kwargs.setdefault('protocol_version', 'HTTP/1.1')
+    server = serve(app, host='127.0.0.1', port=0, start_loop=False,
+                   daemon_threads=True, **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _hello_app(environ, start_response):
+    body = ('hello %s' % environ['PATH_INFO']).encode('ascii')
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def _read_until(sock, expect):
+    data = b''
+    while not data.endswith(expect):
+        chunk = sock.recv(4096)
+        assert chunk, data
+        data += chunk
+    return data
+
+
+def _get(sock, path):
+    sock.sendall(('GET %s HTTP/1.1\r\nHost: x\r\n\r\n' % path).encode('ascii'))
+    return _read_until(sock, ('hello %s' % path).encode('ascii'))
+
+
+def test_limited_length_file():
+    f = LimitedLengthFile(BytesIO(b'one\ntwo\nthree'), 8)
+    assert f.readline(-1) == b'one\n'
+    buf = bytearray(10)
+    assert f.readinto(buf) == 4
+    assert buf[:4] == b'two\n'
+    assert f.read() == b''
+    assert f.readinto(buf) == 0
+    f = LimitedLengthFile(BytesIO(b'one\ntwo\nthree'), 8)
+    assert list(f) == [b'one\n', b'two\n']
+    f = LimitedLengthFile(BytesIO(b'one\ntwo\nthree'), 8)
+    assert f.readlines() == [b'one\n', b'two\n']
+    assert f.read(-1) == b''
+
+
+def test_chunked_input_file():
+    body = (b'5\r\nhello\r\n'
+            b'a;name=value\r\n wide\nworl\r\n'
+            b'1\r\nd\r\n'
+            b'0\r\nTrailer: x\r\n\r\n'
+            b'GET / HTTP/1.1')
+    f = ChunkedInputFile(BytesIO(body))
+    assert f.read() == b'hello wide\nworld'
+    assert f.read() == b''
+    f = ChunkedInputFile(BytesIO(body))
+    assert f.read(3) == b'hel'
+    assert f.read(4) == b'lo w'
+    assert f.readline() == b'ide\n'
+    buf = bytearray(10)
+    assert f.readinto(buf) == 5
+    assert buf[:5] == b'world'
+    assert f.readinto(buf) == 0
+    f = ChunkedInputFile(BytesIO(body))
+    assert list(f) == [b'hello wide\n', b'world']
+    # The next request is left alone
+    rfile = BytesIO(body)
+    ChunkedInputFile(rfile).read()
+    assert rfile.read() == b'GET / HTTP/1.1'
+    for bad in [b'5\r\nhel', b'x\r\nhello\r\n0\r\n\r\n',
+                b'5\r\nhelloX\r\n0\r\n\r\n', b'0\r\n']:
+        with pytest.raises(IOError):
+            ChunkedInputFile(BytesIO(bad)).read()
+
+
+def test_keepalive_connections_are_parked():
+    server = _serve(_hello_app, threadpool_workers=2,
+                    threadpool_options=dict(spawn_if_under=0))
+    try:
+        socks = [socket.create_connection(server.server_address, 5)
+                 for i in range(20)]
+        # Far more idle keep-alive connections than workers
+        for i, sock in enumerate(socks):
+            _get(sock, '/first%d' % i)
+        for i, sock in enumerate(socks):
+            assert b'200 OK' in _get(sock, '/second%d' % i)
+        assert len(server.thread_pool.workers) == 2
+        # A request head that arrives in pieces
+        sock = socks[0]
+        sock.sendall(b'GET /split HTTP/1.1\r\nHo')
+        time.sleep(0.1)
+        sock.sendall(b'st: x\r\n\r\n')
+        assert b'200 OK' in _read_until(sock, b'hello /split')
+        for sock in socks:
+            sock.close()
+    finally:
+        server.server_close()
+
+
+def test_waiting_keepalive_worker_is_idle():
+    server = _serve(_hello_app, park_connections=False,
+                    threadpool_workers=1,
+                    threadpool_options=dict(spawn_if_under=0,
+                                            hung_thread_limit=0.1))
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        _get(sock, '/first')
+        time.sleep(0.3)
+        # The worker waiting for the next request isn't running one
+        pool = server.thread_pool
+        assert list(pool.worker_tracker.values()) == [[None, None]]
+        info = pool.track_threads()
+        assert (len(info['idle']), info['busy'], info['hung']) == (1, [], [])
+        assert b'200 OK' in _get(sock, '/second')
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def test_pipelining():
+    server = _serve(_hello_app)
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b''.join(
+            b'GET /%d HTTP/1.1\r\nHost: x\r\n\r\n' % i for i in range(20)))
+        data = _read_until(sock, b'hello /19')
+        assert data.count(b'HTTP/1.1 200 OK') == 20
+        assert [int(n) for n in re.findall(b'hello /(\\d+)', data)] == list(range(20))
+        # A body the application doesn't read is skipped
+        sock.sendall(b'POST /post HTTP/1.1\r\nHost: x\r\n'
+                     b'Content-Length: 10\r\n\r\nGET /x HTTP'
+                     b'GET /after HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = _read_until(sock, b'hello /after')
+        assert data.count(b'HTTP/1.1 200 OK') == 2
+        # Too much of it, and the connection is closed after the response
+        sock.sendall(b'POST /big HTTP/1.1\r\nHost: x\r\n'
+                     b'Content-Length: 1000000\r\n\r\n')
+        assert _read_until(sock, b'hello /big')
+        assert sock.recv(4096) == b''
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def test_chunked_request():
+    def app(environ, start_response):
+        assert environ['wsgi.input_terminated']
+        assert 'CONTENT_LENGTH' not in environ
+        body = environ['wsgi.input'].read()
+        start_response('200 OK', [('Content-Length', str(len(body) + 4))])
+        return [b'got ', body]
+
+    server = _serve(app)
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'POST / HTTP/1.1\r\nHost: x\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n'
+                     b'3\r\nabc\r\n')
+        time.sleep(0.1)
+        sock.sendall(b'4\r\ndefg\r\n0\r\n\r\n')
+        assert _read_until(sock, b'got abcdefg')
+        # Another request on the same connection
+        sock.sendall(b'POST / HTTP/1.1\r\nHost: x\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n0\r\n\r\n')
+        assert _read_until(sock, b'\r\n\r\ngot ')
+        sock.close()
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'POST / HTTP/1.1\r\nHost: x\r\n'
+                     b'Transfer-Encoding: gzip\r\n\r\n')
+        assert sock.recv(4096).startswith(b'HTTP/1.1 400 ')
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def _closed(sock):
+    try:
+        return sock.recv(4096) == b''
+    except socket.error:
+        return True
+
+
+def test_header_and_keepalive_timeouts():
+    for park_connections in (True, False):
+        server = _serve(_hello_app, header_timeout=0.5, keepalive_timeout=1,
+                        park_connections=park_connections)
+        try:
+            slow = socket.create_connection(server.server_address, 5)
+            slow.sendall(b'GET / HTTP/1.1\r\n')
+            idle = socket.create_connection(server.server_address, 5)
+            _get(idle, '/')
+            start = time.time()
+            assert _closed(slow)
+            assert 0.4 < time.time() - start < 2
+            assert _closed(idle)
+            assert 0.9 < time.time() - start < 3
+            if park_connections:
+                timeouts = server.connection_manager.dropped
+            else:
+                timeouts = server.wsgi_timeouts
+            assert timeouts['header_timeout'] == 1
+            assert timeouts['keepalive_timeout'] == 1
+        finally:
+            server.server_close()
+
+
+class _UploadHandler(WSGIHandler):
+    upload_grace_period = 0.5
+
+
+def test_min_upload_rate():
+    def app(environ, start_response):
+        try:
+            body = environ['wsgi.input'].read()
+        except socket.timeout:
+            body = b'timeout'
+        start_response('200 OK', [('Content-Length', str(len(body)))])
+        return [body]
+
+    server = _serve(app, handler=_UploadHandler, min_upload_rate=1000,
+                    metrics_path='/metrics')
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'POST / HTTP/1.1\r\nHost: x\r\n'
+                     b'Content-Length: 2000\r\n\r\n' + b'x' * 1000)
+        assert _read_until(sock, b'\r\n\r\ntimeout')
+        assert _closed(sock)
+        assert server.wsgi_timeouts['min_upload_rate'] == 1
+        # A fast enough upload is fine
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'POST / HTTP/1.1\r\nHost: x\r\n'
+                     b'Content-Length: 2000\r\n\r\n' + b'x' * 1000)
+        time.sleep(0.3)
+        sock.sendall(b'x' * 1000)
+        assert _read_until(sock, b'\r\n\r\n' + b'x' * 2000)
+        sock.sendall(b'GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert _read_until(
+            sock, b'paste_connections_dropped_total{reason="min_upload_rate"} 1\n')
+    finally:
+        server.server_close()
+
+
+def test_accept_batches():
+    for park_connections in (True, False):
+        server = serve(_hello_app, host='127.0.0.1', port=0, start_loop=False,
+                       park_connections=park_connections)
+        try:
+            # More than the old default backlog of 5 can wait
+            socks = [socket.create_connection(server.server_address, 5)
+                     for i in range(20)]
+            time.sleep(0.1)
+            server.accept_batch = 15
+            assert server.accept_connections() == 15
+            assert server.accept_connections() == 5
+            assert server.accept_connections() == 0
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            for i, sock in enumerate(socks):
+                assert _get(sock, '/%d' % i)
+                sock.close()
+        finally:
+            server.server_close()
+
+
+def test_accept_errors():
+    server = serve(_hello_app, host='127.0.0.1', port=0, start_loop=False)
+    try:
+        errors = [socket.error(errno.ECONNABORTED, 'aborted'),
+                  socket.error(errno.EMFILE, 'Too many open files'),
+                  socket.error(errno.EAGAIN, 'again')]
+        failed = []
+
+        def get_request():
+            raise errors.pop(0)
+        server.get_request = get_request
+        server.accept_failed = failed.append
+        # A client that gave up is skipped; running out of file
+        # descriptors is not taken for there being nothing to accept
+        assert server.accept_connections() == 1
+        assert [exce.errno for exce in failed] == [errno.EMFILE]
+        assert server.accept_connections() == 0
+        assert len(failed) == 1
+        # The listener closed from another thread (e.g., by a drain)
+        del server.get_request
+        server.socket.close()
+        assert server.accept_connections() == 0
+        assert len(failed) == 1
+    finally:
+        server.server_close()
+
+
+def test_chunked_response():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Trailer', 'X-Checksum')])
+        yield b'hello'
+        yield b''
+        yield b' world'
+        environ['paste.httpserver.trailers'].extend([
+            ('X-Checksum', 'abc'),
+            # Not valid, or not allowed in a trailer
+            ('X-Split', 'x\r\nX-Injected: 1'),
+            ('X-Bad Name', 'x'),
+            ('Content-Length', '0'),
+            ('Transfer-Encoding', 'gzip')])
+
+    server = _serve(app)
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        for i in range(2):
+            sock.sendall(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+            data = _read_until(sock, b'\r\n0\r\nX-Checksum: abc\r\n\r\n')
+            head, body = data.split(b'\r\n\r\n', 1)
+            assert b'Transfer-Encoding: chunked' in head
+            assert b'Connection: close' not in head
+            assert body.startswith(b'5\r\nhello\r\n6\r\n world\r\n')
+            assert body.endswith(b'\r\n0\r\nX-Checksum: abc\r\n\r\n')
+        # HTTP/1.0 clients get the body delimited by closing instead
+        sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        data = _read_until(sock, b' world')
+        assert b'Connection: close' in data
+        assert b'chunked' not in data
+        sock.close()
+    finally:
+        server.server_close()
+
+
+PREFORK_SCRIPT = '''
+import os, sys
+from paste.httpserver import serve
+def app(environ, start_response):
+    body = ('%s %s' % (os.getpid(), environ['wsgi.multiprocess'])).encode()
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+serve(app, port=int(sys.argv[1]), processes=2)
+'''
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _get_pid(port, end=b' True'):
+    for i in range(100):
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 5)
+        except socket.error:
+            time.sleep(0.1)
+            continue
+        sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        data = _read_until(sock, end)
+        sock.close()
+        return int(data.split(b'\r\n\r\n')[1].split()[0])
+    raise AssertionError('Server did not start')
+
+
+def _make_pem(directory):
+    pem = os.path.join(directory, 'server.pem')
+    try:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'ec',
+             '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+             '-subj', '/CN=localhost', '-days', '1',
+             '-keyout', pem, '-out', pem + '.crt'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("openssl is needed to make a certificate")
+    with open(pem, 'a') as f:
+        with open(pem + '.crt') as crt:
+            f.write(crt.read())
+    return pem
+
+
+def test_ssl():
+    ssl = pytest.importorskip('ssl')
+
+    def app(environ, start_response):
+        body = ('%s %s %s %s %s' % (
+            environ['wsgi.url_scheme'], environ['SSL_SESSION_RESUMED'],
+            environ.get('paste.httpserver.alpn_protocol'),
+            environ['wsgi.input'].read(3), environ['PATH_INFO']))
+        body = body.encode('ascii')
+        start_response('200 OK', [('Content-Length', str(len(body)))])
+        return [body]
+
+    directory = tempfile.mkdtemp()
+    server = _serve(app, ssl_pem=_make_pem(directory))
+    try:
+        client = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        client.check_hostname = False
+        client.verify_mode = ssl.CERT_NONE
+        client.set_alpn_protocols(['h2', 'http/1.1'])
+        sock = client.wrap_socket(
+            socket.create_connection(server.server_address, 5))
+        # The request body is limited to its Content-Length even over
+        # TLS, so the rest is taken for the next request
+        sock.sendall(b'POST /a HTTP/1.1\r\nHost: x\r\n'
+                     b'Content-Length: 5\r\n\r\nabcde'
+                     b'GET /b HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = _read_until(sock, b"https Initial http/1.1 b'' /b")
+        assert b"https Initial http/1.1 b'abc' /a" in data
+        # The idle connection is parked, and its next request read
+        # from there
+        _wait_for(lambda: len(server.connection_manager.parked) == 1)
+        sock.sendall(b'GET /d HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert _read_until(sock, b"https Initial http/1.1 b'' /d")
+        session = sock.session
+        sock.close()
+        sock = client.wrap_socket(
+            socket.create_connection(server.server_address, 5),
+            session=session)
+        sock.sendall(b'GET /c HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert _read_until(sock, b"https Resumed http/1.1 b'' /c")
+        assert sock.session_reused
+        sock.close()
+        # A client that never starts the handshake only holds a worker
+        # until the timeout
+        server.ssl_handshake_timeout = 0.2
+        idle = socket.create_connection(server.server_address, 5)
+        assert _closed(idle)
+        assert server.wsgi_timeouts['ssl_handshake_timeout'] == 1
+    finally:
+        server.server_close()
+        shutil.rmtree(directory)
+
+
+def test_prefork_processes():
+    port = _free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen(
+        [sys.executable, '-c', PREFORK_SCRIPT, str(port)], cwd=root,
+        stdout=subprocess.PIPE)
+    try:
+        pids = set(_get_pid(port) for i in range(20))
+        assert proc.pid not in pids
+        # A child that dies is replaced
+        os.kill(pids.pop(), signal.SIGKILL)
+        time.sleep(0.5)
+        for i in range(20):
+            _get_pid(port)
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait() == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+
+
+def test_ipv6():
+    if not socket.has_ipv6:
+        pytest.skip("IPv6 is not available")
+    try:
+        server = serve(_hello_app, host='::1', port=0, start_loop=False,
+                       daemon_threads=True)
+    except socket.error:
+        pytest.skip("IPv6 is not available")
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        assert server.server_address[0] == '::1'
+        sock = socket.create_connection(server.server_address[:2], 5)
+        assert _get(sock, '/v6').endswith(b'hello /v6')
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def test_prefork_reuse_port_binds_in_parent():
+    server = PreforkServer(None, 2, ('127.0.0.1', 0), reuse_port=True)
+    try:
+        assert server.socket is None
+        assert server.server_address[1] != 0
+    finally:
+        server.server_close()
+    with pytest.raises(socket.error):
+        PreforkServer(None, 2, ('192.0.2.1', 0), reuse_port=True)
+
+
+def test_listen_fd():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    server = _serve(_hello_app, listen_fd=os.dup(listener.fileno()))
+    try:
+        assert server.server_address == listener.getsockname()
+        sock = socket.create_connection(listener.getsockname(), 5)
+        assert _get(sock, '/fd').endswith(b'hello /fd')
+        sock.close()
+    finally:
+        listener.close()
+        server.server_close()
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                    reason="Unix domain sockets are not available")
+@pytest.mark.parametrize('options', [
+    dict(use_threadpool=True), dict(use_threadpool=False),
+    dict(engine='asyncio')])
+def test_unix_socket(options):
+    def app(environ, start_response):
+        body = ('%(SERVER_NAME)s %(SERVER_PORT)s %(REMOTE_ADDR)s'
+                % environ).encode('ascii')
+        start_response('200 OK', [('Content-Length', str(len(body)))])
+        return [body]
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'paste.sock')
+    # A socket file left behind is replaced
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+    server = serve(app, host='unix:' + path, socket_mode='600',
+                   start_loop=False, daemon_threads=True,
+                   protocol_version='HTTP/1.1', **options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        assert server.server_address == path
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        sock = socket.socket(socket.AF_UNIX)
+        sock.settimeout(5)
+        sock.connect(path)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: example.com:8000\r\n\r\n')
+        assert _read_until(sock, b'example.com 8000 127.0.0.1')
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: [::1]\r\n\r\n')
+        assert _read_until(sock, b'[::1] 80 127.0.0.1')
+        sock.close()
+        # The socket file goes away with the server
+        server.server_close()
+        _wait_for(lambda: not os.path.exists(path))
+        with pytest.raises(AssertionError):
+            serve(app, host='unix:' + path, processes=2, reuse_port=True,
+                  start_loop=False)
+    finally:
+        server.server_close()
+        shutil.rmtree(directory)
+
+
+RESTART_SCRIPT = '''
+import os, sys, time
+from paste.httpserver import serve
+def app(environ, start_response):
+    if environ['PATH_INFO'] == '/slow':
+        time.sleep(1)
+    body = ('%s %s' % (os.getpid(), environ['wsgi.multiprocess'])).encode()
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+serve(app, port=int(sys.argv[1]), restart_on_hup=True)
+'''
+
+
+def test_restart_on_hup():
+    port = _free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    fd, script = tempfile.mkstemp(suffix='.py')
+    os.write(fd, RESTART_SCRIPT.encode('ascii'))
+    os.close(fd)
+    # Stands in for systemd, to be told about the new main process
+    directory = tempfile.mkdtemp()
+    notify = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify.bind(os.path.join(directory, 'notify'))
+    notify.settimeout(5)
+    env = dict(os.environ, PYTHONPATH=root,
+               NOTIFY_SOCKET=os.path.join(directory, 'notify'))
+    proc = subprocess.Popen([sys.executable, script, str(port)], env=env,
+                            stdout=subprocess.PIPE)
+    new_pid = None
+    try:
+        assert _get_pid(port, b' False') == proc.pid
+        slow = socket.create_connection(('127.0.0.1', port), 5)
+        slow.sendall(b'GET /slow HTTP/1.0\r\n\r\n')
+        time.sleep(0.2)
+        proc.send_signal(signal.SIGHUP)
+        # Connections are never refused while the new process starts
+        for i in range(200):
+            sock = socket.create_connection(('127.0.0.1', port), 5)
+            sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+            data = _read_until(sock, b' False')
+            sock.close()
+            new_pid = int(data.split(b'\r\n\r\n')[1].split()[0])
+            if new_pid != proc.pid:
+                break
+            time.sleep(0.05)
+        assert new_pid != proc.pid
+        assert notify.recv(4096) == ('MAINPID=%d' % new_pid).encode('ascii')
+        # The old process finishes the request it was working on
+        data = _read_until(slow, b' False')
+        assert ('%s False' % proc.pid).encode('ascii') in data
+        slow.close()
+        assert proc.wait() == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        if new_pid and new_pid != proc.pid:
+            os.kill(new_pid, signal.SIGTERM)
+        os.unlink(script)
+        notify.close()
+        shutil.rmtree(directory)
+
+
+DRAIN_SCRIPT = '''
+import os, sys, time
+from paste.httpserver import serve
+def app(environ, start_response):
+    time.sleep(float(environ['PATH_INFO'][1:] or 0))
+    body = ('%s False' % os.getpid()).encode()
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+serve(app, port=int(sys.argv[1]), drain_timeout=float(sys.argv[2]),
+      protocol_version='HTTP/1.1', park_connections=sys.argv[3:] != ['0'])
+'''
+
+
+def _drain(drain_timeout, request_time):
+    port = _free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen(
+        [sys.executable, '-c', DRAIN_SCRIPT, str(port), str(drain_timeout)],
+        cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        _get_pid(port, b' False')
+        slow = socket.create_connection(('127.0.0.1', port), 5)
+        slow.sendall(('GET /%s HTTP/1.0\r\n\r\n' % request_time).encode())
+        time.sleep(0.2)
+        proc.send_signal(signal.SIGTERM)
+        time.sleep(0.2)
+        # No more connections are accepted
+        try:
+            socket.create_connection(('127.0.0.1', port), 5).close()
+        except socket.error:
+            pass
+        else:
+            raise AssertionError('Connection accepted while draining')
+        response = b''
+        while True:
+            data = slow.recv(4096)
+            if not data:
+                break
+            response += data
+        slow.close()
+        status = proc.wait()
+        return status, response, proc.stderr.read()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+def test_drain():
+    status, response, log = _drain(5, 1)
+    assert status == 0
+    assert response.endswith(b' False')
+
+
+def test_drain_timeout():
+    status, response, log = _drain(0.5, 3)
+    assert status != 0
+    assert b'Drain did not finish in 0.5 seconds' in log
+    assert b'GET /3 (running for' in log
+
+
+FORCE_QUIT_SCRIPT = '''
+import socket, time
+from paste.httpserver import ThreadPool
+pool = ThreadPool(1, spawn_if_under=0)
+a, b = socket.socketpair()
+pool.add_task(lambda: a.recv(1))
+time.sleep(0.3)
+pool.shutdown(force_quit_timeout=0.5)
+'''
+
+
+def test_thread_pool_force_quit():
+    # A worker stuck in a blocking call can't be killed, so the
+    # process is ended
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen([sys.executable, '-c', FORCE_QUIT_SCRIPT],
+                            cwd=root, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    try:
+        assert proc.wait(30) == 3
+        assert b'Traceback' not in proc.stderr.read()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+@pytest.mark.parametrize('park_connections', [True, False])
+def test_drain_closes_idle_connections(park_connections):
+    port = _free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen(
+        [sys.executable, '-c', DRAIN_SCRIPT, str(port), '3',
+         str(int(park_connections))],
+        cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        _get_pid(port, b' False')
+        idle = socket.create_connection(('127.0.0.1', port), 5)
+        idle.sendall(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+        _read_until(idle, b' False')
+        time.sleep(0.2)
+        start = time.time()
+        proc.send_signal(signal.SIGTERM)
+        # The worker waiting for the next request is woken up, so the
+        # drain doesn't wait for the timeout
+        assert _closed(idle)
+        assert proc.wait() == 0
+        assert time.time() - start < 2
+        idle.close()
+        assert b'Drain did not finish' not in proc.stderr.read()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+def test_file_wrapper():
+    fd, filename = tempfile.mkstemp()
+    os.write(fd, b''.join(str(i).encode('ascii') for i in range(10000)))
+    os.close(fd)
+
+    def app(environ, start_response):
+        f = open(filename, 'rb')
+        headers = []
+        if environ['PATH_INFO'] == '/range':
+            f.seek(100)
+            headers.append(('Content-Length', '50'))
+        start_response('200 OK', headers)
+        return environ['wsgi.file_wrapper'](f, 4096)
+
+    server = _serve(app)
+    try:
+        with open(filename, 'rb') as f:
+            content = f.read()
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'GET /range HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = _read_until(sock, content[100:150])
+        assert data.split(b'\r\n\r\n', 1)[1] == content[100:150]
+        # The Content-Length is filled in, so the connection stays open
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = _read_until(sock, content[-50:])
+        head, body = data.split(b'\r\n\r\n', 1)
+        assert body == content
+        assert ('Content-Length: %s' % len(content)).encode('ascii') in head
+        sock.close()
+    finally:
+        server.server_close()
+        os.unlink(filename)
+
+
+@pytest.mark.parametrize('options, sendfile', [
+    ({}, True),
+    ({'engine': 'asyncio'}, False),
+    ])
+def test_sendfile_declared(options, sendfile):
+    def app(environ, start_response):
+        body = str(environ['paste.httpserver.sendfile']).encode('ascii')
+        start_response('200 OK', [('Content-Length', str(len(body)))])
+        return [body]
+
+    server = _serve(app, **options)
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert _read_until(sock, str(sendfile).encode('ascii'))
+        sock.close()
+    finally:
+        server.server_close()
+
+
+class FlushRecordingHandler(WSGIHandler):
+    flushed = []
+
+    def wsgi_flush(self):
+        if self.wsgi_output:
+            self.flushed.append(b''.join(self.wsgi_output))
+        WSGIHandler.wsgi_flush(self)
+
+
+def test_output_coalescing():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', '9')])
+        if environ['PATH_INFO'] == '/list':
+            return [b'abc', b'def', b'ghi']
+        return iter([b'abc', b'def', b'ghi'])
+
+    flushed = FlushRecordingHandler.flushed
+    server = _serve(app, handler=FlushRecordingHandler)
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        sock.sendall(b'GET /list HTTP/1.1\r\nHost: x\r\n\r\n')
+        _read_until(sock, b'abcdefghi')
+        # Headers and the whole body at once
+        assert len(flushed) == 1
+        assert flushed[0].startswith(b'HTTP/1.1 200 OK\r\n')
+        assert flushed[0].endswith(b'\r\n\r\nabcdefghi')
+        del flushed[:]
+        sock.sendall(b'GET /stream HTTP/1.1\r\nHost: x\r\n\r\n')
+        _read_until(sock, b'abcdefghi')
+        # Headers go with the first chunk, but streamed chunks are
+        # not held back
+        assert len(flushed) == 3
+        assert flushed[0].endswith(b'\r\n\r\nabc')
+        assert flushed[1:] == [b'def', b'ghi']
+        sock.close()
+    finally:
+        server.server_close()
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_thread_pool_supervisor():
+    pool = ThreadPool(2, daemon=True, spawn_if_under=2,
+                      hung_thread_limit=0.1, kill_thread_limit=0,
+                      supervisor_period=60)
+    release = threading.Event()
+    done = []
+
+    def task():
+        release.wait(5)
+        done.append(1)
+
+    try:
+        _wait_for(lambda: pool.idle_count == 2)
+        pool.add_task(task)
+        pool.add_task(task)
+        _wait_for(lambda: pool.busy_count == 2)
+        assert pool.idle_count == 0
+        time.sleep(0.2)
+        # No idle worker is left and both are hung, so the supervisor is
+        # woken up to add workers long before supervisor_period
+        pool.add_task(lambda: done.append(2))
+        _wait_for(lambda: 2 in done)
+        assert len(pool.workers) == 4
+        release.set()
+        _wait_for(lambda: len(done) == 3)
+        _wait_for(lambda: pool.busy_count == 0)
+        assert pool.idle_count == len(pool.workers)
+    finally:
+        release.set()
+        pool.shutdown()
+    assert not pool.supervisor.is_alive()
+
+
+def test_load_shedding():
+    release = threading.Event()
+
+    def app(environ, start_response):
+        release.wait(5)
+        return _hello_app(environ, start_response)
+
+    server = _serve(app, threadpool_workers=1, max_queue_size=1,
+                    threadpool_options={'spawn_if_under': 0})
+    socks = []
+    try:
+        for i in range(3):
+            sock = socket.create_connection(server.server_address, 5)
+            sock.sendall(b'GET /%d HTTP/1.1\r\nHost: x\r\n\r\n' % i)
+            socks.append(sock)
+            if i == 0:
+                _wait_for(lambda: server.thread_pool.busy_count == 1)
+            elif i == 1:
+                _wait_for(lambda: server.thread_pool.queue.qsize() == 1)
+        # The first request is running and the second one is queued,
+        # so the third is turned away at once
+        data = _read_until(socks[2], b'\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 503 Service Unavailable\r\n')
+        assert b'\r\nRetry-After: 1\r\n' in data
+        assert server.requests_shed == 1
+        release.set()
+        assert _read_until(socks[0], b'hello /0').endswith(b'hello /0')
+        assert _read_until(socks[1], b'hello /1').endswith(b'hello /1')
+    finally:
+        release.set()
+        for sock in socks:
+            sock.close()
+        server.server_close()
+
+
+@pytest.mark.parametrize('engine', [None, 'asyncio'])
+def test_max_request_age(engine):
+    if engine == 'asyncio' and sys.version_info < (3, 4):
+        pytest.skip("asyncio needs Python 3.4")
+    release = threading.Event()
+    environs = []
+
+    def app(environ, start_response):
+        environs.append(environ)
+        release.wait(5)
+        return _hello_app(environ, start_response)
+
+    server = _serve(app, threadpool_workers=1, max_request_age=0.2,
+                    threadpool_options={'spawn_if_under': 0}, engine=engine)
+    socks = []
+    try:
+        for i in range(2):
+            sock = socket.create_connection(server.server_address, 5)
+            sock.sendall(b'GET /%d HTTP/1.1\r\nHost: x\r\n\r\n' % i)
+            socks.append(sock)
+            _wait_for(lambda: server.thread_pool.busy_count == 1)
+        _wait_for(lambda: server.thread_pool.queue_wait() > 0.3)
+        release.set()
+        assert _read_until(socks[0], b'hello /0').endswith(b'hello /0')
+        # The second request waited too long to be run
+        data = _read_until(socks[1], b'\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 503 Service Unavailable\r\n')
+        assert server.requests_expired == 1
+        assert len(environs) == 1
+        accepted_at = environs[0]['paste.httpserver.accepted_at']
+        assert environs[0]['paste.httpserver.deadline'] == accepted_at + 0.2
+        assert time.time() - 1 < accepted_at < time.time()
+        # The next request on a keep-alive connection gets its own time
+        assert _get(socks[0], '/2').endswith(b'hello /2')
+        assert environs[1]['paste.httpserver.accepted_at'] > accepted_at
+    finally:
+        release.set()
+        for sock in socks:
+            sock.close()
+        server.server_close()
+
+
+def test_thread_pool_autoscaling():
+    pool = ThreadPool(2, daemon=True, min_workers=1, max_workers=4,
+                      scale_up_wait=0.05, scale_down_delay=0.2,
+                      supervisor_period=0.05)
+    release = threading.Event()
+    done = []
+
+    def task():
+        release.wait(5)
+        done.append(1)
+
+    try:
+        assert pool.nworkers == 2
+        _wait_for(lambda: len(pool.workers) == 2)
+        for i in range(6):
+            pool.add_task(task)
+        # Tasks are left waiting, so the pool grows, but not past
+        # max_workers
+        _wait_for(lambda: len(pool.workers) == 4)
+        time.sleep(0.3)
+        assert len(pool.workers) == 4
+        release.set()
+        _wait_for(lambda: len(done) == 6)
+        # Once it's been idle for scale_down_delay it shrinks to
+        # min_workers
+        _wait_for(lambda: len(pool.workers) == 1)
+        time.sleep(0.3)
+        assert len(pool.workers) == 1
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def test_metrics():
+    server = _serve(_hello_app, metrics_path='/_metrics')
+    try:
+        sock = socket.create_connection(server.server_address, 5)
+        _get(sock, '/a')
+        _get(sock, '/b')
+        sock.sendall(b'GET /_metrics HTTP/1.1\r\nHost: x\r\n\r\n')
+        data = b''
+        while b'\r\n\r\n' not in data:
+            data += sock.recv(4096)
+        head, body = data.split(b'\r\n\r\n', 1)
+        length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+        while len(body) < length:
+            body += sock.recv(4096)
+        sock.close()
+        assert b'Content-Type: text/plain; version=0.0.4' in head
+        lines = body.decode('utf-8').splitlines()
+        assert 'paste_requests_total 2' in lines
+        # The metrics request itself
+        assert 'paste_requests_in_flight 1' in lines
+        assert 'paste_request_duration_seconds_count 2' in lines
+        assert 'paste_request_duration_seconds_bucket{le="+Inf"} 2' in lines
+        # At least one task per connection (keep-alive requests that
+        # arrive before the connection is parked are not queued again)
+        assert 'paste_queue_wait_seconds_count 1' in lines or (
+            'paste_queue_wait_seconds_count 2' in lines or
+            'paste_queue_wait_seconds_count 3' in lines)
+        assert 'paste_queue_depth 0' in lines
+        assert 'paste_workers{state="busy"} 1' in lines
+        assert 'paste_requests_shed_total 0' in lines
+        assert 'paste_connections_parked 0' in lines
+        assert lines.count('# TYPE paste_workers gauge') == 1
+        written = [line for line in lines
+                   if line.startswith('paste_bytes_written_total ')]
+        assert int(written[0].split()[1]) > len(b'hello /a' * 2)
+        # Each process of a PreforkServer labels its own
+        server.wsgi_multiprocess = True
+        _wait_for(lambda: server.wsgi_metrics.requests_served == 3
+                  and not server.thread_pool.busy_count)
+        lines = server.wsgi_metrics.render().splitlines()
+        pid = os.getpid()
+        assert 'paste_requests_total{pid="%d"} 3' % pid in lines
+        assert ('paste_workers{pid="%d",state="busy"} 0' % pid) in lines
+        assert ('paste_request_duration_seconds_bucket{le="+Inf",pid="%d"} 3'
+                % pid) in lines
+        assert 'paste_request_duration_seconds_count{pid="%d"} 3' % pid in lines
+    finally:
+        server.server_close()
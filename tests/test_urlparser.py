@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 from paste.urlparser import *
 from paste.fixture import *
 from pkg_resources import get_distribution
@@ -135,6 +137,36 @@ def test_static_parser():
     res = testapp.get('/dir%20with%20spaces/%2e%2e/%2e%2e/secured.txt', status=404)
     res = testapp.get('/dir%20with%20spaces/', status=404)
 
+def test_static_parser_file_cache():
+    from paste.fileapp import FileCache
+    cache = FileCache()
+    testapp = TestApp(StaticURLParser(path('find_file'), file_cache=cache))
+    res = testapp.get('/dir with spaces/test 4.html')
+    assert res.body.strip() == b'test 4'
+    res = testapp.get('/dir with spaces/test 4.html')
+    assert res.body.strip() == b'test 4'
+    res = testapp.get('/no such file', status=404)
+    assert os.path.join(path('find_file'), 'dir with spaces',
+                        'test 4.html') in cache.entries
+
+def test_static_parser_precompressed():
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'style.css'), 'wb') as fp:
+            fp.write(b'body {}')
+        with open(os.path.join(directory, 'style.css.gz'), 'wb') as fp:
+            fp.write(b'gzipped')
+        testapp = TestApp(StaticURLParser(directory, precompressed=True))
+        res = testapp.get('/style.css', headers={'Accept-Encoding': 'gzip'})
+        assert res.body == b'gzipped'
+        assert res.header('content-encoding') == 'gzip'
+        assert res.header('content-type') == 'text/css'
+        res = testapp.get('/style.css')
+        assert res.body == b'body {}'
+        assert res.header('vary') == 'Accept-Encoding'
+    finally:
+        shutil.rmtree(directory)
+
 def test_egg_parser():
     app = PkgResourcesParser('Paste', 'paste')
     testapp = TestApp(app)